@@ -0,0 +1,223 @@
+"""
+Aliquot planning: aspirate once, dispense many times.
+
+Dispensing system fluid with pump() or the set_aspirate_volume() and
+set_dispense_volume() calls costs a refill stroke and two valve switches for
+every dispense. plan_aliquots() groups the dispenses of one syringe into
+cycles: one refill through the reservoir valve followed by as many needle
+dispenses as the syringe holds.
+
+Volumes are in microliters. dead_volume is liquid that always stays in the
+syringe, over_aspirate is extra liquid kept in the syringe above the dead
+volume so that each dispense of a cycle is made in the same direction of
+travel. It is drawn with the first refill and carried from cycle to cycle,
+later refills only replace what was dispensed.
+
+Example:
+    planner = AliquotPlanner(quadz, dead_volume=5, over_aspirate=10)
+    plan = planner.plan(1, [('dest:A1', 40), ('dest:B1', 40), ...])
+    planner.run(1, plan, move=lambda well: quadz.move_to(*index[well][:2]))
+"""
+import gexceptions
+
+
+class Cycle(object):
+    """
+    One refill stroke and the dispenses made from it
+
+    refill is the volume aspirated from the reservoir (0 when the syringe
+    already holds enough), dispenses is a list of (target, volume).
+    """
+    __slots__ = ('refill', 'dispenses')
+
+    def __init__(self, refill, dispenses):
+        self.refill = refill
+        self.dispenses = dispenses
+
+    def volume(self):
+        return sum(volume for target, volume in self.dispenses)
+
+    def __repr__(self):
+        return '<Cycle refill %s uL, %i dispenses of %s uL>' % (
+                   str(self.refill), len(self.dispenses), str(self.volume()))
+
+
+class AliquotPlan(object):
+    """
+    Cycles for one syringe
+
+    final_volume is the volume left in the syringe after the last cycle.
+    """
+    def __init__(self, cycles, final_volume, dispenses):
+        self.cycles = cycles
+        self.final_volume = final_volume
+        # Number of dispenses requested, before any were split
+        self.dispenses = dispenses
+
+    def __iter__(self):
+        return iter(self.cycles)
+
+    def __len__(self):
+        return len(self.cycles)
+
+    def refills(self):
+        return sum(1 for cycle in self.cycles if cycle.refill > 0)
+
+    def valve_switches(self):
+        """
+        Number of valve switches, two for every refill (to the reservoir
+        and back to the needle)
+        """
+        return 2 * self.refills()
+
+    def report(self):
+        """
+        Compare the plan to one refill per dispense
+
+        Returns:
+        dict with the planned and the one-per-dispense refills and valve
+        switches
+        """
+        return {'dispenses': self.dispenses,
+                'refills': self.refills(),
+                'valve_switches': self.valve_switches(),
+                'single_refills': self.dispenses,
+                'single_valve_switches': 2 * self.dispenses,
+                'saved_refills': self.dispenses - self.refills()}
+
+    def __repr__(self):
+        return '<AliquotPlan %i cycles, %i refills for %i dispenses>' % (
+                   len(self.cycles), self.refills(), self.dispenses)
+
+
+def plan_aliquots(dispenses, syringe_size, current_volume = 0,
+                  dead_volume = 0, over_aspirate = 0, keep_order = False):
+    """
+    Group dispenses of one liquid into as few refill strokes as possible
+
+    Dispenses larger than a syringe load are split into several dispenses.
+    By default the dispenses are packed largest first (first fit
+    decreasing), which gives the fewest cycles; with keep_order a cycle is
+    only closed when the next dispense does not fit, so the targets are
+    visited in the given order.
+
+    Arguments:
+    dispenses -- list of (target, volume), target is passed back unchanged
+    syringe_size -- syringe volume
+    current_volume -- volume in the syringe before the first cycle
+    dead_volume -- volume that must stay in the syringe
+    over_aspirate -- extra volume kept in the syringe, drawn once with the
+                     first refill and carried between cycles
+    keep_order -- keep the order of the dispenses
+
+    Returns:
+    AliquotPlan
+    """
+    capacity = syringe_size - dead_volume - over_aspirate
+    if capacity <= 0:
+        raise gexceptions.VolumeError('Dead and over-aspirate volume (%s uL) '
+                                      'fill the %s uL syringe' %
+                                      (str(dead_volume + over_aspirate),
+                                       str(syringe_size)))
+    parts = []
+    for target, volume in dispenses:
+        if volume <= 0:
+            raise ValueError('Dispense volume for %s must be positive' %
+                             (target,))
+        while volume > capacity:
+            parts.append((target, capacity))
+            volume -= capacity
+        parts.append((target, volume))
+
+    loads = []
+    if keep_order:
+        for part in parts:
+            if not loads or loads[-1][0] + part[1] > capacity:
+                loads.append([0, []])
+            loads[-1][0] += part[1]
+            loads[-1][1].append(part)
+    else:
+        # sorted() is stable, so equal volumes keep their order
+        for part in sorted(parts, key=lambda part: -part[1]):
+            for load in loads:
+                if load[0] + part[1] <= capacity:
+                    break
+            else:
+                load = [0, []]
+                loads.append(load)
+            load[0] += part[1]
+            load[1].append(part)
+
+    cycles = []
+    volume = current_volume
+    for total, load in loads:
+        fill = dead_volume + over_aspirate + total
+        refill = 0
+        if volume < fill:
+            refill = fill - volume
+            volume = fill
+        cycles.append(Cycle(refill, load))
+        volume -= total
+    return AliquotPlan(cycles, volume, len(dispenses))
+
+
+class AliquotPlanner(object):
+    """
+    Plans and runs aliquot cycles on the syringes of a QuadZDevice
+
+    Arguments:
+    quadz -- QuadZDevice with the syringe pumps set up
+    dead_volume, over_aspirate -- see plan_aliquots()
+    """
+    def __init__(self, quadz, dead_volume = 0, over_aspirate = 0):
+        self.quadz = quadz
+        self.dead_volume = dead_volume
+        self.over_aspirate = over_aspirate
+
+    def plan(self, probe, dispenses, keep_order = False):
+        """
+        Plan the dispenses of one probe from its syringe size and current
+        volume
+
+        Arguments:
+        probe -- probe number
+        dispenses -- list of (target, volume)
+        keep_order -- see plan_aliquots()
+        """
+        syringe = self.quadz.syringe[probe]
+        if not syringe.syringe_size:
+            raise gexceptions.VolumeError('Syringe size for probe %i is not '
+                                          'set' % (probe))
+        current_volume = self.quadz.ledger.volume(probe)
+        return plan_aliquots(dispenses, syringe.syringe_size, current_volume,
+                             self.dead_volume, self.over_aspirate, keep_order)
+
+    def run(self, probe, plan, move = None):
+        """
+        Run a plan. The valve position is read before the first cycle and
+        then only switched when a cycle has a refill.
+
+        Arguments:
+        probe -- probe number
+        plan -- AliquotPlan from plan()
+        move -- function called with the target before each dispense, e.g.
+                to move the probe over the target well
+        """
+        quadz = self.quadz
+        syringe = quadz.syringe[probe]
+        # valve_status is only a cache, the valve may have been switched
+        # since it was last read
+        quadz.get_valve_status(probe)
+        for cycle in plan:
+            if cycle.refill > 0:
+                if syringe.valve_status != 'R':
+                    quadz.set_valve_status(probe, 'R')
+                quadz.set_aspirate_volume(probe, cycle.refill)
+                quadz.start_syringe_pump(probe)
+            if syringe.valve_status != 'N':
+                quadz.set_valve_status(probe, 'N')
+            for target, volume in cycle.dispenses:
+                if move is not None:
+                    move(target)
+                quadz.set_dispense_volume(probe, volume)
+                quadz.start_syringe_pump(probe)
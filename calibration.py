@@ -0,0 +1,258 @@
+"""
+Calibration of the delays the Gilson computer needs between commands.
+
+SerialQueue waits time_delay seconds between commands and switch_delay
+seconds after disconnecting from a device. The defaults (.05 and .1) are
+safe for every device; most devices accept commands faster. Calibrator
+sends bursts of commands to a device with decreasing delays and keeps the
+smallest delay at which no command failed (no null reads, no echo
+mismatches, no failed connection), plus a safety margin.
+
+The results are stored per device id and firmware version (the response to
+'%'), so a firmware update is calibrated again:
+    calibration = calibrate(quadz.queue, 'delays.json')
+
+and on the next start:
+    Calibration.load('delays.json').apply(quadz.queue)
+"""
+import json
+import os
+import gexceptions
+
+COMMAND_DELAYS = (.05, .04, .03, .025, .02, .015, .01, .0075, .005, .003,
+                  .002, .001, 0)
+SWITCH_DELAYS = (.1, .08, .06, .05, .04, .03, .025, .02, .015, .01, .005,
+                 .002, 0)
+
+
+def read_version(queue, device_id):
+    """
+    Get the firmware version of a device, None if it does not answer
+    """
+    response = queue.add_immediate_instruction(device_id, '%')
+    return response or None
+
+
+class Calibration(object):
+    """
+    Delays per device id and firmware version
+    """
+    def __init__(self, entries = None):
+        # device id (string) -> version -> {'time_delay', 'switch_delay'}
+        self.entries = entries or {}
+
+    def set(self, device_id, version, time_delay, switch_delay):
+        self.entries.setdefault(str(device_id), {})[version] = {
+            'time_delay': time_delay,
+            'switch_delay': switch_delay}
+
+    def get(self, device_id, version):
+        """
+        Returns:
+        (time_delay, switch_delay) or None if the device was not calibrated
+        with this firmware version
+        """
+        entry = self.entries.get(str(device_id), {}).get(version)
+        if entry is None:
+            return None
+        return entry['time_delay'], entry['switch_delay']
+
+    def apply(self, queue, versions = None):
+        """
+        Set the calibrated delays of the devices registered with a queue
+
+        Arguments:
+        queue -- SerialQueue
+        versions -- dict of device id: firmware version, versions that are
+                    missing are read from the devices
+
+        Returns:
+        dict of device id: (time_delay, switch_delay) that were applied
+        """
+        versions = versions or {}
+        applied = {}
+        for device_id in set(queue.registered_devices):
+            version = versions.get(device_id)
+            if version is None:
+                version = read_version(queue, device_id)
+            delays = self.get(device_id, version)
+            if delays is not None:
+                queue.set_delays(device_id, *delays)
+                applied[device_id] = delays
+        return applied
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a calibration file, an empty calibration if it does not exist
+        """
+        if not os.path.exists(path):
+            return cls()
+        with open(path) as f:
+            return cls(json.load(f))
+
+
+class Calibrator(object):
+    """
+    Finds the smallest safe delays for the devices of a queue
+
+    Arguments:
+    queue -- SerialQueue with the devices registered
+    trials -- commands (or device switches) sent at each delay
+    margin -- fraction added to the smallest delay that worked
+    minimum -- smallest delay applied
+    log -- logger for the results, by default the queue's log
+    """
+    def __init__(self, queue, trials = 20, margin = .5, minimum = .002,
+                 log = None):
+        self.queue = queue
+        self.trials = trials
+        self.margin = margin
+        self.minimum = minimum
+        self.log = log or queue.log
+
+    def failures(self):
+        return sum(self.queue.errors.values())
+
+    def trial_commands(self, device_id, version):
+        """
+        Send trials version requests to a device
+
+        Returns:
+        True if every request was answered correctly
+        """
+        failures = self.failures()
+        for i in range(self.trials):
+            if self.queue.add_immediate_instruction(device_id, '%') != \
+               version:
+                return False
+        return self.failures() == failures
+
+    def trial_switches(self, device_id, other):
+        """
+        Switch trials times from device_id to other and back
+
+        Returns:
+        True if every connection succeeded at the first attempt
+        """
+        failures = self.failures()
+        for i in range(self.trials):
+            for target in (device_id, other):
+                if not self.queue.add_immediate_instruction(target, '%'):
+                    return False
+        return self.failures() == failures
+
+    def search(self, delays, trial):
+        """
+        Try decreasing delays until a trial fails
+
+        Returns:
+        the smallest delay that passed, None if the first one failed
+        """
+        passed = None
+        for delay in delays:
+            if not trial(delay):
+                break
+            passed = delay
+        return passed
+
+    def safe(self, delay, current):
+        """
+        Add the safety margin, never exceeding the current delay
+        """
+        if delay is None:
+            return current
+        return min(max(delay * (1 + self.margin), self.minimum), current)
+
+    def calibrate_device(self, device_id, other = None):
+        """
+        Calibrate the delays of a device. The switch delay is only
+        calibrated when there is another device to switch to.
+
+        Arguments:
+        device_id -- device to calibrate
+        other -- registered device used for the switch trials
+
+        Returns:
+        (version, time_delay, switch_delay), the delays are applied to the
+        queue
+        """
+        queue = self.queue
+        version = read_version(queue, device_id)
+        if version is None:
+            raise gexceptions.DeviceNotResponding(device_id,
+                                                  'No version response')
+        time_delay, switch_delay = queue.get_delays(device_id)
+
+        def commands(delay):
+            queue.set_delays(device_id, delay, None)
+            return self.trial_commands(device_id, version)
+        found = self.search([delay for delay in COMMAND_DELAYS
+                             if delay <= time_delay], commands)
+        # The queue waits twice between immediate commands (after the
+        # command and at the end of its loop) but only once between an
+        # immediate command and the buffer poll of a buffered command
+        if found is not None:
+            found *= 2
+        time_delay = self.safe(found, time_delay)
+        queue.set_delays(device_id, time_delay, None)
+
+        if other is not None:
+            def switches(delay):
+                queue.set_delays(device_id, None, delay)
+                return self.trial_switches(device_id, other)
+            found = self.search([delay for delay in SWITCH_DELAYS
+                                 if delay <= switch_delay], switches)
+            switch_delay = self.safe(found, switch_delay)
+            queue.set_delays(device_id, None, switch_delay)
+        self.log.info('Device %i (%s): command delay %.4f s, switch delay '
+                      '%.4f s' % (device_id, version, time_delay,
+                                  switch_delay))
+        return version, time_delay, switch_delay
+
+    def calibrate(self, device_ids = None, calibration = None):
+        """
+        Calibrate devices
+
+        Arguments:
+        device_ids -- devices to calibrate, by default all registered
+                      devices
+        calibration -- Calibration to add the results to
+
+        Returns:
+        Calibration
+        """
+        if calibration is None:
+            calibration = Calibration()
+        registered = sorted(set(self.queue.registered_devices))
+        if device_ids is None:
+            device_ids = registered
+        for device_id in device_ids:
+            others = [other for other in registered if other != device_id]
+            version, time_delay, switch_delay = self.calibrate_device(
+                device_id, others[0] if others else None)
+            calibration.set(device_id, version, time_delay, switch_delay)
+        return calibration
+
+
+def calibrate(queue, path = None, **options):
+    """
+    Calibrate the registered devices of a queue and apply the delays
+
+    Arguments:
+    queue -- SerialQueue
+    path -- calibration file to add the results to
+    options -- passed to Calibrator
+
+    Returns:
+    Calibration
+    """
+    calibration = Calibration.load(path) if path else Calibration()
+    Calibrator(queue, **options).calibrate(calibration=calibration)
+    if path:
+        calibration.save(path)
+    return calibration
@@ -0,0 +1,142 @@
+"""
+Clocks for waiting and timing.
+
+SerialQueue, QuadZDevice and the emulator read the time and sleep through a
+clock. The default clock is the system clock. A VirtualClock makes sleeps
+return at once and advances its time instead, so a protocol run against
+emulated devices takes the time it would on an instrument in virtual time
+but only seconds of wall time:
+    clock = VirtualClock()
+    quadz = emulator.emulated_station(clock=clock)
+    runner = worklist.WorklistRunner(quadz, index)
+    print runner.run(worklist.read_worklist('transfers.csv'))['elapsed']
+
+Worker threads (the SerialQueue thread) advance the time as they sleep.
+While a worker is busy, other threads sleeping on the clock wait for the
+worker to reach their wake up time, so the caller's polling overlaps the
+queue's delays as it does in real time.
+
+Sleeps of other threads add up, unless the threads are registered as actors
+(the Scheduler and Fleet threads are). An actor's sleep only moves the time
+once every actor is asleep and the workers are idle, and then only to the
+earliest wake up time, so actors sleeping at once overlap as they would in
+real time. An actor that waits for anything but the clock or a worker (a
+lock, an event set by another actor) holds the time still until it wakes.
+Several SerialQueues on one VirtualClock are not simulated, their workers'
+delays add up; give each emulated station its own clock.
+"""
+import time
+import threading
+
+
+class Clock(object):
+    """
+    System clock
+    """
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def add_worker(self, thread, busy):
+        """
+        Register a worker thread, see VirtualClock
+
+        Arguments:
+        thread -- threading.Thread
+        busy -- function returning True while the worker has work queued
+        """
+        pass
+
+    def add_actor(self, thread):
+        """
+        Register a thread whose sleeps overlap with those of the other
+        actors, see VirtualClock. Call it before starting the thread.
+        """
+        pass
+
+
+class VirtualClock(Clock):
+    """
+    Clock whose time only advances by sleeping
+
+    Arguments:
+    start -- initial time in seconds
+    """
+    def __init__(self, start = 0.0):
+        self.now = float(start)
+        self.condition = threading.Condition()
+        self.workers = {}
+        self.actors = []
+        # Wake up times of the sleeping actors
+        self.sleeping = {}
+        # Number of sleeps and total virtual seconds slept
+        self.sleeps = 0
+        self.slept = 0.0
+
+    def time(self):
+        return self.now
+
+    def add_worker(self, thread, busy):
+        self.workers[thread] = busy
+
+    def add_actor(self, thread):
+        with self.condition:
+            self.actors.append(thread)
+
+    def busy(self):
+        return any(busy() for thread, busy in self.workers.items()
+                   if thread.is_alive())
+
+    def may_advance(self, thread, target):
+        """
+        True if a sleeping thread may move the time to its wake up time.
+        Must be called holding the condition.
+        """
+        if self.busy():
+            # Let the workers move the time while they are busy
+            return False
+        if thread not in self.actors:
+            return True
+        # Threads not started yet count as awake
+        self.actors = [actor for actor in self.actors
+                       if actor.ident is None or actor.is_alive()]
+        for actor in self.actors:
+            if actor not in self.sleeping:
+                return False
+        return target <= min(self.sleeping.values())
+
+    def sleep(self, seconds):
+        seconds = max(seconds, 0)
+        with self.condition:
+            self.sleeps += 1
+            self.slept += seconds
+            target = self.now + seconds
+            thread = threading.current_thread()
+            if thread not in self.workers:
+                actor = thread in self.actors
+                if actor:
+                    self.sleeping[thread] = target
+                while self.now < target and \
+                      not self.may_advance(thread, target):
+                    self.condition.wait(.001)
+                if actor:
+                    del self.sleeping[thread]
+            if self.now < target:
+                self.now = target
+            self.condition.notify_all()
+        # Let other threads run, e.g. the queue thread the caller polls
+        time.sleep(0)
+
+    def advance(self, seconds):
+        """
+        Move the time forward without counting a sleep
+        """
+        with self.condition:
+            self.now += seconds
+            self.condition.notify_all()
+
+
+# Shared default
+SYSTEM = Clock()
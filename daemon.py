@@ -0,0 +1,901 @@
+"""
+Instrument daemon that lets several processes share one serial port.
+
+The daemon owns the SerialQueue of a serial port and serves it over a Unix
+domain socket. Clients connect with RemoteQueue, which has the SerialQueue
+methods QuadZDevice uses, so a QuadZDevice works through the daemon
+unchanged:
+    quadz = QuadZDevice(queue=RemoteQueue('/tmp/pygilson.sock'))
+
+Protocol: every message is a fixed size struct header followed by a payload.
+    request  -- request id (I), operation (B), priority (B), device id (b),
+                payload length (H)
+    response -- request id (I), status (B), payload length (H)
+Requests are pipelined: a client can send many requests without waiting and
+responses carry the request id. Buffered commands are acknowledged when they
+are queued, so their responses are not waited for unless they may fail with
+QueueFull (block=False or a timeout). Errors are sent as 'Class: message'
+and raised on the client as the gexceptions class of that name.
+
+When a pipelined buffered request of a client fails, e.g. with the error of
+a failed buffered instruction (see SerialQueue.fail_device()), the daemon
+drops that client's later instructions for the device until the client has
+raised the error and sends RESUME. A motion sequence thus stops at the
+failed step as it does on a local SerialQueue.
+
+A buffered request that finds the daemon's queue full does not hold up the
+other clients: it stays at the head of its client's requests and is retried
+every retry_interval until it is queued or its timeout has passed.
+
+Requests of each client are handled in order. Between clients the daemon
+serves the highest priority first and takes turns between clients of the
+same priority. Read-only status queries for the same device and command
+that are waiting in several clients are answered with one bus transaction.
+
+Run the daemon from the command line:
+    python daemon.py /tmp/pygilson.sock COM3
+"""
+import os
+import json
+import socket
+import struct
+import threading
+import time
+import logging
+from collections import deque
+import gexceptions
+import gcommands
+from clock import SYSTEM as SYSTEM_CLOCK
+
+REQUEST = struct.Struct('!IBBbH')
+RESPONSE = struct.Struct('!IBH')
+
+# Operations
+IMMEDIATE = 1
+STATUS = 2
+BUFFERED = 3
+REGISTER = 4
+PENDING = 5
+DRAIN = 6
+CANCEL = 7
+STATE = 8
+DELAYS = 9
+RESUME = 10
+
+# Response status: ERROR is an instruction that failed (False on the
+# client), RAISED an exception of the queue that the client raises again
+# and DROPPED an instruction skipped after a failed pipelined request
+OK = 0
+ERROR = 1
+RAISED = 2
+DROPPED = 3
+
+# Operations dropped for a device whose pipelined request failed
+DROPPABLE = (IMMEDIATE, STATUS, BUFFERED)
+
+# Buffer semantics of buffered requests, the first payload byte. It is
+# followed by the options 'block,timeout,deadline', LF and the instructions
+# separated by CR.
+WAITS = {'handler': 'h', 'pump': 'p'}
+WAIT_NAMES = dict((code, name) for name, code in WAITS.items())
+
+# Immediate commands that change the device or depend on the previous call
+# (the range commands return the next line on every call) are never
+# coalesced
+NOT_COALESCED = ('$', 'q', 'Q')
+
+
+def receive(connection, size):
+    """
+    Read exactly size bytes, None if the connection was closed
+    """
+    data = ''
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def coalescable(instruction):
+    return instruction not in NOT_COALESCED
+
+
+def describe(exception):
+    return '%s: %s' % (exception.__class__.__name__, str(exception))
+
+
+def remote_error(device_id, payload):
+    """
+    Get the exception for an error response: the gexceptions class named in
+    the payload, DeviceException for any other error
+    """
+    name, _, message = payload.partition(': ')
+    cls = getattr(gexceptions, name, None)
+    if isinstance(cls, type) and issubclass(cls, gexceptions.DeviceException):
+        return cls(device_id, message)
+    return gexceptions.DeviceException(device_id, payload)
+
+
+def optional_float(text):
+    return float(text) if text else None
+
+
+def buffered_payload(wait, bodies, block, timeout, deadline):
+    options = ','.join(['1' if block else '0'] +
+                       ['' if value is None else repr(float(value))
+                        for value in (timeout, deadline)])
+    return WAITS[wait] + options + gcommands.LF + gcommands.CR.join(bodies)
+
+
+def pipelined(payload):
+    """
+    True if the client does not wait for the response to a buffered request
+    """
+    options = payload[1:].split(gcommands.LF, 1)[0]
+    return options.startswith('1,,')
+
+
+def parse_buffered(payload):
+    """
+    Returns:
+    (wait, instructions, block, timeout, deadline) of a buffered request
+    """
+    options, instructions = payload[1:].split(gcommands.LF, 1)
+    block, timeout, deadline = options.split(',')
+    return (WAIT_NAMES[payload[0]], instructions.split(gcommands.CR),
+            block == '1', optional_float(timeout), optional_float(deadline))
+
+
+################################
+####                        ####
+####         Server         ####
+####                        ####
+################################
+
+class Request(object):
+    __slots__ = ('client', 'request_id', 'operation', 'priority',
+                 'device_id', 'payload', 'expires', 'retries')
+
+    def __init__(self, client, request_id, operation, priority, device_id,
+                 payload):
+        self.client = client
+        self.request_id = request_id
+        self.operation = operation
+        self.priority = priority
+        self.device_id = device_id
+        self.payload = payload
+        # Time a buffered request waiting for a free slot gives up
+        self.expires = None
+        self.retries = 0
+
+
+class Client(object):
+    """
+    Connection of one client process
+    """
+    def __init__(self, number, connection):
+        self.number = number
+        self.connection = connection
+        self.requests = deque()
+        # Time the parked request at the head of requests is retried
+        self.retry_at = 0
+        # Devices whose pipelined buffered request failed, see RESUME
+        self.failed = set()
+        self.lock_send = threading.Lock()
+        self.closed = False
+        self.event_closed = threading.Event()
+
+    def respond(self, request_id, status, payload = ''):
+        try:
+            with self.lock_send:
+                self.connection.sendall(RESPONSE.pack(request_id, status,
+                                                      len(payload)) +
+                                        payload)
+        except socket.error:
+            self.closed = True
+
+
+class InstrumentDaemon(object):
+    """
+    Serves a SerialQueue over a Unix domain socket
+
+    Arguments:
+    path -- socket file name, None to only serve connections passed to
+            add_client()
+    queue -- SerialQueue of the serial port, already started
+    retry_interval -- seconds between attempts to queue a buffered request
+                      while the queue is full
+    """
+    def __init__(self, path, queue, retry_interval = .05):
+        self.path = path
+        self.queue = queue
+        self.clients = []
+        self.condition = threading.Condition()
+        # Number of the client served last, for turns between clients
+        self.last_client = -1
+        self.count = 0
+        self.running = False
+        self.server = None
+        self.retry_interval = retry_interval
+        self.stats = {'requests': 0,
+                      'transactions': 0,
+                      'coalesced': 0}
+
+    def start(self):
+        """
+        Listen on the socket and handle clients in background threads
+        """
+        self.running = True
+        targets = [self.dispatch]
+        if self.path is not None:
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.server.bind(self.path)
+            self.server.listen(16)
+            targets.append(self.accept)
+        for target in targets:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        self.running = False
+        with self.condition:
+            self.condition.notify_all()
+        if self.server is not None:
+            self.server.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def serve_forever(self):
+        self.start()
+        while self.running:
+            time.sleep(1)
+
+    def accept(self):
+        while self.running:
+            try:
+                connection, address = self.server.accept()
+            except socket.error:
+                return
+            self.add_client(connection)
+
+    def add_client(self, connection):
+        """
+        Serve a connected socket, e.g. one end of a socket pair
+
+        Returns:
+        Client
+        """
+        with self.condition:
+            client = Client(self.count, connection)
+            self.count += 1
+            self.clients.append(client)
+        thread = threading.Thread(target=self.read, args=(client,))
+        thread.daemon = True
+        thread.start()
+        return client
+
+    def read(self, client):
+        """
+        Read the requests of a client into its queue
+        """
+        connection = client.connection
+        while self.running:
+            try:
+                header = receive(connection, REQUEST.size)
+                if header is None:
+                    break
+                request_id, operation, priority, device_id, size = \
+                    REQUEST.unpack(header)
+                payload = receive(connection, size) if size else ''
+                if payload is None:
+                    break
+            except socket.error:
+                break
+            with self.condition:
+                client.requests.append(Request(client, request_id, operation,
+                                               priority, device_id, payload))
+                self.condition.notify()
+        with self.condition:
+            client.closed = True
+            self.clients.remove(client)
+        connection.close()
+        client.event_closed.set()
+
+    def next_request(self):
+        """
+        Take the next request: highest priority first, then the client after
+        the one served last. Must be called holding the condition.
+        """
+        now = time.time()
+        heads = [client for client in self.clients
+                 if client.requests and client.retry_at <= now]
+        if not heads:
+            return None
+        priority = max(client.requests[0].priority for client in heads)
+        heads = [client for client in heads
+                 if client.requests[0].priority == priority]
+        later = [client for client in heads
+                 if client.number > self.last_client]
+        client = (later or heads)[0]
+        self.last_client = client.number
+        return client.requests.popleft()
+
+    def wait_time(self):
+        """
+        Seconds until the next parked request is retried, at most 1. Must be
+        called holding the condition.
+        """
+        retries = [client.retry_at for client in self.clients
+                   if client.requests and client.retry_at]
+        if not retries:
+            return 1
+        return min(max(min(retries) - time.time(), 0), 1)
+
+    def park(self, request):
+        """
+        Put a buffered request that found the queue full back at the head
+        of its client's requests, to be retried after retry_interval
+        """
+        with self.condition:
+            client = request.client
+            request.retries += 1
+            client.requests.appendleft(request)
+            client.retry_at = time.time() + self.retry_interval
+
+    def coalesce(self, request):
+        """
+        Take the status queries equal to request that other clients can
+        have answered now: those before any other kind of request in their
+        queue. Must be called holding the condition.
+        """
+        same = []
+        for client in self.clients:
+            if client is request.client:
+                continue
+            for other in list(client.requests):
+                if other.operation != STATUS:
+                    break
+                if other.device_id == request.device_id and \
+                   other.payload == request.payload:
+                    client.requests.remove(other)
+                    same.append(other)
+        return same
+
+    def dispatch(self):
+        while self.running:
+            with self.condition:
+                request = self.next_request()
+                while request is None and self.running:
+                    self.condition.wait(self.wait_time())
+                    request = self.next_request()
+                if request is None:
+                    return
+                client = request.client
+                client.retry_at = 0
+                dropped = request.operation in DROPPABLE and \
+                          request.device_id in client.failed
+                same = []
+                if request.operation == STATUS and not dropped:
+                    same = self.coalesce(request)
+            if dropped:
+                client.respond(request.request_id, DROPPED)
+                continue
+            if not request.retries:
+                self.stats['requests'] += 1 + len(same)
+                self.stats['coalesced'] += len(same)
+            try:
+                status, payload = self.execute(request)
+            except Exception, e:
+                status = RAISED
+                payload = describe(e)
+                if request.operation == BUFFERED and \
+                   pipelined(request.payload):
+                    client.failed.add(request.device_id)
+            if status is None:
+                continue
+            for waiting in [request] + same:
+                waiting.client.respond(waiting.request_id, status, payload)
+
+    def execute(self, request):
+        """
+        Run a request on the queue
+
+        Returns:
+        (status, payload), status None if the response is sent later
+        """
+        queue = self.queue
+        operation = request.operation
+        device_id = request.device_id
+        if operation in (IMMEDIATE, STATUS):
+            self.stats['transactions'] += 1
+            instruction, _, timeout = request.payload.partition(gcommands.LF)
+            response = queue.add_immediate_instruction(
+                           device_id, instruction, optional_float(timeout))
+            if response is False:
+                return ERROR, describe(queue.last_exception)
+            return OK, response
+        if operation == BUFFERED:
+            return self.execute_buffered(request)
+        if operation == REGISTER:
+            return OK, '1' if queue.register_device(device_id) else '0'
+        if operation == RESUME:
+            request.client.failed.discard(device_id)
+            return OK, ''
+        if device_id < 0:
+            device_id = None
+        if operation == PENDING:
+            return OK, str(queue.pending(device_id))
+        if operation == CANCEL:
+            return OK, str(queue.cancel(device_id))
+        if operation == STATE:
+            return OK, json.dumps(self.state())
+        if operation == DELAYS:
+            if request.payload:
+                queue.set_delays(device_id, *json.loads(request.payload))
+                return OK, json.dumps(queue.delays.get(device_id))
+            return OK, json.dumps(queue.get_delays(device_id))
+        if operation == DRAIN:
+            timeout = float(request.payload) if request.payload else None
+
+            def drain():
+                done = queue.drain(device_id, timeout)
+                request.client.respond(request.request_id, OK,
+                                       '1' if done else '0')
+            thread = threading.Thread(target=drain)
+            thread.daemon = True
+            thread.start()
+            return None, ''
+        return ERROR, 'Unknown operation %i' % (operation)
+
+    def execute_buffered(self, request):
+        """
+        Queue a buffered request without blocking. If the queue is full the
+        request is parked (see park()) until its timeout has passed, then
+        the client gets QueueFull.
+        """
+        queue = self.queue
+        device_id = request.device_id
+        wait, instructions, block, timeout, deadline = \
+            parse_buffered(request.payload)
+        if not request.retries:
+            if not block:
+                timeout = 0
+            if timeout is not None:
+                request.expires = time.time() + timeout
+        try:
+            if len(instructions) == 1:
+                queue.add_buffered_instruction(device_id, instructions[0],
+                                               wait, block=False,
+                                               deadline=deadline)
+            else:
+                queue.add_buffered_instructions(device_id, instructions,
+                                                wait, block=False,
+                                                deadline=deadline)
+        except gexceptions.QueueFull:
+            if request.expires is not None and \
+               time.time() >= request.expires:
+                raise
+            self.park(request)
+            return None, ''
+        return OK, ''
+
+    def state(self):
+        """
+        Get the connection state of the queue, see RemoteQueue.mirror()
+        """
+        queue = self.queue
+        with queue.condition_outstanding:
+            outstanding = dict((str(device_id), count) for device_id, count
+                               in queue.outstanding.items() if count)
+        last_exception = queue.last_exception
+        if last_exception is not False:
+            last_exception = describe(last_exception)
+        return {'connected_device': queue.connected_device,
+                'registered_devices': list(queue.registered_devices),
+                'outstanding': outstanding,
+                'sleep_total': queue.sleep_total,
+                'last_exception': last_exception,
+                'errors': queue.errors,
+                'delays': dict((str(device_id), list(delays))
+                               for device_id, delays
+                               in queue.delays.items()),
+                'health': dict((str(device_id), report)
+                               for device_id, report
+                               in queue.health.report().items()),
+                'request_timeout': queue.request_timeout}
+
+
+################################
+####                        ####
+####         Client         ####
+####                        ####
+################################
+
+class BufferedEvent(object):
+    """
+    Stand-in for SerialQueue.event_buffered: wait() returns once the
+    daemon has sent all queued buffered commands
+    """
+    def __init__(self, queue):
+        self.queue = queue
+
+    def wait(self, timeout = None):
+        return self.queue.drain(None, timeout)
+
+    def is_set(self):
+        return not self.queue.pending()
+
+
+class RemoteErrors(object):
+    """
+    Stand-in for SerialQueue.errors: the transmission error counts are read
+    from the daemon on every access
+    """
+    def __init__(self, queue):
+        self.queue = queue
+
+    def counts(self):
+        state = self.queue.mirror()
+        return state['errors'] if state is not None else {}
+
+    def __getitem__(self, key):
+        return self.counts()[key]
+
+    def items(self):
+        return self.counts().items()
+
+    def values(self):
+        return self.counts().values()
+
+
+class RemoteHealth(object):
+    """
+    Read-only stand-in for SerialQueue.health. The circuits are kept by the
+    daemon's HealthMonitor, which also sends the health checks; only
+    report() and is_open() are available to clients.
+    """
+    def __init__(self, queue):
+        self.queue = queue
+
+    def report(self):
+        """
+        Returns:
+        dict of device id: DeviceHealth.report() of the daemon's queue
+        """
+        state = self.queue.mirror()
+        if state is None:
+            return {}
+        return dict((int(device_id), report)
+                    for device_id, report in state['health'].items())
+
+    def is_open(self, device_id):
+        report = self.report().get(device_id)
+        return report is not None and report['state'] != 'closed'
+
+
+class RemoteQueue(object):
+    """
+    SerialQueue proxy that sends the instructions to an InstrumentDaemon
+
+    Buffered instructions that block until the daemon's queue has room
+    (block=True and no timeout, the default) are pipelined: the error of a
+    failed one, e.g. CircuitOpen or the error of an earlier buffered
+    instruction that failed on the bus, is raised once by the next
+    instruction added for the device, like SerialQueue.check_failure().
+    Until then the daemon drops the instructions sent for the device. With
+    block=False or a timeout the daemon's response is waited for and
+    QueueFull and the other errors are raised at once.
+
+    errors and health read the daemon's queue on every access, delays is
+    updated by set_delays() and mirror(). request_timeout is sent with
+    every immediate instruction; None uses the request_timeout of the
+    daemon's queue.
+
+    Arguments:
+    path -- socket file name of the daemon
+    priority -- priority of this client's requests (0-255, higher first)
+    connection -- socket already connected to a daemon, replaces path
+    """
+    def __init__(self, path, priority = 0, connection = None):
+        self.path = path
+        self.priority = priority
+        if connection is None:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.connect(path)
+        self.connection = connection
+        self.log = logging.getLogger('pygilson')
+        if not self.log.handlers:
+            log_handler = logging.StreamHandler()
+            log_handler.setFormatter(logging.Formatter(
+                '%(asctime)s %(levelname)s: %(message)s'))
+            self.log.addHandler(log_handler)
+            self.log.setLevel(logging.DEBUG)
+        self.lock_send = threading.Lock()
+        self.lock_pending = threading.Lock()
+        self.count = 0
+        # Outstanding requests: request id -> [event, status, payload]
+        self.waiting = {}
+        # Pipelined requests: request id -> device id, and the errors of
+        # failed ones by device until they are raised
+        self.pipelined = {}
+        self.failures = {}
+        self.last_exception = False
+        self.event_buffered = BufferedEvent(self)
+        self.errors = RemoteErrors(self)
+        self.health = RemoteHealth(self)
+        self.request_timeout = None
+        self.time_delay = .05
+        self.sleep_subtotal = 0
+        self.sleep_total = 0
+        self.clock = SYSTEM_CLOCK
+        # Connection state of the daemon's queue, updated by mirror()
+        self.connected_device = None
+        self.registered_devices = []
+        self.outstanding = {}
+        self.delays = {}
+        self.closed = False
+        thread = threading.Thread(target=self.read)
+        thread.daemon = True
+        thread.start()
+
+    def read(self):
+        while True:
+            try:
+                header = receive(self.connection, RESPONSE.size)
+                if header is None:
+                    break
+                request_id, status, size = RESPONSE.unpack(header)
+                payload = receive(self.connection, size) if size else ''
+                if payload is None:
+                    break
+            except socket.error:
+                break
+            with self.lock_pending:
+                entry = self.waiting.pop(request_id, None)
+                device_id = self.pipelined.pop(request_id, -1)
+            if entry is None:
+                if status in (ERROR, RAISED):
+                    error = remote_error(device_id, payload)
+                    self.last_exception = error
+                    if status == RAISED and device_id not in self.failures:
+                        self.failures[device_id] = error
+                    self.log.error('Daemon: %s' % (payload))
+                continue
+            entry[1] = status
+            entry[2] = payload
+            entry[0].set()
+        self.closed = True
+        with self.lock_pending:
+            entries = self.waiting.values()
+            self.waiting.clear()
+            self.pipelined.clear()
+        for entry in entries:
+            entry[1] = ERROR
+            entry[2] = 'Connection to the daemon was closed'
+            entry[0].set()
+
+    def send(self, operation, device_id, payload = '', reply = True):
+        """
+        Send a request
+
+        Arguments:
+        reply -- wait for the response, if False the request is pipelined
+                 and its errors are kept for check_failure()
+
+        Returns:
+        (status, payload) of the response, (OK, '') if reply is False
+        """
+        if self.closed:
+            raise gexceptions.DeviceNotResponding(device_id,
+                                        'Connection to the daemon was closed')
+        with self.lock_send:
+            self.count = (self.count + 1) & 0xffffffff
+            request_id = self.count
+            with self.lock_pending:
+                if reply:
+                    entry = [threading.Event(), None, None]
+                    self.waiting[request_id] = entry
+                else:
+                    self.pipelined[request_id] = device_id
+            self.connection.sendall(REQUEST.pack(request_id, operation,
+                                                 self.priority, device_id,
+                                                 len(payload)) + payload)
+        if not reply:
+            return OK, ''
+        entry[0].wait()
+        return entry[1], entry[2]
+
+    def start(self):
+        pass
+
+    def sleep(self, seconds, parent = None, top_parent = None):
+        if seconds == 0:
+            self.sleep_subtotal = 0
+            return
+        self.sleep_total += seconds
+        self.sleep_subtotal += seconds
+        self.clock.sleep(seconds)
+
+    def register_device(self, device_id):
+        status, payload = self.send(REGISTER, device_id)
+        self.mirror()
+        return status == OK and payload == '1'
+
+    def mirror(self):
+        """
+        Copy the connection state of the daemon's queue: connected_device,
+        registered_devices, outstanding buffered commands per device, the
+        delays and the last exception of the queue thread
+
+        Returns:
+        dict of the state
+        """
+        status, payload = self.send(STATE, -1)
+        if status != OK:
+            return None
+        state = json.loads(payload)
+        self.connected_device = state['connected_device']
+        self.registered_devices = state['registered_devices']
+        self.outstanding = dict((int(device_id), count) for device_id, count
+                                in state['outstanding'].items())
+        self.delays = dict((int(device_id), tuple(delays))
+                           for device_id, delays in state['delays'].items())
+        if state['last_exception']:
+            self.last_exception = remote_error(self.connected_device,
+                                               state['last_exception'])
+        return state
+
+    def check_failure(self, device_id):
+        """
+        Raise the error of a failed pipelined request for a device, once,
+        and let the daemon take instructions for the device again
+        """
+        error = self.failures.pop(device_id, None)
+        if error is not None:
+            self.send(RESUME, device_id, reply=False)
+            raise error
+
+    def add_immediate_instruction(self, device_id, instruction,
+                                  timeout = None):
+        """
+        See SerialQueue.add_immediate_instruction(), the timeout (by
+        default request_timeout) is enforced by the daemon's queue
+        """
+        self.check_failure(device_id)
+        if isinstance(instruction, gcommands.Frame):
+            instruction = instruction.wire
+        operation = STATUS if coalescable(instruction) else IMMEDIATE
+        if timeout is None:
+            timeout = self.request_timeout
+        payload = instruction
+        if timeout is not None:
+            payload += gcommands.LF + repr(float(timeout))
+        status, payload = self.send(operation, device_id, payload)
+        if status == DROPPED:
+            # The error of the failed request arrived before this response
+            self.check_failure(device_id)
+        if status == RAISED:
+            raise remote_error(device_id, payload)
+        if status != OK:
+            self.last_exception = remote_error(device_id, payload)
+            return False
+        return payload
+
+    def add_buffered_instruction(self, device_id, instruction,
+                                 wait = 'handler', block = True,
+                                 timeout = None, deadline = None):
+        """
+        See SerialQueue.add_buffered_instruction() and the class docstring
+        for the errors that are raised
+        """
+        self.add_buffered_instructions(device_id, [instruction], wait,
+                                       block, timeout, deadline)
+
+    def add_buffered_instructions(self, device_id, instructions,
+                                  wait = 'handler', block = True,
+                                  timeout = None, deadline = None):
+        """
+        See SerialQueue.add_buffered_instructions(), the batch is queued by
+        the daemon in one piece
+        """
+        bodies = [instruction.body
+                  if isinstance(instruction, gcommands.Frame)
+                  else instruction for instruction in instructions]
+        if not bodies:
+            return
+        self.check_failure(device_id)
+        payload = buffered_payload(wait, bodies, block, timeout, deadline)
+        if block and timeout is None:
+            self.send(BUFFERED, device_id, payload, reply=False)
+            return
+        status, payload = self.send(BUFFERED, device_id, payload)
+        if status == DROPPED:
+            self.check_failure(device_id)
+        if status != OK:
+            raise remote_error(device_id, payload)
+
+    def get_delays(self, device_id = None):
+        """
+        Get the delays the daemon's queue uses for a device
+
+        Arguments:
+        device_id -- device id, None for the connected device
+
+        Returns:
+        (time_delay, switch_delay)
+        """
+        status, payload = self.send(DELAYS, -1 if device_id is None
+                                            else device_id)
+        if status != OK:
+            raise remote_error(device_id, payload)
+        return tuple(json.loads(payload))
+
+    def set_delays(self, device_id, time_delay, switch_delay):
+        """
+        Set the delays of the daemon's queue for a device, see
+        SerialQueue.set_delays(). They apply to every client.
+        """
+        status, payload = self.send(DELAYS, device_id,
+                                    json.dumps([time_delay, switch_delay]))
+        if status != OK:
+            raise remote_error(device_id, payload)
+        delays = json.loads(payload)
+        if delays is None:
+            self.delays.pop(device_id, None)
+        else:
+            self.delays[device_id] = tuple(delays)
+
+    def pending(self, device_id = None):
+        status, payload = self.send(PENDING, -1 if device_id is None
+                                             else device_id)
+        return int(payload) if status == OK else 0
+
+    def cancel(self, device_id):
+        status, payload = self.send(CANCEL, device_id)
+        return int(payload) if status == OK else 0
+
+    def drain(self, device_id = None, timeout = None):
+        payload = '' if timeout is None else repr(float(timeout))
+        status, payload = self.send(DRAIN, -1 if device_id is None
+                                           else device_id, payload)
+        return status == OK and payload == '1'
+
+    def close(self):
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.connection.close()
+
+
+def main(argv):
+    """
+    Run a daemon for a serial port: daemon.py socket_path serial_port
+    """
+    import serial
+    from serialqueue import SerialQueue
+    if len(argv) != 3:
+        print 'Usage: python daemon.py socket_path serial_port'
+        return 1
+    device = serial.Serial(argv[2], 19200, parity=serial.PARITY_EVEN,
+                           timeout=1)
+    queue = SerialQueue(device)
+    queue.daemon = True
+    queue.start()
+    queue.supervise()
+    daemon = InstrumentDaemon(argv[1], queue)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        daemon.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv))
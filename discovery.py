@@ -0,0 +1,203 @@
+"""
+Discovery of the devices on a GSIOC bus.
+
+Setting up a QuadZDevice requires the id of every device, and a wrong id
+costs several reconnect attempts, each waiting for the read timeout.
+Scanner sends the select byte of every id once with a short read timeout.
+A device that echoes it is asked for its version ('%'), which identifies
+its type:
+    'quadz' -- Quad-Z 215 liquid handler
+    '402' -- 402 syringe pump
+    '819' -- 819 valve actuator
+    'unknown' -- any other device
+
+Only one device on a bus can be selected at a time, so the ids of one bus
+are scanned one after another. An id that does not echo leaves no device
+selected and the next id is selected right away, so only found devices pay
+the disconnect delay and a full bus takes about 64 read timeouts. Buses on
+different serial ports are scanned in parallel with scan_ports().
+
+Example:
+    quadz = QuadZDevice(com_port='/dev/ttyUSB0')
+    devices = discover(quadz)
+    print devices
+"""
+import threading
+import gcommands
+import gexceptions
+
+QUADZ = 'quadz'
+PUMP_402 = '402'
+VALVE_819 = '819'
+UNKNOWN = 'unknown'
+
+# GSIOC device ids
+DEVICE_IDS = range(64)
+
+
+def classify(version):
+    """
+    Get the device type from the response to '%'
+    """
+    if version.startswith('402'):
+        return PUMP_402
+    if version.startswith('819'):
+        return VALVE_819
+    if 'quad' in version.lower() or version.startswith('215'):
+        return QUADZ
+    return UNKNOWN
+
+
+class DeviceInfo(object):
+    """
+    A device found on the bus
+    """
+    __slots__ = ('device_id', 'version', 'kind')
+
+    def __init__(self, device_id, version):
+        self.device_id = device_id
+        self.version = version
+        self.kind = classify(version)
+
+    def to_dict(self):
+        return {'device_id': self.device_id, 'version': self.version,
+                'kind': self.kind}
+
+    def __repr__(self):
+        return '<DeviceInfo %i %s %r>' % (self.device_id, self.kind,
+                                          self.version)
+
+
+class Scanner(object):
+    """
+    Finds the devices on the bus of a SerialQueue. The queue's worker is
+    held during the scan, so the queue must be local (not a RemoteQueue).
+
+    Arguments:
+    queue -- SerialQueue
+    timeout -- read timeout in seconds while scanning
+    """
+    def __init__(self, queue, timeout = .03):
+        self.queue = queue
+        self.timeout = timeout
+
+    def probe(self, device_id):
+        """
+        Select a device once and read its version
+
+        Returns:
+        version string, None if no device answered
+        """
+        queue = self.queue
+        device_byte = gcommands.select_byte(device_id)
+        queue.send(device_byte)
+        if queue.get_byte() != device_byte:
+            return None
+        queue.connected_device = device_id
+        try:
+            version = queue.send_immediate_instruction('%',
+                                                       parent='[scan]')
+        except gexceptions.ResponseSizeError:
+            version = None
+        queue.disconnect()
+        return version
+
+    def scan(self, device_ids = DEVICE_IDS):
+        """
+        Scan device ids
+
+        Returns:
+        list of DeviceInfo, ordered by device id
+        """
+        queue = self.queue
+        port = queue.device
+        timeout = getattr(port, 'timeout', None)
+        # Hold the worker as register_device() does
+        queue.event_buffer_lock.clear()
+        queue.event_lock.wait()
+        try:
+            if timeout is not None:
+                port.timeout = self.timeout
+            queue.disconnect()
+            found = []
+            for device_id in device_ids:
+                version = self.probe(device_id)
+                if version is not None:
+                    found.append(DeviceInfo(device_id, version))
+        finally:
+            if timeout is not None:
+                port.timeout = timeout
+            queue.event_buffer_lock.set()
+        queue.log.info('Found %i devices: %s' % (len(found), ', '.join(
+                       '%i (%s)' % (info.device_id, info.version)
+                       for info in found)))
+        return found
+
+
+def scan_ports(queues, **options):
+    """
+    Scan the buses of several serial ports at once
+
+    Arguments:
+    queues -- dict of name: SerialQueue
+    options -- passed to Scanner
+
+    Returns:
+    dict of name: list of DeviceInfo
+    """
+    results = {}
+    threads = []
+
+    def scan(name, queue):
+        results[name] = Scanner(queue, **options).scan()
+    for name, queue in queues.items():
+        thread = threading.Thread(target=scan, args=(name, queue))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def configure(quadz, devices):
+    """
+    Set up a QuadZDevice from a scan: the first Quad-Z is the liquid
+    handler and the 402 pumps are assigned to probes 1 and 2, 3 and 4 in
+    the order of their ids
+
+    Arguments:
+    quadz -- QuadZDevice
+    devices -- list of DeviceInfo
+
+    Returns:
+    dict of device id: (left probe, right probe) for the pumps
+    """
+    handlers = [info for info in devices if info.kind == QUADZ]
+    if not handlers:
+        raise gexceptions.DeviceNotFound('No Quad-Z on the bus')
+    quadz.initialize_device(handlers[0].device_id)
+    pumps = {}
+    probe = 1
+    for info in devices:
+        if info.kind != PUMP_402 or probe > 4:
+            continue
+        quadz.add_402_syringe_pump(info.device_id, probe, probe + 1)
+        pumps[info.device_id] = (probe, probe + 1)
+        probe += 2
+    return pumps
+
+
+def discover(quadz, **options):
+    """
+    Scan the bus of a QuadZDevice and configure it
+
+    Arguments:
+    quadz -- QuadZDevice whose queue is a SerialQueue
+    options -- passed to Scanner
+
+    Returns:
+    list of DeviceInfo
+    """
+    devices = Scanner(quadz.queue, **options).scan()
+    configure(quadz, devices)
+    return devices
@@ -0,0 +1,463 @@
+"""
+GSIOC bus emulator for running stations without hardware.
+
+Bus is a serial port replacement that answers GSIOC traffic the way a Quad-Z
+215 and 402 syringe pumps do: device selection, immediate commands answered
+one character per ACK and buffered commands echoed character by character.
+Gantry and probe moves and syringe strokes take time, so polling code sees
+the instrument move.
+
+Example:
+    bus = Bus.station()
+    quadz = QuadZDevice(device=bus)
+    quadz.initialize_device(22)
+
+or, with the pumps registered and the syringes set up:
+    quadz = emulated_station()
+
+With a clock.VirtualClock the moves and strokes take virtual time, so long
+protocols run in seconds:
+    quadz = emulated_station(clock=VirtualClock())
+"""
+import threading
+from collections import deque
+from clock import SYSTEM as SYSTEM_CLOCK
+
+ACK = chr(0x06)
+LF = chr(0x0A)
+CR = chr(0x0D)
+
+
+def interpolate(start, end, t0, t1, now):
+    """
+    Position between start and end of a move from t0 to t1
+    """
+    if now >= t1 or t1 <= t0:
+        return end
+    return start + (end - start) * (now - t0) / (t1 - t0)
+
+
+class EmulatedDevice(object):
+    """
+    Base class of emulated GSIOC devices
+
+    Arguments:
+    version -- response to the '%' command
+    time_scale -- factor applied to all move and stroke durations
+    clock -- time source, by default the system clock
+    """
+    def __init__(self, version, time_scale = 1.0, clock = None):
+        self.version = version
+        self.time_scale = time_scale
+        self.clock = clock or SYSTEM_CLOCK
+        # Last buffered commands received
+        self.commands = deque(maxlen=1000)
+
+    def immediate(self, command):
+        """
+        Get the response to an immediate command
+        """
+        if command == '%':
+            return self.version
+        if command == '$':
+            self.reset()
+            return '$'
+        return self.respond(command)
+
+    def buffered(self, body):
+        self.commands.append(body)
+        self.execute(body)
+
+    def reset(self):
+        pass
+
+    def respond(self, command):
+        return '?'
+
+    def execute(self, body):
+        pass
+
+
+class EmulatedQuadZ(EmulatedDevice):
+    """
+    Quad-Z 215 liquid handler
+
+    Arguments:
+    xy_speed -- gantry speed in tenths of millimeters per second
+    z_speed -- probe speed in tenths of millimeters per second
+    """
+    def __init__(self, version = 'Quad-Z 215 v2.10', time_scale = 1.0,
+                 xy_speed = 3000, z_speed = 1250, clock = None):
+        EmulatedDevice.__init__(self, version, time_scale, clock)
+        self.xy_speed = xy_speed
+        self.z_speed = z_speed
+        self.x_range = (0, 3000)
+        self.y_range = (0, 3500)
+        self.z_range = (0, 2000)
+        self.probe_x_ranges = [(0, 2460), (90, 2550), (180, 2640),
+                               (270, 2730)]
+        self.reset()
+
+    def reset(self):
+        self.width = 90
+        now = self.clock.time()
+        # Gantry move: (x0, y0, x1, y1, t0, t1), x is the probe 1 position
+        self.xy = (0, 0, 0, 0, now, now)
+        # Probe moves: (z0, z1, t0, t1) per probe
+        self.z = [(2000, 2000, now, now) for i in range(4)]
+        self.z_targets = [None] * 4
+        self.sensitivity = [5, 5, 5, 5]
+        self.speed = [125, 125, 125, 125]
+        self.range_line = {'q': 0, 'Q': 0}
+        self.error = 0
+
+    def position(self):
+        x0, y0, x1, y1, t0, t1 = self.xy
+        now = self.clock.time()
+        return (int(round(interpolate(x0, x1, t0, t1, now))),
+                int(round(interpolate(y0, y1, t0, t1, now))))
+
+    def heights(self):
+        now = self.clock.time()
+        return [int(round(interpolate(z0, z1, t0, t1, now)))
+                for z0, z1, t0, t1 in self.z]
+
+    def moving(self):
+        now = self.clock.time()
+        return now < self.xy[5] or any(now < move[3] for move in self.z)
+
+    def respond(self, command):
+        x, y = self.position()
+        if command == 'P':
+            return '%i/%i' % (x, y)
+        if command == 'X':
+            return ','.join(str(x + probe * self.width) for probe in range(4))
+        if command == 'Y':
+            return str(y)
+        if command == 'Z' or command == 'T':
+            return ','.join(map(str, self.heights()))
+        if command == 'w':
+            return str(self.width)
+        if command == 'S':
+            return '|'
+        if command == 'K':
+            return ','.join(map(str, self.sensitivity))
+        if command == 'O':
+            return ','.join(map(str, self.speed))
+        if command == 'N':
+            return 'PPPP'
+        if command == 'A':
+            return '0/0'
+        if command == 'e':
+            return str(self.error)
+        if command == 'R':
+            return ' '
+        if command in 'xy':
+            return 'P'
+        if command == 'z':
+            return 'PPPP'
+        if command == 'm':
+            status = 'R' if self.moving() else 'P'
+            return status * 6 + 'U'
+        if command == 'M':
+            status = 'R' if self.moving() else 'P'
+            return status * 3 + 'U'
+        if command == 'q':
+            line = self.range_line['q']
+            self.range_line['q'] = (line + 1) % 4
+            low, high = self.probe_x_ranges[line]
+            return '%s=%i/%i' % ('abcd'[line], low, high)
+        if command == 'Q':
+            line = self.range_line['Q']
+            self.range_line['Q'] = (line + 1) % 3
+            low, high = (self.x_range, self.y_range, self.z_range)[line]
+            return '%s=%i/%i' % ('XYZ'[line], low, high)
+        return '?'
+
+    def move_xy(self, x, y):
+        x0, y0 = self.position()
+        now = self.clock.time()
+        seconds = max(abs(x - x0), abs(y - y0)) / float(self.xy_speed)
+        self.xy = (x0, y0, x, y, now, now + seconds * self.time_scale)
+
+    def move_z(self, probe, z):
+        heights = self.heights()
+        now = self.clock.time()
+        seconds = abs(z - heights[probe]) / float(self.z_speed)
+        self.z[probe] = (heights[probe], z, now,
+                         now + seconds * self.time_scale)
+
+    def execute(self, body):
+        command = body[:2]
+        if command == 'SX':
+            probe = 'abcd'.index(body[2])
+            x, y = body[3:].split('/')
+            self.move_xy(int(x) - probe * self.width, int(y))
+        elif command == 'SY':
+            self.move_xy(self.position()[0], int(body[2:]))
+        elif command == 'ST':
+            for probe, value in enumerate(body[2:].split(',')):
+                if value:
+                    self.z_targets[probe] = int(value)
+        elif command in ('SM', 'Sm'):
+            for probe, z in enumerate(self.z_targets):
+                if z is not None:
+                    self.move_z(probe, z)
+            self.z_targets = [None] * 4
+        elif command in ('SZ', 'Sz'):
+            self.move_z('abcd'.index(body[2]), int(body[3:]))
+        elif command == 'Sw':
+            self.width = int(body[2:])
+        elif command == 'SK':
+            self.sensitivity['abcd'.index(body[2])] = int(body[3:])
+        elif command == 'SH':
+            self.move_xy(0, 0)
+            for probe in range(4):
+                self.move_z(probe, self.z_range[1])
+        elif command == 'Se':
+            self.error = 0
+
+
+class EmulatedPump(EmulatedDevice):
+    """
+    402 dual syringe pump
+
+    Arguments:
+    init_time -- seconds an initialization takes
+    """
+    def __init__(self, version = '402 v1.20', time_scale = 1.0,
+                 init_time = 1.0, clock = None):
+        EmulatedDevice.__init__(self, version, time_scale, clock)
+        self.init_time = init_time
+        self.reset()
+
+    def reset(self):
+        self.volume = {'L': 0.0, 'R': 0.0}
+        self.pending = {'L': 0.0, 'R': 0.0}
+        self.valve = {'L': 'N', 'R': 'N'}
+        self.flow_rate = {'L': 10.0, 'R': 10.0}
+        self.size = {'L': 250, 'R': 250}
+        # Running stroke: (start volume, end volume, t0, t1, status)
+        self.stroke = {'L': None, 'R': None}
+
+    def update(self, side):
+        """
+        Finish the stroke of a syringe if its time is up
+
+        Returns:
+        status letter and current volume
+        """
+        stroke = self.stroke[side]
+        if stroke is None:
+            return 'H', self.volume[side]
+        v0, v1, t0, t1, status = stroke
+        now = self.clock.time()
+        if now >= t1:
+            self.volume[side] = v1
+            self.stroke[side] = None
+            return 'H', v1
+        return status, interpolate(v0, v1, t0, t1, now)
+
+    def respond(self, command):
+        if command == 'M':
+            response = ''
+            for side in 'LR':
+                status, volume = self.update(side)
+                response += '%s%.1f' % (status, volume)
+            return response
+        if command == 'S':
+            return '00'
+        if command == 'V':
+            return self.valve['L'] + self.valve['R']
+        return '?'
+
+    def sides(self, letter):
+        return 'LR' if letter == 'B' else letter
+
+    def execute(self, body):
+        command = body[0]
+        if command == 'A':
+            self.pending[body[1]] = float(body[2:])
+        elif command == 'D':
+            self.pending[body[1]] = -float(body[2:])
+        elif command == 'B':
+            now = self.clock.time()
+            for side in self.sides(body[1]):
+                volume = self.pending[side]
+                if not volume or self.update(side)[0] != 'H':
+                    continue
+                self.pending[side] = 0.0
+                seconds = abs(volume) * .06 / self.flow_rate[side]
+                start = self.volume[side]
+                end = min(max(start + volume, 0.0), self.size[side])
+                self.stroke[side] = (start, end, now,
+                                     now + seconds * self.time_scale, 'R')
+        elif command == 'V':
+            self.valve[body[1]] = body[2]
+        elif command == 'S':
+            self.flow_rate[body[1]] = float(body[2:])
+        elif command == 'P':
+            for side in self.sides(body[1]):
+                self.size[side] = int(body[2:])
+        elif command == 'O':
+            now = self.clock.time()
+            for side in self.sides(body[1]):
+                self.pending[side] = 0.0
+                self.stroke[side] = (self.volume[side], 0.0, now,
+                                     now + self.init_time * self.time_scale,
+                                     'I')
+        elif command == 'N':
+            for side in self.sides(body[1]):
+                status, volume = self.update(side)
+                self.volume[side] = volume
+                self.stroke[side] = None
+
+
+class Bus(object):
+    """
+    Serial port replacement connecting emulated devices
+
+    Like the Gilson computer, the bus can be made to drop commands that
+    follow the previous one too closely: an immediate command sent less
+    than min_command_gap seconds after the last response is not answered,
+    and a device selected less than min_switch_gap seconds after a
+    disconnect does not echo. The buffer status poll right after a
+    buffered command is always answered.
+
+    Arguments:
+    devices -- dict of device id: EmulatedDevice
+    timeout -- read timeout, kept for compatibility with serial.Serial
+    clock -- time source for the gaps
+    """
+    def __init__(self, devices = None, timeout = 1, clock = None,
+                 min_command_gap = 0, min_switch_gap = 0):
+        self.devices = devices or {}
+        self.timeout = timeout
+        self.clock = clock or SYSTEM_CLOCK
+        self.min_command_gap = min_command_gap
+        self.min_switch_gap = min_switch_gap
+        self.last_response = None
+        self.last_disconnect = None
+        self.selected = None
+        self.output = []
+        self.response = ''
+        self.command = None
+        self.lock = threading.Lock()
+        # When offline the bus neither answers nor echoes, like a station
+        # that was switched off or unplugged
+        self.offline = False
+
+    @classmethod
+    def station(cls, quadz_id = 22, pump_ids = (0, 1), time_scale = 1.0,
+                clock = None):
+        """
+        Create a bus with a Quad-Z and 402 syringe pumps
+        """
+        devices = {quadz_id: EmulatedQuadZ(time_scale=time_scale,
+                                           clock=clock)}
+        for device_id in pump_ids:
+            devices[device_id] = EmulatedPump(time_scale=time_scale,
+                                              clock=clock)
+        return cls(devices, clock=clock)
+
+    def write(self, data):
+        with self.lock:
+            if self.offline:
+                return len(data)
+            for char in data:
+                self.receive(char)
+        return len(data)
+
+    def too_soon(self, last, gap):
+        return gap and last is not None and \
+               self.clock.time() - last < gap
+
+    def receive(self, char):
+        code = ord(char)
+        if code == 255:
+            self.selected = None
+            self.command = None
+            self.last_disconnect = self.clock.time()
+            return
+        if code >= 128:
+            if self.too_soon(self.last_disconnect, self.min_switch_gap):
+                self.selected = None
+            elif code - 128 in self.devices:
+                self.selected = self.devices[code - 128]
+                self.output.append(char)
+            else:
+                self.selected = None
+            return
+        device = self.selected
+        if device is None:
+            return
+        if char == LF:
+            self.command = ''
+            self.output.append(char)
+            return
+        if self.command is not None:
+            self.output.append(char)
+            if char == CR:
+                device.buffered(self.command)
+                self.command = None
+                # The buffer status is polled right after a command
+                self.last_response = None
+            else:
+                self.command += char
+            return
+        if char == ACK:
+            self.response = self.response[1:]
+        elif self.too_soon(self.last_response, self.min_command_gap):
+            self.response = ''
+        else:
+            self.response = device.immediate(char)
+        if len(self.response) == 1:
+            self.output.append(chr(ord(self.response) + 128))
+            self.last_response = self.clock.time()
+        elif self.response:
+            self.output.append(self.response[0])
+
+    def read(self, size = 1):
+        with self.lock:
+            if self.offline or not self.output:
+                return ''
+            data = ''.join(self.output[:size])
+            del self.output[:size]
+            return data
+
+    def reset_input_buffer(self):
+        """
+        Discard unread output and the rest of a pending response
+        """
+        with self.lock:
+            del self.output[:]
+            self.response = ''
+
+    def close(self):
+        pass
+
+
+def emulated_station(quadz_id = 22, pump_ids = (0, 1), syringe_size = 250,
+                     time_scale = 1.0, bus = None, clock = None):
+    """
+    Create a QuadZDevice on an emulated bus with the 402 pumps registered to
+    probes 1-4 and the syringe sizes set
+
+    Arguments:
+    clock -- time source of the devices and the QuadZDevice, e.g. a
+             clock.VirtualClock
+
+    Returns:
+    QuadZDevice, the bus is quadz.device
+    """
+    from quadz import QuadZDevice
+    if bus is None:
+        bus = Bus.station(quadz_id, pump_ids, time_scale, clock)
+    quadz = QuadZDevice(device=bus, clock=clock)
+    quadz.initialize_device(quadz_id)
+    probe = 1
+    for device_id in pump_ids:
+        quadz.add_402_syringe_pump(device_id, probe, probe + 1)
+        quadz.set_syringe_size(probe, syringe_size, both=True)
+        probe += 2
+    return quadz
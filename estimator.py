@@ -0,0 +1,349 @@
+"""
+Runtime estimates for protocols from a simulated run.
+
+estimate() runs a protocol against an emulated station on a
+clock.VirtualClock and records when each resource is in use:
+    'gantry' -- move_to() calls
+    'z1' - 'z4' -- move_probe() calls, per probe
+    'syringe1' - 'syringe4' -- syringe strokes, from start to stop
+    'valve1' - 'valve4' -- set_valve_status() calls
+    'bus' -- GSIOC traffic at 19200 baud
+The resulting Timeline has the predicted total runtime, the busy time of
+each resource and every span, and can be saved as JSON or as a static HTML
+page with an SVG Gantt chart. Protocol variants (probe grouping, aliquoting,
+refill strategy) can be compared before booking instrument time.
+
+Example:
+    timeline = estimate_worklist(read_worklist('transfers.csv'), index)
+    print timeline.report()['total']
+    timeline.save_html('transfers.html')
+
+    def aliquots(quadz):
+        planner = AliquotPlanner(quadz)
+        planner.run(1, planner.plan(1, dispenses))
+    print compare({'aliquots': aliquots, 'single': single})
+"""
+import cgi
+import json
+import emulator
+import worklist
+from clock import VirtualClock
+from scheduler import GANTRY, PROBES, z, syringe, valve
+
+BUS = 'bus'
+
+# 8 data bits, even parity, start and stop bit at 19200 baud
+BYTE_TIME = 11 / 19200.0
+
+COLORS = {'gantry': '#4e79a7',
+          'z': '#59a14f',
+          'syringe': '#f28e2b',
+          'valve': '#b07aa1',
+          'bus': '#9c9c9c'}
+
+
+class Span(object):
+    __slots__ = ('resource', 'start', 'end', 'label')
+
+    def __init__(self, resource, start, end, label = ''):
+        self.resource = resource
+        self.start = start
+        self.end = end
+        self.label = label
+
+    def __repr__(self):
+        return '<Span %s %.2f-%.2f %s>' % (self.resource, self.start,
+                                           self.end, self.label)
+
+
+def busy_time(spans):
+    """
+    Get the time covered by spans, overlapping spans are counted once
+    """
+    total = 0.0
+    end = None
+    for span in sorted(spans, key=lambda span: span.start):
+        if end is None or span.start > end:
+            total += span.end - span.start
+            end = span.end
+        elif span.end > end:
+            total += span.end - end
+            end = span.end
+    return total
+
+
+class Timeline(object):
+    """
+    Resource use over the course of a run, times in seconds from its start
+
+    Arguments:
+    clock -- clock the run is timed with
+    """
+    def __init__(self, clock):
+        self.clock = clock
+        self.origin = clock.time()
+        self.total = 0.0
+        self.spans = []
+
+    def begin(self):
+        self.origin = self.clock.time()
+        del self.spans[:]
+
+    def finish(self):
+        self.total = self.now()
+
+    def now(self):
+        return self.clock.time() - self.origin
+
+    def add(self, resource, start, end, label = ''):
+        self.spans.append(Span(resource, start, end, label))
+
+    def resources(self):
+        """
+        Get the resources used, in the order of the chart rows
+        """
+        order = [GANTRY] + [function(probe)
+                            for function in (z, syringe, valve)
+                            for probe in PROBES] + [BUS]
+        used = set(span.resource for span in self.spans)
+        return [resource for resource in order if resource in used] + \
+               sorted(used.difference(order))
+
+    def report(self):
+        """
+        Returns:
+        dict with the total runtime and the busy seconds, utilization and
+        span count of each resource
+        """
+        resources = {}
+        for resource in self.resources():
+            spans = [span for span in self.spans
+                     if span.resource == resource]
+            busy = busy_time(spans)
+            resources[resource] = {
+                'busy': busy,
+                'utilization': busy / self.total if self.total > 0 else 0.0,
+                'spans': len(spans)}
+        return {'total': self.total, 'resources': resources}
+
+    def to_dict(self):
+        report = self.report()
+        report['spans'] = [{'resource': span.resource, 'start': span.start,
+                            'end': span.end, 'label': span.label}
+                           for span in sorted(self.spans,
+                                              key=lambda span: span.start)]
+        return report
+
+    def save_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1, sort_keys=True)
+
+    def svg(self, width = 1000, row_height = 22, label_width = 80):
+        """
+        Get an SVG Gantt chart with one row per resource
+        """
+        resources = self.resources()
+        total = self.total or max([span.end for span in self.spans] or [1.0])
+        scale = (width - label_width) / total
+        height = (len(resources) + 1) * row_height
+        lines = ['<svg xmlns="http://www.w3.org/2000/svg" width="%i" '
+                 'height="%i" font-family="sans-serif" font-size="11">' %
+                 (width, height)]
+        # Time axis with about 10 ticks
+        step = 10 ** len(str(int(total / 10))) / 10.0 or 1.0
+        while total / step > 10:
+            step *= 2
+        tick = 0.0
+        while tick <= total:
+            x = label_width + tick * scale
+            lines.append('<line x1="%.1f" y1="0" x2="%.1f" y2="%i" '
+                         'stroke="#ddd"/>' % (x, x, height - row_height))
+            lines.append('<text x="%.1f" y="%i">%gs</text>' %
+                         (x + 2, height - 6, tick))
+            tick += step
+        for row, resource in enumerate(resources):
+            y = row * row_height
+            color = COLORS.get(resource.rstrip('1234'), '#76b7b2')
+            lines.append('<text x="4" y="%i">%s</text>' %
+                         (y + row_height - 7, cgi.escape(resource)))
+            for span in self.spans:
+                if span.resource != resource:
+                    continue
+                lines.append('<rect x="%.2f" y="%i" width="%.2f" '
+                             'height="%i" fill="%s"><title>%s %.2f-%.2fs'
+                             '</title></rect>' %
+                             (label_width + span.start * scale, y + 3,
+                              max((span.end - span.start) * scale, .5),
+                              row_height - 6, color,
+                              cgi.escape(span.label), span.start, span.end))
+        lines.append('</svg>')
+        return '\n'.join(lines)
+
+    def save_html(self, path, title = 'Protocol timeline'):
+        report = self.report()['resources']
+        rows = ''.join('<tr><td>%s</td><td>%.1f s</td><td>%.0f%%</td></tr>' %
+                       (resource, report[resource]['busy'],
+                        100 * report[resource]['utilization'])
+                       for resource in self.resources())
+        with open(path, 'w') as f:
+            f.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+                    '<title>%s</title></head><body>\n<h1>%s</h1>\n'
+                    '<p>Predicted runtime: %.1f s</p>\n%s\n'
+                    '<table><tr><th>Resource</th><th>Busy</th>'
+                    '<th>Utilization</th></tr>%s</table>\n</body></html>\n' %
+                    (cgi.escape(title), cgi.escape(title), self.total,
+                     self.svg(), rows))
+
+
+class BusRecorder(object):
+    """
+    Serial port wrapper that charges the clock for every byte on the bus
+    and records the traffic as 'bus' spans
+    """
+    def __init__(self, bus, clock, byte_time = BYTE_TIME):
+        self.bus = bus
+        self.clock = clock
+        self.byte_time = byte_time
+        self.timeline = None
+
+    def transfer(self, size):
+        start = self.clock.time()
+        self.clock.advance(size * self.byte_time)
+        timeline = self.timeline
+        if timeline is None:
+            return
+        start -= timeline.origin
+        end = timeline.now()
+        # Bytes of one transaction follow each other, join them
+        last = timeline.spans and timeline.spans[-1]
+        if last and last.resource == BUS and start - last.end < \
+           2 * self.byte_time:
+            last.end = end
+        else:
+            timeline.add(BUS, start, end)
+
+    def write(self, data):
+        count = self.bus.write(data)
+        self.transfer(len(data))
+        return count
+
+    def read(self, size = 1):
+        data = self.bus.read(size)
+        self.transfer(len(data))
+        return data
+
+    def close(self):
+        self.bus.close()
+
+    def __getattr__(self, name):
+        return getattr(self.bus, name)
+
+
+def record(quadz, timeline):
+    """
+    Record the resource use of a QuadZDevice's calls in a timeline
+    """
+    def timed(function, resources, label):
+        def call(*args, **kwargs):
+            start = timeline.now()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                end = timeline.now()
+                for resource in resources(*args, **kwargs):
+                    timeline.add(resource, start, end, label)
+        return call
+
+    quadz.move_to = timed(quadz.move_to,
+                          lambda *args, **kwargs: [GANTRY], 'move_to')
+    quadz.move_probe = timed(quadz.move_probe,
+                             lambda z_position, probes = [1], *args,
+                                    **kwargs: map(z, probes), 'move_probe')
+    quadz.set_valve_status = timed(quadz.set_valve_status,
+                                   lambda probe, *args, **kwargs:
+                                   [valve(probe)], 'set_valve_status')
+
+    timer = quadz.stroke_timer
+    stroke = timer.record
+
+    def record_stroke(probe, predicted, actual):
+        end = timeline.now()
+        timeline.add(syringe(probe), max(end - actual, 0.0), end, 'stroke')
+        stroke(probe, predicted, actual)
+    timer.record = record_stroke
+
+
+def emulated(quadz_id = 22, pump_ids = (0, 1), syringe_size = 250,
+             flow_rate = None, byte_time = BYTE_TIME):
+    """
+    Create an emulated station on a virtual clock with a timeline recording
+    its resource use
+
+    Returns:
+    (QuadZDevice, Timeline)
+    """
+    clock = VirtualClock()
+    bus = BusRecorder(emulator.Bus.station(quadz_id, pump_ids, clock=clock),
+                      clock, byte_time)
+    quadz = emulator.emulated_station(quadz_id, pump_ids, syringe_size,
+                                      bus=bus, clock=clock)
+    if flow_rate is not None:
+        for probe in range(1, 2 * len(pump_ids) + 1):
+            quadz.set_syringe_flow_rate(probe, flow_rate)
+    timeline = Timeline(clock)
+    bus.timeline = timeline
+    record(quadz, timeline)
+    return quadz, timeline
+
+
+def estimate(protocol, **station):
+    """
+    Run a protocol on an emulated station and time it
+
+    Arguments:
+    protocol -- function called with the QuadZDevice
+    station -- options of emulated()
+
+    Returns:
+    Timeline
+    """
+    quadz, timeline = emulated(**station)
+    timeline.begin()
+    protocol(quadz)
+    timeline.finish()
+    return timeline
+
+
+def estimate_worklist(transfers, index, station = None, **options):
+    """
+    Estimate the runtime of a worklist
+
+    Arguments:
+    transfers -- iterable of worklist.Transfer
+    index -- labware.WellIndex of the deck
+    station -- dict of emulated() options
+    options -- passed to worklist.WorklistRunner
+
+    Returns:
+    Timeline
+    """
+    options.setdefault('progress', lambda stats: None)
+
+    def protocol(quadz):
+        worklist.WorklistRunner(quadz, index, **options).run(transfers)
+    return estimate(protocol, **(station or {}))
+
+
+def compare(protocols, **station):
+    """
+    Estimate several protocol variants
+
+    Arguments:
+    protocols -- dict of name: protocol function
+    station -- options of emulated()
+
+    Returns:
+    dict of name: Timeline.report()
+    """
+    return dict((name, estimate(protocol, **station).report())
+                for name, protocol in protocols.items())
@@ -0,0 +1,290 @@
+"""
+Orchestrator for several Quad-Z stations in one process.
+
+Each station is a QuadZDevice (with its own SerialQueue and serial port) and
+a deck with the same layout. Fleet shards a worklist across the stations by
+estimated completion time, runs every station in its own thread and moves
+work between stations: an idle station takes transfers from the station
+that would finish last, and the transfers of a station that fails are
+handed to the remaining stations. A transfer that was interrupted by a
+failure is run again from the start on another station.
+
+Stations can be emulated for local testing:
+    fleet = Fleet()
+    for i in range(4):
+        fleet.add_station('station %i' % (i), emulator.emulated_station(),
+                          index)
+    fleet.run(worklist.read_worklist('transfers.csv'))
+    print fleet.report()
+
+Stations are timed with the clock of their QuadZDevice. To simulate a
+fleet on a clock.VirtualClock give each station its own clock, e.g.
+emulator.emulated_station(clock=VirtualClock()): the elapsed time of a run
+is that of the station that took longest. Stations sharing one
+VirtualClock are not simulated, see clock.py.
+"""
+import threading
+from collections import deque
+import gexceptions
+import worklist
+from clock import VirtualClock
+
+
+class Station(object):
+    """
+    One liquid handler in the fleet
+
+    Arguments:
+    name -- station name used in reports
+    quadz -- QuadZDevice with the syringe pumps set up
+    index -- labware.WellIndex of the station deck
+    seconds_per_transfer -- initial estimate of the time per transfer,
+                            replaced by measurements as the station runs
+    options -- passed to worklist.WorklistRunner
+    """
+    def __init__(self, name, quadz, index, seconds_per_transfer = 10.0,
+                 **options):
+        self.name = name
+        self.quadz = quadz
+        options.setdefault('progress', lambda stats: None)
+        self.runner = worklist.WorklistRunner(quadz, index, **options)
+        self.seconds_per_transfer = seconds_per_transfer
+        self.backlog = deque()
+        # 'idle', 'running' or 'failed'
+        self.state = 'idle'
+        self.error = None
+        self.current = None
+        self.started = None
+        self.transfers = 0
+        self.volume = 0.0
+        self.busy = 0.0
+
+    def estimate(self):
+        """
+        Get the estimated seconds until the station has finished its work
+        """
+        remaining = len(self.backlog) * self.seconds_per_transfer
+        if self.current is not None:
+            remaining += max(0.0, self.seconds_per_transfer -
+                                  (self.quadz.clock.time() - self.started))
+        return remaining
+
+    def __repr__(self):
+        return '<Station %s %s, %i queued>' % (self.name, self.state,
+                                                len(self.backlog))
+
+
+class Fleet(object):
+    """
+    Runs worklists on several stations
+
+    Arguments:
+    smoothing -- weight of the newest transfer time in each station's
+                 moving average
+    log -- logger for station failures, by default the log of the first
+           station's queue
+    """
+    def __init__(self, smoothing = .3, log = None):
+        self.stations = []
+        self.smoothing = smoothing
+        self.log = log
+        self.condition = threading.Condition()
+        self.unfinished = []
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {'elapsed': 0.0,
+                      'stolen': 0,
+                      'rebalanced': 0,
+                      'failures': 0}
+
+    def add_station(self, name, quadz, index, seconds_per_transfer = 10.0,
+                    **options):
+        """
+        Add a station, see Station
+
+        Returns:
+        Station
+        """
+        station = Station(name, quadz, index, seconds_per_transfer,
+                          **options)
+        if self.log is None:
+            self.log = quadz.queue.log
+        if isinstance(quadz.clock, VirtualClock) and \
+           any(other.quadz.clock is quadz.clock for other in self.stations):
+            self.log.warning('Station %s shares a VirtualClock with another '
+                             'station, the fleet timing will be wrong' %
+                             (name))
+        self.stations.append(station)
+        return station
+
+    def live(self):
+        return [station for station in self.stations
+                if station.state != 'failed']
+
+    def assign(self, transfers):
+        """
+        Give each transfer to the station that would finish it first
+        """
+        stations = self.live()
+        if not stations:
+            self.unfinished.extend(transfers)
+            return
+        for transfer in transfers:
+            station = min(stations, key=lambda station: station.estimate() +
+                                                 station.seconds_per_transfer)
+            station.backlog.append(transfer)
+
+    def run(self, transfers):
+        """
+        Run transfers on all stations and wait until they are done
+
+        Arguments:
+        transfers -- iterable of worklist.Transfer
+
+        Returns:
+        report(), raises FleetError if every station failed before the
+        transfers were done
+        """
+        self.unfinished = []
+        clocks = []
+        for station in self.stations:
+            if station.quadz.clock not in clocks:
+                clocks.append(station.quadz.clock)
+        started = [clock.time() for clock in clocks]
+        with self.condition:
+            self.assign(list(transfers))
+        threads = [self.start(station) for station in self.live()]
+        for thread in threads:
+            thread.join()
+        self.stats['elapsed'] += max([clock.time() - start for clock, start
+                                      in zip(clocks, started)] or [0.0])
+        if self.unfinished:
+            raise gexceptions.FleetError('All stations failed, %i transfers '
+                                         'were not run' %
+                                         (len(self.unfinished)))
+        return self.report()
+
+    def start(self, station):
+        """
+        Run work() for a station in a new thread, an actor of the station's
+        clock
+
+        Returns:
+        threading.Thread
+        """
+        thread = threading.Thread(target=self.work, args=(station,),
+                                  name=station.name)
+        thread.daemon = True
+        station.quadz.clock.add_actor(thread)
+        thread.start()
+        return thread
+
+    def work(self, station):
+        """
+        Run a station's backlog, taking work from other stations when it is
+        empty
+        """
+        while True:
+            with self.condition:
+                if not station.backlog:
+                    self.steal(station)
+                if not station.backlog:
+                    station.state = 'idle'
+                    return
+                station.state = 'running'
+                transfer = station.backlog.popleft()
+                station.current = transfer
+                station.started = station.quadz.clock.time()
+            try:
+                station.runner.run([transfer])
+            except Exception, e:
+                self.fail(station, e)
+                return
+            seconds = station.quadz.clock.time() - station.started
+            with self.condition:
+                station.current = None
+                station.transfers += 1
+                station.volume += transfer.volume
+                station.busy += seconds
+                if station.transfers == 1:
+                    station.seconds_per_transfer = seconds
+                else:
+                    station.seconds_per_transfer += self.smoothing * \
+                        (seconds - station.seconds_per_transfer)
+
+    def steal(self, station):
+        """
+        Move queued transfers from the station expected to finish last to
+        an idle station, as long as each move makes the work finish earlier
+        """
+        others = [other for other in self.live()
+                  if other is not station and other.backlog]
+        if not others:
+            return
+        victim = max(others, key=lambda other: other.estimate())
+        while victim.backlog and station.estimate() + \
+              station.seconds_per_transfer < victim.estimate():
+            station.backlog.appendleft(victim.backlog.pop())
+            self.stats['stolen'] += 1
+
+    def fail(self, station, error):
+        """
+        Take a station out of the fleet and hand its work to the others
+        """
+        with self.condition:
+            station.state = 'failed'
+            station.error = error
+            orphans = []
+            if station.current is not None:
+                orphans.append(station.current)
+                station.current = None
+            orphans.extend(station.backlog)
+            station.backlog.clear()
+            self.stats['failures'] += 1
+            self.stats['rebalanced'] += len(orphans)
+            if self.log is not None:
+                self.log.error('Station %s failed (%s: %s), moving %i '
+                               'transfers to other stations' %
+                               (station.name, error.__class__.__name__,
+                                str(error), len(orphans)))
+            self.assign(orphans)
+            idle = [other for other in self.live()
+                    if other.state == 'idle' and other.backlog]
+        # Stations that already finished need a new worker thread, run()
+        # waits for them by waiting for this one
+        threads = []
+        for other in idle:
+            other.state = 'running'
+            threads.append(self.start(other))
+        for thread in threads:
+            thread.join()
+
+    def report(self):
+        """
+        Aggregate throughput of the fleet
+
+        Returns:
+        dict with the fleet totals and a 'stations' dict of per station
+        counters
+        """
+        stats = dict(self.stats)
+        elapsed = stats['elapsed']
+        stats['transfers'] = sum(station.transfers
+                                 for station in self.stations)
+        stats['volume'] = sum(station.volume for station in self.stations)
+        stats['transfers_per_second'] = 0.0
+        if elapsed > 0:
+            stats['transfers_per_second'] = stats['transfers'] / elapsed
+        stats['stations'] = {}
+        for station in self.stations:
+            utilization = station.busy / elapsed if elapsed > 0 else 0.0
+            stats['stations'][station.name] = {
+                'state': station.state,
+                'transfers': station.transfers,
+                'volume': station.volume,
+                'seconds_per_transfer': station.seconds_per_transfer,
+                'utilization': utilization,
+                'error': None if station.error is None else
+                         str(station.error)}
+        return stats
@@ -0,0 +1,372 @@
+"""
+Declarative command tables for the Gilson GSIOC command sets.
+
+Every command the library sends is described once in a CommandSet: its
+template, the converters that validate and format its arguments and whether
+it is an immediate or a buffered command. Calling a command returns a Frame
+which holds the formatted command body as well as the exact characters that
+go over the wire, so a frame can be built once and sent many times.
+
+Example:
+    frame = QUADZ.set_probe_position(1, 100, 2000)
+    quadz.buffered(frame)
+
+Immediate commands carry the gresponses parser for their response format,
+QuadZDevice.immediate() applies it to the response.
+"""
+import gexceptions
+import gresponses as r
+
+LF = chr(0x0A)
+CR = chr(0x0D)
+
+# GSIOC device ids are 0-63, the device select byte is the id + 128
+SELECT_BYTES = [chr(i + 128) for i in range(64)]
+DISCONNECT = chr(255)
+
+# Maximum number of cached frames per command
+max_cached_frames = 512
+
+
+def select_byte(device_id):
+    """
+    Get the device select byte for a GSIOC device id
+
+    Arguments:
+    device_id -- device id (0-63)
+    """
+    try:
+        return SELECT_BYTES[device_id]
+    except (IndexError, TypeError):
+        raise gexceptions.CommandArgumentError(
+                            'Invalid GSIOC device id: %s' % (str(device_id)))
+
+
+################################
+####                        ####
+####  Argument Converters   ####
+####                        ####
+################################
+
+class Int(object):
+    """
+    Integer argument with optional bounds. If blank is True, '' and None are
+    passed through as an empty field (used by the four probe commands where
+    a blank field leaves the probe unchanged).
+    """
+    __slots__ = ('low', 'high', 'blank')
+
+    def __init__(self, low = None, high = None, blank = False):
+        self.low = low
+        self.high = high
+        self.blank = blank
+
+    def __call__(self, value):
+        if self.blank and (value == '' or value is None):
+            return ''
+        try:
+            number = int(value)
+        except (TypeError, ValueError):
+            raise ValueError('%r is not an integer' % (value,))
+        if self.low is not None and number < self.low:
+            raise ValueError('%i is below the minimum of %i' % (number,
+                                                                self.low))
+        if self.high is not None and number > self.high:
+            raise ValueError('%i is above the maximum of %i' % (number,
+                                                                self.high))
+        return str(number)
+
+
+class Number(object):
+    """
+    Positive number formatted with str() (e.g. flow rates)
+    """
+    __slots__ = ('low',)
+
+    def __init__(self, low = 0):
+        self.low = low
+
+    def __call__(self, value):
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            raise ValueError('%r is not a number' % (value,))
+        if number <= self.low:
+            raise ValueError('%s must be greater than %s' % (str(value),
+                                                             str(self.low)))
+        return str(value)
+
+
+class Volume(object):
+    """
+    Volume in microliters, always sent with a decimal point (e.g. 150.0)
+    """
+    __slots__ = ()
+
+    def __call__(self, value):
+        try:
+            volume = float(value)
+        except (TypeError, ValueError):
+            raise ValueError('%r is not a volume' % (value,))
+        if volume < 0:
+            raise ValueError('volume cannot be negative')
+        return str(volume)
+
+
+class Choice(object):
+    """
+    One of a fixed set of values, optionally mapped to the sent value
+    """
+    __slots__ = ('values',)
+
+    def __init__(self, values):
+        if not isinstance(values, dict):
+            values = dict((value, value) for value in values)
+        self.values = values
+
+    def __call__(self, value):
+        try:
+            return self.values[value]
+        except (KeyError, TypeError):
+            raise ValueError('%r is not one of %s' % (value,
+                                           ', '.join(map(str, self.values))))
+
+
+class Text(object):
+    """
+    Free text with a maximum length
+    """
+    __slots__ = ('max_length',)
+
+    def __init__(self, max_length):
+        self.max_length = max_length
+
+    def __call__(self, value):
+        value = str(value)
+        if len(value) > self.max_length:
+            raise ValueError('text is longer than %i characters' %
+                             (self.max_length))
+        return value
+
+
+PROBE = Choice({1: 'a', 2: 'b', 3: 'c', 4: 'd'})
+SYRINGE = Choice(['L', 'R'])
+SYRINGES = Choice(['L', 'R', 'B'])
+VALVE = Choice(['R', 'N'])
+BIT = Choice({0: '0', 1: '1', False: '0', True: '1'})
+
+
+################################
+####                        ####
+####    Commands & Frames   ####
+####                        ####
+################################
+
+class Frame(object):
+    """
+    A ready to send command. body is the command as the instrument documents
+    it, wire is what is written to the serial port (buffered commands are
+    wrapped in LF/CR).
+    """
+    __slots__ = ('command', 'body', 'wire')
+
+    def __init__(self, command, body):
+        self.command = command
+        self.body = body
+        if command.buffered:
+            self.wire = LF + body + CR
+        else:
+            self.wire = body
+
+    def parse(self, response):
+        """
+        Parse a response to this frame with the command's parser
+        """
+        if self.command.parser is None:
+            return response
+        return self.command.parser(response)
+
+    def __str__(self):
+        return self.body
+
+    def __repr__(self):
+        return '<Frame %s %r>' % (self.command.name, self.body)
+
+
+class Command(object):
+    """
+    Description of a single GSIOC command
+
+    Arguments:
+    name -- method style name of the command
+    template -- body template, one %s per argument
+    args -- list of (argument name, converter) tuples
+    buffered -- True for buffered commands, False for immediate commands
+    parser -- function that parses the response of an immediate command
+    """
+    __slots__ = ('name', 'template', 'args', 'buffered', 'parser', 'wait',
+                 'frames')
+
+    def __init__(self, name, template, args = (), buffered = False,
+                 parser = None):
+        self.name = name
+        self.template = template
+        self.args = tuple(args)
+        self.buffered = buffered
+        self.parser = parser
+        # Buffer semantics, set by the CommandSet the command belongs to
+        self.wait = None
+        self.frames = {}
+
+    def __call__(self, *values):
+        """
+        Validate arguments and return the Frame for this command
+        """
+        try:
+            return self.frames[values]
+        except (KeyError, TypeError):
+            pass
+        if len(values) != len(self.args):
+            raise gexceptions.CommandArgumentError(
+                        '%s() takes exactly %i arguments (%i given)' %
+                        (self.name, len(self.args), len(values)))
+        fields = []
+        for value, (arg_name, converter) in zip(values, self.args):
+            try:
+                fields.append(converter(value))
+            except ValueError, e:
+                raise gexceptions.CommandArgumentError(
+                                    '%s(): invalid %s: %s' %
+                                    (self.name, arg_name, str(e)))
+        if fields:
+            frame = Frame(self, self.template % tuple(fields))
+        else:
+            frame = Frame(self, self.template)
+        if len(self.frames) >= max_cached_frames:
+            self.frames.clear()
+        try:
+            self.frames[values] = frame
+        except TypeError:
+            # Frames for unhashable arguments are not cached
+            pass
+        return frame
+
+    def __repr__(self):
+        return '<Command %s %r>' % (self.name, self.template)
+
+
+class CommandSet(object):
+    """
+    Named collection of commands for one type of device. Commands are
+    available as attributes, e.g. QUADZ.home()
+
+    Arguments:
+    name -- device type name
+    wait -- buffer semantics of the buffered commands ("handler" or "pump"),
+            see SerialQueue.add_buffered_instruction()
+    commands -- list of Command objects
+    """
+    def __init__(self, name, wait, commands):
+        self.name = name
+        self.wait = wait
+        self.commands = {}
+        for command in commands:
+            if command.buffered:
+                command.wait = wait
+            self.commands[command.name] = command
+            setattr(self, command.name, command)
+
+    def __getitem__(self, name):
+        return self.commands[name]
+
+    def __iter__(self):
+        return iter(self.commands.values())
+
+
+# Gilson Quad-Z 215 liquid handler (Quad-Z 215 User Guide, GSIOC commands)
+QUADZ = CommandSet('quadz', 'handler', [
+    # Immediate commands
+    Command('get_version', '%'),
+    Command('reset', '$'),
+    Command('get_home_phase', 'A', parser=r.parse_axis_pair),
+    Command('get_last_error', 'e', parser=r.parse_int),
+    Command('get_liquid_sensitivity', 'K', parser=r.parse_probe_ints),
+    Command('get_motor_status_2', 'M', parser=r.parse_motor_status_2),
+    Command('get_motor_status', 'm', parser=r.parse_motor_status),
+    Command('get_liquid_detector_status', 'N',
+            parser=r.parse_probe_chars),
+    Command('get_probe_speed', 'O', parser=r.parse_probe_ints),
+    Command('get_encoder_position', 'P', parser=r.parse_axis_pair),
+    Command('get_probe_x_range', 'q', parser=r.parse_range),
+    Command('get_travel_range', 'Q', parser=r.parse_range),
+    Command('get_led_text', 'R'),
+    Command('get_sync_buffer', 'S'),
+    Command('get_last_probe_z_position', 'T',
+            parser=r.parse_probe_ints),
+    Command('get_probe_width', 'w', parser=r.parse_int),
+    Command('get_x_motor_status', 'x'),
+    Command('get_y_motor_status', 'y'),
+    Command('get_z_motor_status', 'z', parser=r.parse_probe_chars),
+    Command('get_probe_x_position', 'X', parser=r.parse_probe_ints),
+    Command('get_y_position', 'Y', parser=r.parse_int),
+    Command('get_probe_z_position', 'Z', parser=r.parse_probe_ints),
+    # Buffered commands
+    Command('beep', 'SB%s,%s', [('frequency', Int(0)),
+                                ('duration', Int(0))], buffered=True),
+    Command('clear_error', 'Se', buffered=True),
+    Command('set_motor_status', 'SE%s%s%s', [('x', BIT), ('y', BIT),
+                                             ('z', BIT)], buffered=True),
+    Command('relax_probe', 'SF%s', [('probe', PROBE)], buffered=True),
+    Command('home', 'SH', buffered=True),
+    Command('set_liquid_level_sensitivity', 'SK%s%s',
+            [('probe', PROBE), ('sensitivity', Int(0, 255))], buffered=True),
+    Command('start_probe_move', 'SM', buffered=True),
+    Command('start_probe_move_liquid_level', 'Sm', buffered=True),
+    Command('set_probe_speed', 'SO%s,%s,%s,%s',
+            [('a', Int(0, blank=True)), ('b', Int(0, blank=True)),
+             ('c', Int(0, blank=True)), ('d', Int(0, blank=True))],
+            buffered=True),
+    Command('set_probe_z_height', 'ST%s,%s,%s,%s',
+            [('a', Int(blank=True)), ('b', Int(blank=True)),
+             ('c', Int(blank=True)), ('d', Int(blank=True))], buffered=True),
+    Command('set_lcd_text', 'SW%s', [('text', Text(32))], buffered=True),
+    Command('set_probe_width', 'Sw%s', [('width', Int(90, 180))],
+            buffered=True),
+    Command('set_probe_position', 'SX%s%s/%s',
+            [('probe', PROBE), ('x', Int()), ('y', Int())], buffered=True),
+    Command('set_y_position', 'SY%s', [('y', Int())], buffered=True),
+    Command('set_probe_z', 'SZ%s%s', [('probe', PROBE), ('z', Int())],
+            buffered=True),
+    Command('set_probe_z_liquid_level', 'Sz%s%s',
+            [('probe', PROBE), ('z', Int())], buffered=True),
+])
+
+# Gilson 402 syringe pump (402 Syringe Pump User Guide, GSIOC commands)
+PUMP_402 = CommandSet('402', 'pump', [
+    # Immediate commands
+    Command('get_version', '%'),
+    Command('reset', '$'),
+    Command('get_syringe_status', 'M', parser=r.parse_syringe_status),
+    Command('get_global_status', 'S', parser=r.parse_global_status),
+    Command('get_valve_status', 'V', parser=r.parse_valve_status),
+    # Buffered commands
+    Command('aspirate', 'A%s%s', [('syringe', SYRINGE), ('volume', Volume())],
+            buffered=True),
+    Command('dispense', 'D%s%s', [('syringe', SYRINGE), ('volume', Volume())],
+            buffered=True),
+    Command('start', 'B%s', [('syringe', SYRINGES)], buffered=True),
+    Command('set_motor_force', 'F%s%s', [('syringe', SYRINGE),
+                                         ('amplitude', Int(0))],
+            buffered=True),
+    Command('halt', 'N%s', [('syringe', SYRINGES)], buffered=True),
+    Command('initialize', 'O%s', [('syringe', SYRINGES)], buffered=True),
+    Command('set_syringe_size', 'P%s%s', [('syringe', SYRINGES),
+                                          ('volume', Int(1))],
+            buffered=True),
+    Command('set_flow_rate', 'S%s%s', [('syringe', SYRINGE),
+                                       ('flow_rate', Number())],
+            buffered=True),
+    Command('synchronize', 'T%s', [('syringe', SYRINGE)], buffered=True),
+    Command('set_valve', 'V%s%s', [('syringe', SYRINGE), ('valve', VALVE)],
+            buffered=True),
+])
@@ -19,6 +19,9 @@ class DeviceNotConnected(DeviceException):
 class DeviceNotResponding(DeviceException):
     pass
 
+class CircuitOpen(DeviceNotResponding):
+    pass
+
 class DeviceNotFound(Exception):
     pass
 
@@ -26,4 +29,19 @@ class MoveInnacuracyDetected(Exception):
     pass
 
 class VolumeError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class CommandArgumentError(ValueError):
+    pass
+
+class QueueFull(DeviceException):
+    pass
+
+class RequestTimeout(DeviceException):
+    pass
+
+class OutOfRange(Exception):
+    pass
+
+class FleetError(Exception):
+    pass
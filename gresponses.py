@@ -0,0 +1,273 @@
+"""
+Parsers for GSIOC immediate command responses.
+
+Each parser turns the raw response string of one immediate command into a
+small record with numeric fields. Patterns are compiled once at import time
+and most formats are parsed with str.split, so parsing a status poll costs a
+few microseconds. The parsers are attached to their commands in the
+gcommands tables.
+
+Records that used to be returned as dicts (keyed by probe number or axis
+letter) still support the same item access, e.g. position['Y'] or
+heights[2].
+
+Run this module to benchmark the parsers:
+    python gresponses.py
+"""
+import re
+from collections import namedtuple
+
+
+################################
+####                        ####
+####        Records         ####
+####                        ####
+################################
+
+class Record(object):
+    """
+    Base class for slotted response records. _keys maps the item keys of the
+    old dict return values to slot names.
+    """
+    __slots__ = ()
+    _keys = {}
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, self._keys[key])
+        except (KeyError, TypeError):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def keys(self):
+        return sorted(self._keys)
+
+    def values(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            return type(self) is type(other) and \
+                   self.values() == other.values()
+        if isinstance(other, dict):
+            return dict(self.items()) == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__,
+                           ', '.join('%s=%r' % (name, getattr(self, name))
+                                     for name in self.__slots__))
+
+
+class ProbeValues(Record):
+    """
+    One value per probe, indexed by probe number (1-4)
+    """
+    __slots__ = ('a', 'b', 'c', 'd')
+    _keys = {1: 'a', 2: 'b', 3: 'c', 4: 'd'}
+
+    def __init__(self, a, b, c, d):
+        self.a = a
+        self.b = b
+        self.c = c
+        self.d = d
+
+    def __getitem__(self, probe):
+        # Fast path for the most common lookup in polling loops
+        if probe == 1:
+            return self.a
+        elif probe == 2:
+            return self.b
+        elif probe == 3:
+            return self.c
+        elif probe == 4:
+            return self.d
+        raise KeyError(probe)
+
+
+class AxisPair(Record):
+    """
+    X and Y values, indexed by 'X' and 'Y'
+    """
+    __slots__ = ('x', 'y')
+    _keys = {'X': 'x', 'Y': 'y'}
+
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+
+class AxisRanges(Record):
+    """
+    (min, max) ranges of the gantry axes, indexed by 'X', 'Y' and 'Z'
+    """
+    __slots__ = ('x', 'y', 'z')
+    _keys = {'X': 'x', 'Y': 'y', 'Z': 'z'}
+
+    def __init__(self, x, y, z):
+        self.x = x
+        self.y = y
+        self.z = z
+
+
+class MotorStatus(Record):
+    """
+    Quad-Z motor status ('m' command)
+    """
+    __slots__ = ('x', 'y', 'z1', 'z2', 'z3', 'z4', 'p')
+    _keys = {'X': 'x', 'Y': 'y', 'Z1': 'z1', 'Z2': 'z2', 'Z3': 'z3',
+             'Z4': 'z4', 'P': 'p'}
+
+    def __init__(self, x, y, z1, z2, z3, z4, p):
+        self.x = x
+        self.y = y
+        self.z1 = z1
+        self.z2 = z2
+        self.z3 = z3
+        self.z4 = z4
+        self.p = p
+
+
+class MotorStatus2(Record):
+    """
+    Motor status of the single Z liquid handler command set ('M' command)
+    """
+    __slots__ = ('x', 'y', 'z', 'd')
+    _keys = {'X': 'x', 'Y': 'y', 'Z': 'z', 'D': 'd'}
+
+    def __init__(self, x, y, z, d):
+        self.x = x
+        self.y = y
+        self.z = z
+        self.d = d
+
+
+# 402 syringe pump records behave like the tuples they replace
+SyringeStatus = namedtuple('SyringeStatus', 'left_status left_volume '
+                                            'right_status right_volume')
+GlobalStatus = namedtuple('GlobalStatus', 'buffer error')
+ValveStatus = namedtuple('ValveStatus', 'left right')
+
+
+################################
+####                        ####
+####        Parsers         ####
+####                        ####
+################################
+
+SYRINGE_STATUS = re.compile(r'([A-Z])([0-9.]+)([A-Z])([0-9.]+)')
+
+
+def parse_int(response):
+    return int(response)
+
+
+def parse_probe_ints(response):
+    """
+    'a,b,c,d' -> ProbeValues of ints
+    """
+    a, b, c, d = response.split(',')
+    return ProbeValues(int(a), int(b), int(c), int(d))
+
+
+def parse_probe_chars(response):
+    """
+    'abcd' -> ProbeValues of single character statuses
+    """
+    return ProbeValues(response[0], response[1], response[2], response[3])
+
+
+def parse_axis_pair(response):
+    """
+    'x/y' -> AxisPair of ints
+    """
+    x, y = response.split('/')
+    return AxisPair(int(x), int(y))
+
+
+def parse_range(response):
+    """
+    'k=min/max' -> (k, (min, max)), one line of the 'q' and 'Q' responses
+    """
+    key, numbers = response.split('=')
+    low, high = numbers.split('/')
+    return key, (int(low), int(high))
+
+
+def parse_motor_status(response):
+    return MotorStatus(*response[:7])
+
+
+def parse_motor_status_2(response):
+    return MotorStatus2(*response[:4])
+
+
+def parse_syringe_status(response):
+    """
+    'H250.0R0.0' -> SyringeStatus('H', 250.0, 'R', 0.0)
+    """
+    match = SYRINGE_STATUS.match(response)
+    if match is None:
+        raise ValueError('Invalid syringe status %r' % (response,))
+    left, lvol, right, rvol = match.groups()
+    return SyringeStatus(left, float(lvol), right, float(rvol))
+
+
+def parse_global_status(response):
+    return GlobalStatus(int(response[0]), int(response[1]))
+
+
+def parse_valve_status(response):
+    return ValveStatus(response[0], response[1])
+
+
+def benchmark(number = 100000):
+    """
+    Print the cost of each parser per call
+
+    Arguments:
+    number -- number of calls to time for each parser
+    """
+    import timeit
+    samples = [('parse_probe_ints', "'2000,1500,2000,125'"),
+               ('parse_probe_chars', "'PPPU'"),
+               ('parse_axis_pair', "'1024/2000'"),
+               ('parse_range', "'a=0/3200'"),
+               ('parse_motor_status', "'PPPPPPU'"),
+               ('parse_syringe_status', "'H250.0R12.5'"),
+               ('parse_global_status', "'00'"),
+               ('parse_valve_status', "'NR'")]
+    # Reference: the uncompiled pattern previously matched on every poll
+    uncompiled = ("re.match(r'(?P<left>[A-Z])(?P<lvol>[0-9\.]+)' + "
+                  "r'(?P<right>[A-Z])(?P<rvol>[\.0-9]+)', 'H250.0R12.5')")
+    for name, sample in samples:
+        timer = timeit.Timer('%s(%s)' % (name, sample),
+                             'from gresponses import %s' % (name))
+        seconds = min(timer.repeat(3, number)) / number
+        print '%25s: %6.2f us' % (name, seconds * 1e6)
+    timer = timeit.Timer(uncompiled, 'import re')
+    seconds = min(timer.repeat(3, number)) / number
+    print '%25s: %6.2f us' % ('uncompiled re.match', seconds * 1e6)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,208 @@
+"""
+Per-device health tracking and circuit breakers for the GSIOC bus.
+
+Every command to a device that is switched off or unplugged costs the queue
+a series of reconnect attempts, each waiting for the read timeout, and every
+other device waits behind it. HealthMonitor tracks the success rate and the
+latency of each device and retries connections with exponential backoff and
+jitter. After failure_threshold consecutive failures the device's circuit
+opens: commands to it fail at once with CircuitOpen while the other devices
+keep running. Once reset_timeout has passed, one command to the device is
+let through as a health check; if it succeeds the circuit closes again,
+otherwise it stays open for twice as long. The health check is the next
+command sent to the device, or the version request ('%') of probe(), which
+the queue's Supervisor calls on every check (see SerialQueue.supervise()).
+
+Circuit states:
+    'closed' -- commands are sent
+    'open' -- commands fail with CircuitOpen
+    'half-open' -- one health check is being sent
+"""
+import random
+import gexceptions
+from clock import SYSTEM as SYSTEM_CLOCK
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class DeviceHealth(object):
+    """
+    Health of one device
+    """
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.state = CLOSED
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        # Moving average of command and connection latency in seconds
+        self.latency = None
+        # Time the circuit may be tried again and how long it stays open
+        self.retry_at = None
+        self.reset_timeout = None
+        self.opened = 0
+
+    def success_rate(self):
+        total = self.successes + self.failures
+        if not total:
+            return 1.0
+        return self.successes / float(total)
+
+    def report(self):
+        return {'state': self.state,
+                'successes': self.successes,
+                'failures': self.failures,
+                'success_rate': self.success_rate(),
+                'latency': self.latency,
+                'opened': self.opened}
+
+    def __repr__(self):
+        return '<DeviceHealth %i %s, %.0f%% success>' % (
+                   self.device_id, self.state, 100 * self.success_rate())
+
+
+class HealthMonitor(object):
+    """
+    Health of the devices on a bus
+
+    Arguments:
+    clock -- time source, see clock.py
+    failure_threshold -- consecutive failures that open a circuit
+    max_retries -- connection attempts per command
+    base_backoff -- delay before the second connection attempt, doubled
+                    for every further attempt
+    max_backoff -- longest delay between connection attempts
+    jitter -- random fraction added to or taken from each backoff
+    reset_timeout -- seconds a circuit stays open before a health check,
+                     doubled after every failed check up to max_reset
+    smoothing -- weight of the newest latency in the moving average
+    log -- logger for circuit changes
+    """
+    def __init__(self, clock = None, failure_threshold = 3, max_retries = 4,
+                 base_backoff = .05, max_backoff = 1.0, jitter = .25,
+                 reset_timeout = 5.0, max_reset = 60.0, smoothing = .2,
+                 log = None):
+        self.clock = clock or SYSTEM_CLOCK
+        self.failure_threshold = failure_threshold
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.reset_timeout = reset_timeout
+        self.max_reset = max_reset
+        self.smoothing = smoothing
+        self.log = log
+        self.devices = {}
+
+    def get(self, device_id):
+        health = self.devices.get(device_id)
+        if health is None:
+            health = self.devices[device_id] = DeviceHealth(device_id)
+        return health
+
+    def backoff(self, attempt):
+        """
+        Get the delay before a connection attempt (the first is 1)
+        """
+        delay = min(self.base_backoff * 2 ** (attempt - 1), self.max_backoff)
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def is_open(self, device_id):
+        """
+        True if commands to a device would fail at once
+        """
+        health = self.devices.get(device_id)
+        if health is None or health.state == CLOSED:
+            return False
+        if health.state == HALF_OPEN:
+            return True
+        return self.clock.time() < health.retry_at
+
+    def check(self, device_id):
+        """
+        Raise CircuitOpen if a device may not be used now. An open circuit
+        whose reset timeout has passed becomes half open and lets this
+        command through as a health check.
+        """
+        health = self.get(device_id)
+        if health.state == CLOSED:
+            return
+        if health.state == OPEN and self.clock.time() >= health.retry_at:
+            health.state = HALF_OPEN
+            return
+        raise gexceptions.CircuitOpen(device_id, 'Circuit for device %i is '
+                                      'open after %i failures' %
+                                      (device_id,
+                                       health.consecutive_failures))
+
+    def success(self, device_id, latency = None):
+        health = self.get(device_id)
+        health.successes += 1
+        health.consecutive_failures = 0
+        if latency is not None:
+            if health.latency is None:
+                health.latency = latency
+            else:
+                health.latency += self.smoothing * (latency - health.latency)
+        if health.state != CLOSED:
+            health.state = CLOSED
+            health.reset_timeout = None
+            if self.log is not None:
+                self.log.info('Device %i is responding again, circuit '
+                              'closed' % (device_id))
+
+    def failure(self, device_id):
+        health = self.get(device_id)
+        health.failures += 1
+        health.consecutive_failures += 1
+        if health.state == HALF_OPEN:
+            # Failed health check, stay open for longer
+            health.reset_timeout = min(2 * health.reset_timeout,
+                                       self.max_reset)
+        elif health.state == CLOSED and \
+             health.consecutive_failures >= self.failure_threshold:
+            health.reset_timeout = self.reset_timeout
+            health.opened += 1
+        else:
+            return
+        health.state = OPEN
+        health.retry_at = self.clock.time() + health.reset_timeout
+        if self.log is not None:
+            self.log.warning('Device %i failed %i times, circuit open for '
+                             '%.1f s' % (device_id,
+                                         health.consecutive_failures,
+                                         health.reset_timeout))
+
+    def due(self):
+        """
+        Get the devices whose open circuit may be tried again
+        """
+        return [device_id for device_id, health in self.devices.items()
+                if health.state == OPEN and
+                self.clock.time() >= health.retry_at]
+
+    def probe(self, queue):
+        """
+        Send a health check ('%') to every device whose circuit may be tried
+        again. A device with the error of a failed buffered instruction
+        pending is skipped, the error is left for the next command of the
+        user (see SerialQueue.fail_device()).
+
+        Returns:
+        list of device ids whose circuit closed
+        """
+        closed = []
+        failures = getattr(queue, 'failures', {})
+        for device_id in self.due():
+            if device_id in failures:
+                continue
+            queue.add_immediate_instruction(device_id, '%')
+            if self.get(device_id).state == CLOSED:
+                closed.append(device_id)
+        return closed
+
+    def report(self):
+        return dict((device_id, health.report())
+                    for device_id, health in self.devices.items())
@@ -0,0 +1,274 @@
+"""
+Labware definitions and a compiled well coordinate index.
+
+Labware types (plates, tube racks, reservoirs) describe a rectangular grid of
+wells relative to their A1 well. Labware is placed on a Deck, and
+Deck.compile() turns the layout into a WellIndex: NumPy arrays holding the
+x, y, z-top and z-bottom coordinates of every well on the deck. All
+coordinates are in tenths of millimeters, like the QuadZDevice methods.
+
+Example:
+    deck = Deck()
+    deck.load('source', plate_96(), 250, 400)
+    deck.load('dest', plate_384(), 1450, 400)
+    index = deck.compile()
+    index.validate(quadz)
+    x, y, z_top, z_bottom = index['source:A1']
+    coordinates = index.positions(['source:A%i' % (i) for i in range(1, 13)])
+"""
+import string
+import numpy
+import gexceptions
+
+ROW_LETTERS = string.ascii_uppercase
+
+# Columns of the coordinate array returned by WellIndex
+X, Y, Z_TOP, Z_BOTTOM = range(4)
+
+# Columns of the obstacle array returned by WellIndex
+X_MIN, Y_MIN, X_MAX, Y_MAX, HEIGHT = range(5)
+
+
+class Labware(object):
+    """
+    Definition of a labware type
+
+    Arguments:
+    name -- labware type name
+    rows -- number of rows (A, B, ...), along the y axis
+    columns -- number of columns (1, 2, ...), along the x axis
+    row_pitch -- distance between rows
+    column_pitch -- distance between columns
+    height -- height of the top of the labware above the deck
+    depth -- depth of the wells
+    """
+    def __init__(self, name, rows, columns, row_pitch, column_pitch, height,
+                 depth):
+        if rows > len(ROW_LETTERS):
+            raise ValueError('Labware cannot have more than %i rows' %
+                             (len(ROW_LETTERS)))
+        self.name = name
+        self.rows = rows
+        self.columns = columns
+        self.row_pitch = row_pitch
+        self.column_pitch = column_pitch
+        self.height = height
+        self.depth = depth
+
+    def __len__(self):
+        return self.rows * self.columns
+
+    def wells(self):
+        """
+        Get well names in column order (A1, B1, ..., A2, ...)
+        """
+        return ['%s%i' % (ROW_LETTERS[row], column + 1)
+                for column in range(self.columns)
+                for row in range(self.rows)]
+
+    def offsets(self):
+        """
+        Get x and y offsets of the wells from well A1, in the order of
+        wells()
+
+        Returns:
+        (n, 2) int array
+        """
+        columns, rows = numpy.meshgrid(numpy.arange(self.columns),
+                                       numpy.arange(self.rows),
+                                       indexing='ij')
+        offsets = numpy.empty((len(self), 2), dtype=numpy.int32)
+        offsets[:, 0] = (columns * self.column_pitch).ravel()
+        offsets[:, 1] = (rows * self.row_pitch).ravel()
+        return offsets
+
+    def __repr__(self):
+        return '<Labware %s %ix%i>' % (self.name, self.rows, self.columns)
+
+
+def plate_96(height = 144, depth = 107):
+    """
+    SBS 96 well plate, 9 mm pitch
+    """
+    return Labware('96 well plate', 8, 12, 90, 90, height, depth)
+
+
+def plate_384(height = 144, depth = 115):
+    """
+    SBS 384 well plate, 4.5 mm pitch
+    """
+    return Labware('384 well plate', 16, 24, 45, 45, height, depth)
+
+
+def tube_rack(rows, columns, pitch, height, depth):
+    """
+    Rack of tubes on a square grid
+    """
+    return Labware('%ix%i tube rack' % (rows, columns), rows, columns, pitch,
+                   pitch, height, depth)
+
+
+def reservoir(channels = 1, pitch = 90, height = 440, depth = 390):
+    """
+    Single row reservoir with one or more channels
+    """
+    return Labware('%i channel reservoir' % (channels), 1, channels, pitch,
+                   pitch, height, depth)
+
+
+class Deck(object):
+    """
+    Layout of labware on the liquid handler bed
+    """
+    def __init__(self):
+        self.names = []
+        self.labware = {}
+        self.origins = {}
+
+    def load(self, name, labware, x, y):
+        """
+        Place labware on the deck
+
+        Arguments:
+        name -- unique name of this piece of labware
+        labware -- Labware definition
+        x, y -- position of well A1
+        """
+        if ':' in name:
+            raise ValueError('Labware names cannot contain ":"')
+        if name in self.labware:
+            raise ValueError('Labware %s is already on the deck' % (name))
+        self.names.append(name)
+        self.labware[name] = labware
+        self.origins[name] = (x, y)
+
+    def compile(self):
+        """
+        Compile the deck layout into a WellIndex
+        """
+        total = sum(len(self.labware[name]) for name in self.names)
+        coordinates = numpy.empty((total, 4), dtype=numpy.int32)
+        obstacles = numpy.empty((len(self.names), 5), dtype=numpy.int32)
+        names = []
+        slices = {}
+        start = 0
+        for i, name in enumerate(self.names):
+            labware = self.labware[name]
+            end = start + len(labware)
+            x, y = self.origins[name]
+            block = coordinates[start:end]
+            block[:, X:Y + 1] = labware.offsets()
+            block[:, X] += x
+            block[:, Y] += y
+            block[:, Z_TOP] = labware.height
+            block[:, Z_BOTTOM] = labware.height - labware.depth
+            names.extend('%s:%s' % (name, well) for well in labware.wells())
+            slices[name] = slice(start, end)
+            start = end
+            # Footprint extends half a pitch beyond the outer wells
+            obstacles[i] = (x - labware.column_pitch // 2,
+                            y - labware.row_pitch // 2,
+                            x + (labware.columns * 2 - 1) *
+                                labware.column_pitch // 2,
+                            y + (labware.rows * 2 - 1) *
+                                labware.row_pitch // 2,
+                            labware.height)
+        return WellIndex(names, coordinates, slices, obstacles)
+
+
+class WellIndex(object):
+    """
+    Compiled coordinates of every well on a deck
+
+    coordinates is an (n, 4) array of x, y, z-top and z-bottom, rows are
+    indexed by the well names 'labware:well' (e.g. 'source:A1'). obstacles
+    is an (m, 5) array of the labware footprints (x-min, y-min, x-max, y-max)
+    and heights.
+    """
+    def __init__(self, names, coordinates, slices, obstacles):
+        self.names = names
+        self.coordinates = coordinates
+        self.coordinates.flags.writeable = False
+        self.obstacles = obstacles
+        self.obstacles.flags.writeable = False
+        self.rows = dict((name, row) for row, name in enumerate(names))
+        self.slices = slices
+        # Set by validate(), (n, 4) bool array of which probes reach a well
+        self.reachable = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.rows
+
+    def __getitem__(self, name):
+        """
+        Get (x, y, z-top, z-bottom) of a well
+        """
+        return tuple(self.coordinates[self.rows[name]].tolist())
+
+    def lookup(self, names):
+        """
+        Get the coordinate array rows of a list of wells
+        """
+        rows = self.rows
+        try:
+            return numpy.fromiter((rows[name] for name in names),
+                                  dtype=numpy.intp)
+        except KeyError, e:
+            raise KeyError('Unknown well %s' % (e.args[0]))
+
+    def positions(self, names):
+        """
+        Get coordinates of many wells at once
+
+        Returns:
+        (n, 4) array of x, y, z-top, z-bottom
+        """
+        return self.coordinates[self.lookup(names)]
+
+    def labware(self, name):
+        """
+        Get the coordinates of all wells of one piece of labware, in column
+        order
+        """
+        return self.coordinates[self.slices[name]]
+
+    def validate(self, quadz = None, xyz_range = None, probe_x_range = None):
+        """
+        Check once that every well is inside the gantry travel range and can
+        be reached by at least one probe. The ranges are read from the
+        instrument if quadz is given, otherwise they must be passed in.
+
+        Arguments:
+        quadz -- QuadZDevice to read get_travel_range() and
+                 get_probe_x_range() from
+        xyz_range -- travel ranges, indexed by 'X', 'Y' and 'Z'
+        probe_x_range -- x range of each probe, indexed by probe number
+
+        Returns:
+        (n, 4) bool array, True where probe (column + 1) can reach a well
+        """
+        if quadz is not None:
+            xyz_range = quadz.get_travel_range()
+            probe_x_range = quadz.get_probe_x_range()
+        x = self.coordinates[:, X]
+        y = self.coordinates[:, Y]
+        y_min, y_max = xyz_range['Y']
+        z_min, z_max = xyz_range['Z']
+        bad = (y < y_min) | (y > y_max) | \
+              (self.coordinates[:, Z_BOTTOM] < z_min) | \
+              (self.coordinates[:, Z_TOP] > z_max)
+        reachable = numpy.empty((len(self), 4), dtype=bool)
+        for probe in range(1, 5):
+            x_min, x_max = probe_x_range[probe]
+            reachable[:, probe - 1] = (x >= x_min) & (x <= x_max)
+        bad |= ~reachable.any(axis=1)
+        if bad.any():
+            wells = [self.names[row] for row in numpy.flatnonzero(bad)[:5]]
+            raise gexceptions.OutOfRange('%i wells are out of range: %s%s' %
+                                         (bad.sum(), ', '.join(wells),
+                                          ', ...' if bad.sum() > 5 else ''))
+        self.reachable = reachable
+        return reachable
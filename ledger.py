@@ -0,0 +1,125 @@
+"""
+Client side volume ledger for the 402 syringes.
+
+The ledger predicts the volume in each syringe from the strokes that were
+started, so volume checks do not need a status query before every stroke.
+The prediction is reconciled with the device when a status response is
+read anyway (e.g. while waiting for a stroke to finish), when the volume has
+never been read, after reconcile_interval strokes without a reading, and
+after anything that makes the prediction unreliable (reset, halt,
+initialization, syringe size change).
+
+The predicted volume is kept in Syringe.current_volume.
+"""
+import gexceptions
+
+# 402 statuses while the syringe is moving, the reported volume is not final
+MOVING = ('R', 'I')
+
+
+class VolumeLedger(object):
+    """
+    Predicted syringe volumes, indexed by probe number
+
+    Arguments:
+    state -- state.InstrumentState holding the syringes
+    read -- function that reads the status of a probe's syringe from the
+            device and passes it to observe()
+    reconcile_interval -- strokes after which the volume is read again
+    tolerance -- difference in uL between prediction and device reading
+                 that counts as an anomaly
+    log -- logger for anomalies
+    """
+    def __init__(self, state, read, reconcile_interval = 25, tolerance = .5,
+                 log = None):
+        self.state = state
+        self.syringes = state.syringes
+        self.read = read
+        self.reconcile_interval = reconcile_interval
+        self.tolerance = tolerance
+        self.log = log
+        # Strokes since the last reading, None if the volume is unknown
+        self.strokes = [None] * 5
+        self.anomalies = 0
+        self.reads = 0
+
+    def volume(self, probe):
+        """
+        Get the predicted volume of a syringe, reading it from the device
+        first if the prediction is unknown or due for reconciliation
+        """
+        strokes = self.strokes[probe]
+        if strokes is None or strokes >= self.reconcile_interval:
+            self.reads += 1
+            self.read(probe)
+        return self.syringes[probe].current_volume
+
+    def check(self, probe, volume):
+        """
+        Raise VolumeError if a stroke does not fit the predicted volume
+
+        Arguments:
+        probe -- probe number
+        volume -- positive to dispense, negative to aspirate
+        """
+        current = self.volume(probe)
+        syringe = self.syringes[probe]
+        if volume > 0 and volume > current + self.tolerance:
+            raise gexceptions.VolumeError('Syringe for probe #%i does not '
+                                          'have enough volume to dispense '
+                                          '%s uL (%s uL left)' %
+                                          (probe, str(volume), str(current)))
+        if volume < 0 and syringe.syringe_size and \
+           current - volume > syringe.syringe_size + self.tolerance:
+            raise gexceptions.VolumeError('Syringe for probe #%i does not '
+                                          'have room to aspirate %s uL '
+                                          '(%s uL of %s uL used)' %
+                                          (probe, str(-volume), str(current),
+                                           str(syringe.syringe_size)))
+
+    def record(self, probe):
+        """
+        Apply the syringe's pending operation to the prediction when its
+        stroke is started
+        """
+        with self.state.lock:
+            syringe = self.syringes[probe]
+            syringe.current_volume -= syringe.next_operation
+            syringe.next_operation = 0
+            if self.strokes[probe] is not None:
+                self.strokes[probe] += 1
+
+    def observe(self, probe, status, volume):
+        """
+        Reconcile the prediction with a status read from the device
+
+        Arguments:
+        probe -- probe number
+        status -- syringe status letter
+        volume -- volume reported by the device
+
+        Returns:
+        False if the reading differs from the prediction, True otherwise
+        """
+        if status in MOVING:
+            return True
+        with self.state.lock:
+            syringe = self.syringes[probe]
+            expected = syringe.current_volume
+            syringe.current_volume = volume
+            known = self.strokes[probe] is not None
+            self.strokes[probe] = 0
+        if known and abs(volume - expected) > self.tolerance:
+            self.anomalies += 1
+            if self.log is not None:
+                self.log.warning('Syringe for probe #%i holds %s uL, '
+                                 'expected %s uL' % (probe, str(volume),
+                                                     str(expected)))
+            return False
+        return True
+
+    def invalidate(self, probe):
+        """
+        Forget the prediction so that the next check reads the device
+        """
+        self.strokes[probe] = None
@@ -0,0 +1,513 @@
+"""
+Motion planning for well based protocols.
+
+The planners work on a labware.WellIndex and produce stops: gantry positions
+at which one or more probes are over their target wells.
+
+Example:
+    stops = group_wells(index, targets)
+    run_stops(quadz, stops, lambda stop: quadz.move_probe(500, stop.probes()))
+"""
+import numpy
+import gexceptions
+import labware
+
+# Probe spacing limits of the Quad-Z in tenths of millimeters
+min_probe_width = 90
+max_probe_width = 180
+
+
+################################
+####                        ####
+####     Probe Grouping     ####
+####                        ####
+################################
+
+class Stop(object):
+    """
+    A gantry position where probes are lowered into wells
+
+    probe is the reference probe positioned at (x, y) by move_to(), wells
+    maps probe numbers to the well names they land on.
+    """
+    __slots__ = ('x', 'y', 'probe', 'width', 'wells')
+
+    def __init__(self, x, y, probe, width, wells):
+        self.x = x
+        self.y = y
+        self.probe = probe
+        self.width = width
+        self.wells = wells
+
+    def probes(self):
+        return sorted(self.wells)
+
+    def __repr__(self):
+        return '<Stop (%i, %i) width %i: %s>' % (self.x, self.y, self.width,
+                   ', '.join('%i=%s' % (probe, self.wells[probe])
+                             for probe in self.probes()))
+
+
+def group_wells(index, wells, width = min_probe_width):
+    """
+    Group target wells into stops where several probes land on wells at
+    once. The probe width is only changed when a different width lands more
+    probes, and stops are ordered so that each width is set once.
+
+    Arguments:
+    index -- labware.WellIndex the wells are in. If index.validate() has
+             been called, probes are only assigned to wells they can reach.
+    wells -- names of the target wells, each is visited once
+    width -- current probe width, preferred when widths tie
+
+    Returns:
+    list of Stop
+    """
+    positions = index.positions(wells)
+    rows = {}
+    for name, position in zip(wells, positions.tolist()):
+        rows.setdefault(position[labware.Y], []).append((position[labware.X],
+                                                         name))
+    reachable = index.reachable
+    stops = []
+    for y in sorted(rows):
+        remaining = dict((x, name) for x, name in rows[y])
+        if len(remaining) != len(rows[y]):
+            raise ValueError('Two target wells share the position (x, %i)' %
+                             (y))
+        while remaining:
+            x0 = min(remaining)
+            stop = best_stop(index, reachable, remaining, x0, y, width)
+            for probe in stop.wells:
+                del remaining[stop.x + (probe - stop.probe) * stop.width]
+            width = stop.width
+            stops.append(stop)
+    # Visit all stops of one width before changing the width, starting with
+    # the width that is already set
+    first = stops[0].width if stops else width
+    stops.sort(key=lambda stop: (stop.width != first, stop.width))
+    return stops
+
+
+def best_stop(index, reachable, remaining, x0, y, width):
+    """
+    Find the stop that lands the most probes on remaining wells, with the
+    leftmost remaining well (at x0) under one of the probes
+    """
+    candidates = set([width])
+    for x in remaining:
+        dx = x - x0
+        for step in (1, 2, 3):
+            if dx % step == 0 and \
+               min_probe_width <= dx // step <= max_probe_width:
+                candidates.add(dx // step)
+    best = None
+    best_key = None
+    for probe in (1, 2, 3, 4):
+        if not can_reach(index, reachable, remaining[x0], probe):
+            continue
+        for candidate in candidates:
+            wells = {probe: remaining[x0]}
+            for other in range(probe + 1, 5):
+                x = x0 + (other - probe) * candidate
+                if x in remaining and \
+                   can_reach(index, reachable, remaining[x], other):
+                    wells[other] = remaining[x]
+            # Most probes first, then keep the current width, then the
+            # narrowest width
+            key = (-len(wells), candidate != width, candidate, probe)
+            if best_key is None or key < best_key:
+                best_key = key
+                best = Stop(x0, y, probe, candidate, wells)
+    if best is None:
+        raise ValueError('No probe can reach well %s' % (remaining[x0]))
+    return best
+
+
+def can_reach(index, reachable, name, probe):
+    if reachable is None:
+        return True
+    return reachable[index.rows[name], probe - 1]
+
+
+def run_stops(quadz, stops, action = None):
+    """
+    Move to each stop, setting the probe width only when it changes
+
+    Arguments:
+    quadz -- QuadZDevice
+    stops -- list of Stop
+    action -- function called with each Stop after the gantry arrives
+    """
+    width = None
+    for stop in stops:
+        if stop.width != width:
+            quadz.set_probe_width(stop.width)
+            width = stop.width
+        quadz.move_to(stop.x, stop.y, probe=stop.probe)
+        if action is not None:
+            action(stop)
+
+
+################################
+####                        ####
+####    Path Optimization   ####
+####                        ####
+################################
+
+# Segments longer than this are only ordered by nearest neighbour, 2-opt
+# needs a full distance matrix
+max_two_opt_points = 2000
+
+
+def travel(a, b):
+    """
+    Gantry travel between two (x, y) points. X and Y move at the same time,
+    so the longer axis determines the move.
+    """
+    return max(abs(a[0] - b[0]), abs(a[1] - b[1]))
+
+
+def path_length(points, start = None):
+    """
+    Total gantry travel along a list of (x, y) points
+    """
+    length = 0
+    previous = start
+    for point in points:
+        if previous is not None:
+            length += travel(previous, point)
+        previous = point
+    return length
+
+
+def serpentine(points):
+    """
+    Order points row by row (by y), alternating the x direction every row
+
+    Returns:
+    list of indices into points
+    """
+    rows = {}
+    for i, point in enumerate(points):
+        rows.setdefault(point[1], []).append(i)
+    order = []
+    for row, y in enumerate(sorted(rows)):
+        row_order = sorted(rows[y], key=lambda i: points[i][0],
+                           reverse=row % 2 == 1)
+        order.extend(row_order)
+    return order
+
+
+def optimize_path(points, dependencies = (), barriers = (), start = None,
+                  xyz_range = None, passes = 20):
+    """
+    Reorder independent steps to minimize total gantry travel
+
+    Arguments:
+    points -- list of (x, y) step positions, in the original order
+    dependencies -- list of (before, after) index pairs that must keep their
+                    order (e.g. aspirate from a source before dispensing to
+                    its destination)
+    barriers -- indices of steps that must stay in place, no step moves
+                across a barrier (e.g. re-aspirate points)
+    start -- current (x, y) position of the gantry
+    xyz_range -- travel range from QuadZDevice.get_travel_range(), used to
+                 report the saved travel in full deck traverses
+    passes -- maximum number of 2-opt passes per segment
+
+    Returns:
+    list of indices into points, dict report with the 'original',
+    'optimized' and 'saved' travel and 'saved_traverses'
+    """
+    barriers = sorted(set(barriers))
+    after = {}
+    for before, later in dependencies:
+        after.setdefault(before, []).append(later)
+    order = []
+    segment_start = 0
+    position = start
+    for barrier in barriers + [len(points)]:
+        segment = range(segment_start, barrier)
+        if segment:
+            order.extend(optimize_segment(points, segment, after, position,
+                                          passes))
+            position = points[order[-1]]
+        if barrier < len(points):
+            order.append(barrier)
+            position = points[barrier]
+        segment_start = barrier + 1
+
+    original = path_length(points, start)
+    optimized = path_length([points[i] for i in order], start)
+    report = {'original': original,
+              'optimized': optimized,
+              'saved': original - optimized,
+              'saved_traverses': None}
+    if xyz_range is not None:
+        span = max(xyz_range['X'][1] - xyz_range['X'][0],
+                   xyz_range['Y'][1] - xyz_range['Y'][0])
+        report['saved_traverses'] = (original - optimized) / float(span)
+    return order, report
+
+
+def optimize_stops(stops, start = None, xyz_range = None):
+    """
+    Reorder stops from group_wells() to minimize gantry travel, keeping the
+    stops of each probe width together
+
+    Returns:
+    list of Stop, dict report (see optimize_path())
+    """
+    points = [(stop.x, stop.y) for stop in stops]
+    barriers = []
+    # Stops of one width form a segment. optimize_path() keeps barriers in
+    # place, so the first stop of each new width is fixed and the rest of
+    # its group is reordered after it.
+    for i in range(1, len(stops)):
+        if stops[i].width != stops[i - 1].width:
+            barriers.append(i)
+    order, report = optimize_path(points, barriers=barriers, start=start,
+                                  xyz_range=xyz_range)
+    return [stops[i] for i in order], report
+
+
+def optimize_segment(points, segment, after, start, passes):
+    """
+    Order one segment of steps (a list of indices into points), returning the
+    shortest valid order of the original, serpentine and nearest neighbour
+    plus 2-opt orders
+    """
+    members = set(segment)
+    after = dict((i, [j for j in after.get(i, ()) if j in members])
+                 for i in segment)
+    candidates = [list(segment)]
+    snake = [segment[i] for i in serpentine([points[i] for i in segment])]
+    if valid_order(snake, after):
+        candidates.append(snake)
+    nearest = nearest_neighbour(points, segment, after, start)
+    if len(segment) <= max_two_opt_points:
+        nearest = two_opt(points, nearest, after, start, passes)
+    candidates.append(nearest)
+    return min(candidates,
+               key=lambda order: path_length([points[i] for i in order],
+                                             start))
+
+
+def valid_order(order, after):
+    position = dict((step, i) for i, step in enumerate(order))
+    for before, laters in after.items():
+        for later in laters:
+            if position[before] > position[later]:
+                return False
+    return True
+
+
+def nearest_neighbour(points, segment, after, start):
+    """
+    Greedy order that always moves to the closest step whose dependencies
+    are done
+    """
+    waiting = dict((i, 0) for i in segment)
+    for laters in after.values():
+        for later in laters:
+            waiting[later] += 1
+    ready = set(i for i in segment if waiting[i] == 0)
+    order = []
+    position = start
+    while ready:
+        if position is None:
+            step = min(ready)
+        else:
+            step = min(ready, key=lambda i: (travel(position, points[i]), i))
+        ready.remove(step)
+        order.append(step)
+        position = points[step]
+        for later in after.get(step, ()):
+            waiting[later] -= 1
+            if waiting[later] == 0:
+                ready.add(later)
+    if len(order) != len(segment):
+        raise ValueError('Step dependencies contain a cycle')
+    return order
+
+
+def two_opt(points, order, after, start, passes):
+    """
+    Improve an order by reversing sub-paths while that shortens the path and
+    keeps every dependency in order
+    """
+    coordinates = [points[i] for i in order]
+    offset = 0
+    if start is not None:
+        coordinates.insert(0, start)
+        offset = 1
+    coordinates = numpy.array(coordinates, dtype=numpy.int64)
+    distance = numpy.maximum(
+            abs(coordinates[:, 0, None] - coordinates[None, :, 0]),
+            abs(coordinates[:, 1, None] - coordinates[None, :, 1]))
+    # Node k of the path is coordinates row path[k]
+    path = numpy.arange(len(coordinates))
+    pairs = [(before, later) for before, laters in after.items()
+             for later in laters]
+    node = dict((step, i + offset) for i, step in enumerate(order))
+    pairs = [(node[before], node[later]) for before, later in pairs]
+    n = len(path)
+    for i in range(passes):
+        improved = False
+        # Reverse path[a + 1 .. b]; the first node stays fixed when the path
+        # starts at the gantry position
+        for a in range(0 if offset else -1, n - 2):
+            first = path[a] if a >= 0 else None
+            for b in range(a + 2, n):
+                second = path[a + 1]
+                last = path[b]
+                delta = 0
+                if first is not None:
+                    delta += distance[first, last] - distance[first, second]
+                if b + 1 < n:
+                    delta += distance[second, path[b + 1]] - \
+                             distance[last, path[b + 1]]
+                if delta < 0 and reversible(path, a + 1, b, pairs):
+                    path[a + 1:b + 1] = path[a + 1:b + 1][::-1].copy()
+                    improved = True
+        if not improved:
+            break
+    steps = [None] * offset + list(order)
+    return [steps[k] for k in path[offset:]]
+
+
+def reversible(path, first, last, pairs):
+    """
+    Check that reversing path[first .. last] keeps all dependency pairs in
+    order
+    """
+    if not pairs:
+        return True
+    segment = set(path[first:last + 1].tolist())
+    for before, later in pairs:
+        if before in segment and later in segment:
+            return False
+    return True
+
+
+################################
+####                        ####
+####      Z Clearance       ####
+####                        ####
+################################
+
+class ClearancePlanner(object):
+    """
+    Moves the gantry while retracting the probes only as far as the labware
+    between two positions requires, instead of fully retracting them before
+    every move.
+
+    Heights are in the frame of QuadZDevice.move_probe(), tenths of
+    millimeters above the deck. The planner tracks the height of every probe
+    it moves; probes start at an unknown height and are retracted before the
+    first move.
+
+    Arguments:
+    quadz -- QuadZDevice
+    index -- labware.WellIndex with the deck obstacles
+    clearance -- distance to keep between the probe tips and the labware
+    width -- current probe width
+    max_z -- highest probe position, used when the heights are unknown
+    """
+    def __init__(self, quadz, index, clearance = 50, width = min_probe_width,
+                 max_z = 1500):
+        self.quadz = quadz
+        self.index = index
+        self.clearance = clearance
+        self.width = width
+        self.max_z = max_z
+        self.position = None
+        self.heights = {1: None, 2: None, 3: None, 4: None}
+        # Number of moves that needed a retraction and that skipped it
+        self.retractions = 0
+        self.skipped = 0
+
+    def safe_height(self, start, end, probes):
+        """
+        Get the lowest height at which probes can travel from start to end
+
+        Arguments:
+        start -- (x, y, reference probe) of the current position
+        end -- (x, y, reference probe) of the next position
+        probes -- probes that are lowered during the move
+
+        Returns:
+        height in tenths of millimeters
+        """
+        obstacles = self.index.obstacles
+        if not len(obstacles) or not probes:
+            return self.clearance
+        x_min = x_max = None
+        for x, y, reference in (start, end):
+            for probe in probes:
+                probe_x = x + (probe - reference) * self.width
+                if x_min is None or probe_x < x_min:
+                    x_min = probe_x
+                if x_max is None or probe_x > x_max:
+                    x_max = probe_x
+        y_min = min(start[1], end[1])
+        y_max = max(start[1], end[1])
+        # Obstacles whose footprint overlaps the swept rectangle
+        hit = (obstacles[:, labware.X_MIN] <= x_max) & \
+              (obstacles[:, labware.X_MAX] >= x_min) & \
+              (obstacles[:, labware.Y_MIN] <= y_max) & \
+              (obstacles[:, labware.Y_MAX] >= y_min)
+        if not hit.any():
+            return self.clearance
+        return int(obstacles[hit, labware.HEIGHT].max()) + self.clearance
+
+    def move_to(self, x, y, probe = 1):
+        """
+        Move the gantry, first raising any lowered probe that would hit
+        labware on the way
+
+        Arguments:
+        x, y -- target position
+        probe -- reference probe positioned at (x, y)
+        """
+        end = (x, y, probe)
+        lowered = [p for p in sorted(self.heights)
+                   if self.heights[p] is None or
+                      self.heights[p] < self.max_z]
+        if self.position is None or None in self.heights.values():
+            height = self.max_z
+        else:
+            height = self.safe_height(self.position, end, lowered)
+            if height > self.max_z:
+                raise gexceptions.OutOfRange('Safe travel height %i is above '
+                                             'the maximum of %i' %
+                                             (height, self.max_z))
+        low = [p for p in lowered
+               if self.heights[p] is None or self.heights[p] < height]
+        if low:
+            self.move_probe(height, low)
+            self.retractions += 1
+        else:
+            self.skipped += 1
+        self.quadz.move_to(x, y, probe=probe)
+        self.position = end
+
+    def move_probe(self, z, probes, liquid_sensing = False):
+        """
+        Move probes with QuadZDevice.move_probe() and track their height
+        """
+        self.quadz.move_probe(z, probes=probes, liquid_sensing=liquid_sensing)
+        for probe in probes:
+            self.heights[probe] = z
+
+    def set_probe_width(self, width):
+        if width != self.width:
+            self.quadz.set_probe_width(width)
+            self.width = width
+
+    def retract(self):
+        """
+        Fully retract all probes
+        """
+        self.move_probe(self.max_z, [1, 2, 3, 4])
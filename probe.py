@@ -1,4 +1,5 @@
 import traceback
+from gcommands import QUADZ
 
 class ProbeList():
     def __init__(self, quadz, syringes, mask):
@@ -13,12 +14,11 @@ class ProbeList():
         for probe in mask:
             if probe in self.both:
                 continue
-            if self.syringes[probe]['partner_probe'] in self.mask:
-                self.both[self.syringes[probe]['partner_probe']] = probe
+            if self.syringes[probe].partner_probe in self.mask:
+                self.both[self.syringes[probe].partner_probe] = probe
         
     def relax(self):
-        for probe in self.mask:
-            self.quadz.relax_probe(probe)
+        self.quadz.relax_probes(self.mask)
     
     def form_args(self, argv):
         ct = len(argv)
@@ -55,18 +55,17 @@ class ProbeList():
         args = self.form_args(argv)
         if not args:
             return self.quadz.get_liquid_sensitivity()
-        for key, probe in enumerate(self.mask):
-            self.quadz.set_liquid_level_sensitivity(probe, args[key])
+        self.quadz.set_liquid_level_sensitivities(dict(zip(self.mask, args)))
     
     def height(self, *argv):
         args = self.form_args(argv)
         if not args:
             return self.quadz.get_probe_z_position()
-        height = {'a': '', 'b': '', 'c': '', 'd': ''}
+        height = ['', '', '', '']
         for key, probe in enumerate(self.mask):
-            height[self.probe_map[probe]] = args[key]
-        self.quadz.set_probe_z_height(**height)
-        self.quadz.start_probe_move(liquid_level=False)
+            height[probe - 1] = args[key]
+        self.quadz.buffered_batch([QUADZ.set_probe_z_height(*height),
+                                   QUADZ.start_probe_move()])
         
     def speed(self, *args):
         args = self.form_args(args)
@@ -0,0 +1,76 @@
+"""
+SerialQueue worker running in a child process.
+
+The SerialQueue thread shares the interpreter lock with the calling code, so
+the byte timing of a GSIOC transaction stretches while the caller is busy
+(e.g. planning with numpy). ProcessQueue starts the SerialQueue in a child
+process and talks to it through a socket pair with the daemon protocol, so
+the serial timing only depends on the child.
+
+The connection state of the child's queue (connected device, registered
+devices, outstanding buffered commands, last exception) is mirrored into the
+ProcessQueue after device registration and on every mirror() call.
+
+Example:
+    quadz = QuadZDevice(com_port='/dev/ttyUSB0', process=True)
+
+or with an explicit queue:
+    queue = ProcessQueue(serial.Serial('/dev/ttyUSB0', 19200,
+                                       parity=serial.PARITY_EVEN, timeout=1))
+    quadz = QuadZDevice(queue=queue)
+"""
+import socket
+import multiprocessing
+from daemon import InstrumentDaemon, RemoteQueue
+from serialqueue import SerialQueue
+
+
+def serve(connection, device, max_buffered):
+    """
+    Run a SerialQueue for device and serve it on connection until the
+    parent closes its end. Runs in the child process.
+    """
+    queue = SerialQueue(device, max_buffered)
+    queue.daemon = True
+    queue.start()
+    queue.supervise()
+    daemon = InstrumentDaemon(None, queue)
+    daemon.start()
+    client = daemon.add_client(connection)
+    client.event_closed.wait()
+    daemon.stop()
+    queue.close()
+
+
+class ProcessQueue(RemoteQueue):
+    """
+    SerialQueue proxy for a queue running in a child process
+
+    The child is forked, so device is used by the child as it is: an open
+    serial.Serial or an emulator.Bus (whose devices then live in the child).
+    The parent must not use device after creating the queue.
+
+    Arguments:
+    device -- serial port
+    max_buffered -- see SerialQueue
+    priority -- see RemoteQueue
+    """
+    def __init__(self, device, max_buffered = 0, priority = 0):
+        parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.process = multiprocessing.Process(target=serve,
+                                               args=(child, device,
+                                                     max_buffered),
+                                               name='SerialQueue')
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        RemoteQueue.__init__(self, None, priority, connection=parent)
+
+    def close(self):
+        """
+        Stop the child process
+        """
+        RemoteQueue.close(self)
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
@@ -1,22 +1,42 @@
 import serial
-import re
 import gexceptions
 from serialqueue import SerialQueue
+from processqueue import ProcessQueue
 from probe import ProbeList
+from gcommands import Frame, QUADZ, PUMP_402
+from gresponses import AxisRanges, ProbeValues
+from state import InstrumentState
+from ledger import VolumeLedger
+from strokes import StrokeHandle, StrokeTimer
 
 class QuadZDevice():
-    def __init__(self, com_port = 1):
-        self.device = serial.Serial(com_port, 19200, \
-                                    parity = serial.PARITY_EVEN, \
-                                    timeout = 1)
-        if not self.device:
-            raise gexceptions.DeviceNotFound
-        
-        self.queue = SerialQueue(self.device)
-        self.queue.start()
-        
-        self.syringe_pumps = {}
-        self.syringe_pump_devices = []
+    def __init__(self, com_port = 1, max_buffered = 0, device = None,
+                 queue = None, process = False, clock = None):
+        # queue replaces the SerialQueue, e.g. a daemon.RemoteQueue sharing
+        # the serial port of an instrument daemon
+        self.device = device
+        self.queue = queue
+        if self.queue is None:
+            # device replaces the serial port, e.g. an emulator.Bus
+            if device is None:
+                self.device = serial.Serial(com_port, 19200, \
+                                            parity = serial.PARITY_EVEN, \
+                                            timeout = 1)
+            if not self.device:
+                raise gexceptions.DeviceNotFound
+            
+            # max_buffered bounds the buffered command queue (0 for no
+            # limit), with process the queue runs in a child process
+            if process:
+                self.queue = ProcessQueue(self.device, max_buffered)
+            else:
+                self.queue = SerialQueue(self.device, max_buffered, clock)
+            self.queue.start()
+            if not process:
+                # Restart the worker if it dies or hangs
+                self.queue.supervise()
+        # Time source shared with the queue, see clock.VirtualClock
+        self.clock = self.queue.clock
         
         self.probe_map = {1: 'a', 2: 'b', 3: 'c', 4: 'd'}
         
@@ -25,44 +45,19 @@ class QuadZDevice():
         self.base_tip_height = 10
         self.current_tip_height = 20
         
-        # Cached variables
-        self.liquid_sensitivity = {}
-        self.liquid_detector_status = {}
-        self.probe_speed = {}
-        self.probe_x_range = {}
-        self.xyz_range = {}
-        self.home_phase = {}
-        self.motor_status = {}
-        
         self.time_delay = .05
         
-        # Syringe pump data
-        """syringe_default = {'device_id': -1,
-                           'side': None,
-                           'syringe_size': 0,
-                           'partner_probe': 0,
-                           'status': 'I',
-                           'current_volume': 0,
-                           'valve_status': 'N',
-                           'motor_force': 3,
-                           'flow_rate': 10,
-                           'next_operation': 0}
-        self.syringe = {1: syringe_default, 2: syringe_default,
-                        3: syringe_default, 4: syringe_default}"""
-        
-        self.syringe = {}
-        for i in range(4):
-            self.syringe[i+1] = {'device_id': -1,
-                                   'side': None,
-                                   'syringe_size': 0,
-                                   'partner_probe': 0,
-                                   'status': 'I',
-                                   'current_volume': 0,
-                                   'valve_status': 'N',
-                                   'motor_force': 3,
-                                   'flow_rate': 10,
-                                   'next_operation': 0}
+        # Cached variables and syringe pump data, self.syringe is indexed by
+        # probe number (1-4)
+        self.state = InstrumentState()
+        self.syringe = self.state.syringes
         self.syringe_devices = []
+        
+        # Predicted syringe volumes, read from the pumps only when needed
+        self.ledger = VolumeLedger(self.state, self.get_syringe_pump_status,
+                                   log = self.queue.log)
+        # Stroke durations predicted from the flow rates
+        self.stroke_timer = StrokeTimer(self.state, log = self.queue.log)
     
     def initialize_device(self, device_id = 22):
         """
@@ -103,6 +98,29 @@ class QuadZDevice():
         if not result:
             self.queue.log.debug('EXCEPTION ---- ' + str(self.queue.last_exception))
             return False
+        if isinstance(instruction, Frame):
+            return instruction.parse(result)
+        return result
+    
+    def query(self, instruction, device_id = -1):
+        """
+        Send an immediate command whose response is required, e.g. for a
+        getter that caches its result
+        
+        Arguments:
+        instruction -- command to send
+        device_id -- device ID to send to. If it's -1, send to liquid handler
+        
+        Returns:
+        parsed response, raises DeviceNotResponding if there is none
+        """
+        if device_id == -1:
+            device_id = self.device_id
+        result = self.immediate(instruction, device_id)
+        if result is False:
+            raise gexceptions.DeviceNotResponding(device_id,
+                'No response to %s: %s' % (str(instruction),
+                                           str(self.queue.last_exception)))
         return result
     
     def buffered(self, instruction, device_id = -1):
@@ -115,13 +133,32 @@ class QuadZDevice():
         """
         if device_id == -1:
             device_id = self.device_id
-        wait = True
-        if device_id in self.syringe_devices:
-            wait = 'pump'
+        if isinstance(instruction, Frame):
+            wait = instruction.command.wait
+        else:
+            wait = 'handler'
+            if device_id in self.syringe_devices:
+                wait = 'pump'
         # TODO: Add code for checking if it is injection module
         return self.queue.add_buffered_instruction(device_id, instruction,
                                                    wait = wait)
     
+    def buffered_batch(self, instructions, device_id = -1):
+        """
+        Send several buffered commands to one device as a single batch
+        
+        Arguments:
+        instructions -- list of gcommands.Frame objects to send in order
+        device_id -- device id to send to. If set to -1, send to liquid handler
+        """
+        if device_id == -1:
+            device_id = self.device_id
+        wait = 'handler'
+        if device_id in self.syringe_devices:
+            wait = 'pump'
+        return self.queue.add_buffered_instructions(device_id, instructions,
+                                                    wait = wait)
+    
     def get_version(self):
         """
         Get liquid handler identifier and software version
@@ -129,26 +166,26 @@ class QuadZDevice():
         Returns:
         version string
         """
-        return self.immediate('%')
+        return self.immediate(QUADZ.get_version())
     
     def reset(self):
         """
         Reset liquid handler
         """
-        return self.immediate('$')
+        return self.immediate(QUADZ.reset())
     
     def get_home_phase(self):
         """
         Get motor home phase
         
         Returns:
-        dict where:
+        AxisPair where:
             X - x motor home phase
             Y - y motor home phase
         """
-        phase = self.immediate('A')
-        phase = phase.split('/')
-        return {'X': int(phase[0]), 'Y': int(phase[1])}
+        phase = self.query(QUADZ.get_home_phase())
+        self.state.update(home_phase=phase)
+        return phase
     
     def get_last_error(self):
         """
@@ -157,137 +194,119 @@ class QuadZDevice():
         Returns:
         error code of last error
         """
-        return int(self.immediate('e'))
+        return self.immediate(QUADZ.get_last_error())
     
     def get_liquid_sensitivity(self):
         """
         Get liquid level sensing sensitivity
         
         Returns:
-        dict where:
+        ProbeValues where:
             # - Probe # liquid level sensitivity (where # = 1-4)
         """
-        sensitivity = self.immediate('K')
-        sensitivity = sensitivity.split(',')
-        self.liquid_sensitivity = {1: int(sensitivity[0]),
-                                   2: int(sensitivity[1]),
-                                   3: int(sensitivity[2]),
-                                   4: int(sensitivity[3])}
-        return self.liquid_sensitivity
+        sensitivity = self.query(QUADZ.get_liquid_sensitivity())
+        self.state.update(liquid_sensitivity=sensitivity)
+        return sensitivity
     
     def get_motor_status_2(self):
         """
         Get motor status
         
         Returns:
-        dict -- where:
+        MotorStatus2 where:
             X - x motor status
             Y - y motor status
             Z - z motor status
             D - dilutor motor status (unuzed on Quad-Z)
         """
-        status = self.immediate('M')
-        self.motor_status = {'X': status[0], 'Y': status[1], 
-                            'Z': status[2], 'D': status[3]}
-        return self.motor_status
+        status = self.query(QUADZ.get_motor_status_2())
+        self.state.update(motor_status=status)
+        return status
     
     def get_motor_status(self):
         """
         Get motor status
         
         Returns:
-        dict -- where:
+        MotorStatus where:
             X - x motor status
             Y - y motor status
             Z# - probe # motor statusv (where # = 1-4)
             P - Unused on Quad-Z
         """
-        status = self.immediate('m')
-        self.motor_status = {'X': status[0], 'Y': status[1], 
-                            'Z1': status[2], 'Z2': status[3], 'Z3': status[4], 
-                            'Z4': status[5], 'P': status[6]} 
-        return self.motor_status
+        status = self.query(QUADZ.get_motor_status())
+        self.state.update(motor_status=status)
+        return status
     
     def get_liquid_detector_status(self):
         """
         Get liquid detector status
         
         Returns:
-        dict where:
+        ProbeValues where:
             # - Probe # status (where # = 1-4)
         """
-        status = self.immediate('N')
-        self.liquid_detector_status = {1: status[0], 2: status[1], 
-                                      3: status[2], 4: status[3]} 
-        return self.liquid_detector_status
+        status = self.query(QUADZ.get_liquid_detector_status())
+        self.state.update(liquid_detector_status=status)
+        return status
     
     def get_probe_speed(self):
         """
         Get probe speed in micrometers
         
         Returns:
-        dict where:
+        ProbeValues where:
             # - Probe # speed (where # = 1-4)
         """
-        speed = self.immediate('O')
-        speed = speed.split(',')
-        self.probe_speed = {1: int(speed[0]), 2: int(speed[1]),
-                            3: int(speed[2]), 4: int(speed[3])}
-        return self.probe_speed 
+        speed = self.query(QUADZ.get_probe_speed())
+        self.state.update(probe_speed=speed)
+        return speed
     
     def get_encoder_position(self):
         """
         Get linear encoder position in tenths of millimeters
         
         Returns:
-        dict where:
+        AxisPair where:
             x - x axis position
             y - y axis position
         """
-        position = self.immediate('P')
-        position = position.split('/')
-        return {'X': position[0], 'Y': position[1]}
+        return self.query(QUADZ.get_encoder_position())
     
     def get_probe_x_range(self):
         """
         Get probe x range in tenths of millimeters
         
         Returns:
-        dict of tuples (x-min, x-max) where:
+        ProbeValues of tuples (x-min, x-max) where:
             # - Probe # x range (where # = 1-4)
         """
         ranges = {}
         for i in range(4):
-            range_ = self.immediate('q')
-            range_ = range_.split('=')
-            range_nums = range_[1].split('/')
-            ranges[range_[0]] = range_nums
-        self.probe_x_range = {1: (int(ranges['a'][0]), int(ranges['a'][1])),
-                              2: (int(ranges['b'][0]), int(ranges['b'][1])),
-                              3: (int(ranges['c'][0]), int(ranges['c'][1])),
-                              4: (int(ranges['d'][0]), int(ranges['d'][1]))}
-        return self.probe_x_range
+            key, range_ = self.query(QUADZ.get_probe_x_range())
+            ranges[key] = range_
+        probe_x_range = ProbeValues(ranges['a'], ranges['b'],
+                                    ranges['c'], ranges['d'])
+        self.state.update(probe_x_range=probe_x_range)
+        return probe_x_range
     
     def get_travel_range(self):
         """
         Get gantry travel range in tenths of millimeters
         
         Returns:
-        dict of tuples (min, max) where:
+        AxisRanges of tuples (min, max) where:
             X - x axis range
             Y - y axis range
             Z - z axis range
         """
         ranges = {}
         for i in range(3):
-            range_ = self.immediate('Q')
-            range_ = range_.split('=')
-            range_nums = range_[1].split('/')
-            ranges[range_[0]] = range_nums
-        self.xyz_range = {'X': (int(ranges['X'][0]), int(ranges['X'][1])),
-                          'Y': (int(ranges['Y'][0]), int(ranges['Y'][1])),
-                          'Z': (int(ranges['Z'][0]), int(ranges['Z'][1]))}
-        return self.xyz_range
+            key, range_ = self.query(QUADZ.get_travel_range())
+            ranges[key] = range_
+        xyz_range = AxisRanges(ranges['X'], ranges['Y'], ranges['Z'])
+        self.state.update(xyz_range=xyz_range)
+        return xyz_range
     
     def get_led_text(self):
         """
@@ -296,7 +315,7 @@ class QuadZDevice():
         Returns:
         string
         """
-        return self.immediate('R')
+        return self.immediate(QUADZ.get_led_text())
     
     def get_sync_buffer(self):
         """
@@ -305,20 +324,17 @@ class QuadZDevice():
         Returns:
         string
         """
-        return self.immediate('S')
+        return self.immediate(QUADZ.get_sync_buffer())
     
     def get_last_probe_z_position(self):
         """
         Get last probe z position in tenths of millimeters
         
         Returns:
-        dict where:
+        ProbeValues where:
             # - Probe # z position (where # = 1-4)
         """
-        height = self.immediate('T')
-        height = height.split(',')
-        return {1: int(height[0]), 2: int(height[1]), 
-                3: int(height[2]), 4: int(height[3])}
+        return self.immediate(QUADZ.get_last_probe_z_position())
     
     def get_probe_width(self):
         """
@@ -327,7 +343,9 @@ class QuadZDevice():
         Returns:
         integer
         """
-        return int(self.immediate('w'))
+        width = self.query(QUADZ.get_probe_width())
+        self.state.update(probe_width=width)
+        return width
     
     def get_x_motor_status(self):
         """
@@ -336,7 +354,7 @@ class QuadZDevice():
         Returns:
         "U" for unpowered, "P" for powered, "E" for error
         """
-        return self.immediate('x')
+        return self.immediate(QUADZ.get_x_motor_status())
     
     def get_y_motor_status(self):
         """
@@ -345,7 +363,7 @@ class QuadZDevice():
         Returns:
         "U" for unpowered, "P" for powered, "E" for error
         """
-        return self.immediate('y')
+        return self.immediate(QUADZ.get_y_motor_status())
     
     def get_z_motor_status(self):
         """
@@ -353,24 +371,20 @@ class QuadZDevice():
         
         Returns:
         "U" for unpowered, "P" for powered, "E" for error
-        dict where:
+        ProbeValues where:
             # - Probe # motor status (where # = 1-4)
         """
-        status = self.immediate('z')
-        return {1: status[0], 2: status[1], 3: status[2], 4: status[3]}
+        return self.immediate(QUADZ.get_z_motor_status())
     
     def get_probe_x_position(self):
         """
         Get probe x position in tenths of millimeters
         
         Returns:
-        dict where:
+        ProbeValues where:
             # - Probe # x position (where # = 1-4)
         """
-        position = self.immediate('X')
-        position = position.split(',')
-        return {1: int(position[0]), 2: int(position[1]),
-                3: int(position[2]), 4: int(position[3])}
+        return self.query(QUADZ.get_probe_x_position())
     
     def get_y_position(self):
         """
@@ -379,20 +393,17 @@ class QuadZDevice():
         Returns:
         integer
         """
-        return int(self.immediate('Y'))
+        return self.query(QUADZ.get_y_position())
     
     def get_probe_z_position(self):
         """
         Get probe z position in tenths of millimeters
         
         Returns:
-        dict where:
+        ProbeValues where:
             # - Probe # z position (where # = 1-4)
         """
-        position = self.immediate('Z')
-        position = position.split(',')
-        return {1: int(position[0]), 2: int(position[1]),
-                3: int(position[2]), 4: int(position[3])}
+        return self.query(QUADZ.get_probe_z_position())
         
     def beep(self, frequency = 2400, duration = 1):
         """
@@ -402,13 +413,13 @@ class QuadZDevice():
         frequency -- frequency of sound in Hz
         duration -- duration of sound in tenths of seconds
         """
-        return self.buffered('SB%i,%i' % (frequency, duration))
+        return self.buffered(QUADZ.beep(frequency, duration))
     
     def clear_error(self):
         """
         Clear last error
         """
-        return self.buffered('Se')
+        return self.buffered(QUADZ.clear_error())
     
     def set_motor_status(self, x, y, z):
         """
@@ -421,7 +432,8 @@ class QuadZDevice():
         y -- new y motor status
         z -- new z motor status
         """
-        return self.buffered('SE%i%i%i' % (int(x), int(y), int(z)))
+        return self.buffered(QUADZ.set_motor_status(int(x), int(y),
+                                                    int(z)))
     
     def relax_probe(self, probe):
         """
@@ -430,13 +442,23 @@ class QuadZDevice():
         Arguments:
         probe -- Probe number to relax (1-4)
         """
-        return self.buffered('SF%s' % (self.probe_map[probe]))
+        return self.buffered(QUADZ.relax_probe(probe))
+    
+    def relax_probes(self, probes):
+        """
+        Relax several probes with one batch of commands
+        
+        Arguments:
+        probes -- list of probe numbers to relax
+        """
+        return self.buffered_batch([QUADZ.relax_probe(probe)
+                                    for probe in probes])
     
     def home(self):
         """
         Home the instrument axes
         """
-        return self.buffered('SH')
+        return self.buffered(QUADZ.home())
     
     def set_liquid_level_sensitivity(self, probe, sensitivity):
         """
@@ -446,7 +468,20 @@ class QuadZDevice():
         probe -- probe number to set sensitivity for
         sensitivity -- desired sensitivity (0-255 where 0 is most sensitive)
         """
-        return self.buffered('SK%s%i' % (self.probe_map[probe], sensitivity))
+        return self.buffered(QUADZ.set_liquid_level_sensitivity(probe,
+                                                                 sensitivity))
+    
+    def set_liquid_level_sensitivities(self, sensitivities):
+        """
+        Set liquid level sensitivity of several probes with one batch of
+        commands
+        
+        Arguments:
+        sensitivities -- dict of probe number: sensitivity (0-255)
+        """
+        return self.buffered_batch(
+                    [QUADZ.set_liquid_level_sensitivity(probe, sensitivity)
+                     for probe, sensitivity in sorted(sensitivities.items())])
     
     def start_probe_move(self, liquid_level = False):
         """
@@ -457,13 +492,12 @@ class QuadZDevice():
         liquid_level -- If true, use liquid level sensing
         """
         if liquid_level:
-            return self.buffered('Sm')
+            return self.buffered(QUADZ.start_probe_move_liquid_level())
         else:
-            return self.buffered('SM')
+            return self.buffered(QUADZ.start_probe_move())
     
     def set_probe_speed(self, a = '', b = '', c = '', d = ''):
-        return self.buffered('SO%s,%s,%s,%s' % (str(a), str(b), str(c), 
-                                                str(d)))
+        return self.buffered(QUADZ.set_probe_speed(a, b, c, d))
     
     def set_probe_z_height(self, a = '', b = '', c = '', d = ''):
         """
@@ -476,8 +510,7 @@ class QuadZDevice():
         c -- probe 3 z position
         d -- probe 4 z position
         """
-        return self.buffered('ST%s,%s,%s,%s' % (str(a), str(b), str(c), 
-                                                str(d)))
+        return self.buffered(QUADZ.set_probe_z_height(a, b, c, d))
     
     def set_lcd_text(self, led_string):
         """
@@ -486,7 +519,7 @@ class QuadZDevice():
         Arguments:
         led_string -- text to set the LCD to
         """
-        return self.buffered('SW%s' % (led_string))
+        return self.buffered(QUADZ.set_lcd_text(led_string))
     
     def set_probe_width(self, width):
         """
@@ -495,7 +528,9 @@ class QuadZDevice():
         Arguments:
         width -- width to set to
         """
-        return self.buffered('Sw%i' % (width))
+        result = self.buffered(QUADZ.set_probe_width(width))
+        self.state.update(probe_width=width)
+        return result
     
     def set_probe_position(self, probe, x, y):
         """
@@ -506,7 +541,7 @@ class QuadZDevice():
         x -- desired x position
         y -- desired y position
         """
-        return self.buffered('SX%s%i/%i' % (self.probe_map[probe], x, y))
+        return self.buffered(QUADZ.set_probe_position(probe, x, y))
         
     def set_y_position(self, y):
         """
@@ -515,7 +550,7 @@ class QuadZDevice():
         Arguments:
         y -- y coordinate to move to
         """
-        self.buffered('SY%i' % (y))
+        self.buffered(QUADZ.set_y_position(y))
         
     def set_probe_z(self, probe, z, liquid_level = False):
         """
@@ -527,9 +562,9 @@ class QuadZDevice():
         liquid_level -- If true, use liquid level sensing
         """
         if liquid_level:
-            self.buffered('Sz%s%i' % (self.probe_map[probe], z))
+            self.buffered(QUADZ.set_probe_z_liquid_level(probe, z))
         else:
-            self.buffered('SZ%s%i' % (self.probe_map[probe], z))
+            self.buffered(QUADZ.set_probe_z(probe, z))
 
     def move_to(self, x, y, probe = 1, timeout = 5):
         """
@@ -551,7 +586,7 @@ class QuadZDevice():
         sleep_counter = 0
         
         # While the positions do not match the target position
-        while probe_x[probe] != x and position['Y'] != y:
+        while probe_x[probe] != x or position['Y'] != y:
             # If the timeout has expired
             if sleep_counter > timeout:
                 self.sleep(2)
@@ -572,15 +607,16 @@ class QuadZDevice():
         compensated_z = z + (self.base_z + self.base_tip_height + \
                         self.current_tip_height) * 10
         
+        # One ST command positions all probes, sent in the same batch as the
+        # start command
+        heights = ['', '', '', '']
         for probe in probes:
-            if liquid_sensing:
-                self.set_probe_z_with_liquid_sensing(probe, compensated_z)
-            else:
-                self.set_probe_z(probe, compensated_z)
+            heights[probe - 1] = compensated_z
         if liquid_sensing:
-            self.start_probe_move_liquid_sensing()
+            start = QUADZ.start_probe_move_liquid_level()
         else:
-            self.start_probe_move()
+            start = QUADZ.start_probe_move()
+        self.buffered_batch([QUADZ.set_probe_z_height(*heights), start])
         
         sleep_counter = 0
         moving = True
@@ -628,19 +664,15 @@ class QuadZDevice():
         right_probe_num -- probe number to assign to right side pump
         """
         self.queue.register_device(device_id)
-        response = self.immediate('%', device_id)
+        response = self.immediate(PUMP_402.get_version(), device_id)
         if response[0:3] != '402':
             raise gexceptions.DeviceException(device_id, 
                               'Specified device is not a 402 syringe pump')
-        pr = left_probe_num
-        self.syringe[pr]['device_id'] = device_id
-        self.syringe[pr]['side'] = 'left'
-        self.syringe[pr]['partner_probe'] = right_probe_num
-        
-        pr = right_probe_num
-        self.syringe[pr]['device_id'] = device_id
-        self.syringe[pr]['side'] = 'right'
-        self.syringe[pr]['partner_probe'] = left_probe_num
+        with self.state.lock:
+            self.syringe[left_probe_num].assign(device_id, 'left',
+                                                right_probe_num)
+            self.syringe[right_probe_num].assign(device_id, 'right',
+                                                 left_probe_num)
         
         self.syringe_devices.append(device_id)
     
@@ -655,8 +687,10 @@ class QuadZDevice():
         Returns:
         '$' when pump is reset
         """
-        device_id = self.syringe[probe_num]['device_id']
-        return self.immediate('$', device_id)
+        syringe = self.syringe[probe_num]
+        self.ledger.invalidate(syringe.left_probe)
+        self.ledger.invalidate(syringe.right_probe)
+        return self.immediate(PUMP_402.reset(), syringe.device_id)
     
     def get_syringe_pump_status(self, probe_num):
         """
@@ -667,27 +701,39 @@ class QuadZDevice():
         
         Returns:
         str -- syringe status
-        int -- syringe size in uL
+        float -- current syringe volume in uL
         """
-        device_id = self.syringe[probe_num]['device_id']
-        response = self.immediate('M', device_id)
-        res = re.match(r"(?P<left>[A-Z])(?P<lvol>[0-9\.]+)" + 
-                       r"(?P<right>[A-Z])(?P<rvol>[\.0-9]+)", response)
+        syringe = self.syringe[probe_num]
+        res = self.query(PUMP_402.get_syringe_status(), syringe.device_id)
+        self.update_syringe_status(syringe, res)
         
-        if self.syringe[probe_num]['side'] is 'right':
-            pl = self.syringe[probe_num]['partner_probe']
-            pr = probe_num
-        else:
-            pl = probe_num
-            pr = self.syringe[probe_num]['partner_probe']
-        self.syringe[pl]['status'] = res.group("left")
-        self.syringe[pl]['current_volume'] = res.group("lvol")
-        self.syringe[pr]['status'] = res.group("right")
-        self.syringe[pr]['current_volume'] = res.group("rvol")
-        
-        if self.syringe[probe_num]['side'] is 'right':
-            return res.group("right"), float(res.group("rvol"))
-        return res.group("left"), float(res.group("lvol"))
+        if syringe.letter == 'R':
+            return res.right_status, res.right_volume
+        return res.left_status, res.left_volume
+    
+    def update_syringe_status(self, syringe, res):
+        """
+        Store a syringe status response of a pump and reconcile the volume
+        ledger with it
+        
+        Arguments:
+        syringe -- state of either syringe of the pump
+        res -- gresponses.SyringeStatus
+        
+        Returns:
+        list of probes whose volume differs from the ledger
+        """
+        with self.state.lock:
+            self.syringe[syringe.left_probe].status = res.left_status
+            self.syringe[syringe.right_probe].status = res.right_status
+        errors = []
+        if not self.ledger.observe(syringe.left_probe, res.left_status,
+                                   res.left_volume):
+            errors.append(syringe.left_probe)
+        if not self.ledger.observe(syringe.right_probe, res.right_status,
+                                   res.right_volume):
+            errors.append(syringe.right_probe)
+        return errors
     
     def get_global_status(self, probe_num):
         """
@@ -700,9 +746,8 @@ class QuadZDevice():
         int -- command buffer status
         int -- error flag status
         """
-        device_id = self.syringe[probe_num]['device_id']
-        resp = self.immediate('S', device_id)
-        return int(resp[0]), int(resp[1])
+        device_id = self.syringe[probe_num].device_id
+        return self.immediate(PUMP_402.get_global_status(), device_id)
     
     def get_valve_status(self, probe_num):
         """
@@ -714,22 +759,16 @@ class QuadZDevice():
         Returns:
         str - valve status
         """
-        device_id = self.syringe[probe_num]['device_id']
-        resp = self.immediate('V', device_id)
+        syringe = self.syringe[probe_num]
+        resp = self.query(PUMP_402.get_valve_status(), syringe.device_id)
         
-        if self.syringe[probe_num]['side'] is 'right':
-            pl = self.syringe[probe_num]['partner_probe']
-            pr = probe_num
-        else:
-            pl = probe_num
-            pr = self.syringe[probe_num]['partner_probe']
-        self.syringe[pl]['valve_status'] = resp[0]
-        self.syringe[pr]['valve_status'] = resp[1]
-        
-        offset = 0
-        if self.syringe[probe_num]['side'] is 'right':
-            offset = 1
-        return resp[offset]
+        with self.state.lock:
+            self.syringe[syringe.left_probe].valve_status = resp.left
+            self.syringe[syringe.right_probe].valve_status = resp.right
+        
+        if syringe.letter == 'R':
+            return resp.right
+        return resp.left
     
     def set_aspirate_volume(self, probe_num, volume, block = True):
         """
@@ -738,44 +777,42 @@ class QuadZDevice():
         Arguments:
         probe_num -- assigned probe number of the syringe pump
         volume -- volume to aspirate
-        """
-        self.wait_for_buffered()
-        device_id = self.syringe[probe_num]['device_id']
-        probe_letter = "L"
-        if self.syringe[probe_num]['side'] is 'right':
-            probe_letter = "R"
-        suffix = ''
-        if not volume % 1 > 0:
-            suffix = '.0'
-        if (volume % 1) == (self.get_syringe_pump_status(probe_num)[1] % 1):
+        block -- wait until the pump has accepted the volume, if False the
+                 command is only queued
+        """
+        if block:
+            self.wait_for_buffered()
+        syringe = self.syringe[probe_num]
+        self.ledger.check(probe_num, -volume)
+        self.buffered(PUMP_402.aspirate(syringe.letter, volume),
+                      syringe.device_id)
+        syringe.next_operation = -volume
+        if not block:
             return
-        self.buffered(('A%s' % (probe_letter)) + str(volume) + suffix, 
-                      device_id)
-        self.syringe[probe_num]['next_operation'] = -volume
+        self.queue.drain(syringe.device_id)
         while self.get_syringe_pump_status(probe_num)[0] != 'H':
             self.sleep(.05, '[aspirate block]')
     
-    def set_dispense_volume(self, probe_num, volume):
+    def set_dispense_volume(self, probe_num, volume, block = True):
         """
         Set syringe pump dispense volume without starting the pump
         
         Arguments:
         probe_num -- assigned probe number of the syringe pump
         volume -- volume to dispense
-        """
-        self.wait_for_buffered()
-        device_id = self.syringe[probe_num]['device_id']
-        probe_letter = "L"
-        if self.syringe[probe_num]['side'] is 'right':
-            probe_letter = "R"
-        suffix = ''
-        if not volume % 1 > 0:
-            suffix = '.0' 
-        if (volume % 1) == (self.get_syringe_pump_status(probe_num)[1] % 1):
+        block -- wait until the pump has accepted the volume, if False the
+                 command is only queued
+        """
+        if block:
+            self.wait_for_buffered()
+        syringe = self.syringe[probe_num]
+        self.ledger.check(probe_num, volume)
+        self.buffered(PUMP_402.dispense(syringe.letter, volume),
+                      syringe.device_id)
+        syringe.next_operation = volume
+        if not block:
             return
-        self.buffered(('D%s' % (probe_letter)) + str(volume) + suffix, 
-                      device_id)
-        self.syringe[probe_num]['next_operation'] = volume
+        self.queue.drain(syringe.device_id)
         while self.get_syringe_pump_status(probe_num)[0] != 'H':
             self.sleep(.05, '[aspirate block]')
     
@@ -786,30 +823,86 @@ class QuadZDevice():
         Arguments:
         probe_num -- assigned probe number of the syringe pump
         both -- True to start both syringes, False to move only one
+        block -- wait until the stroke has finished
+        
+        Returns:
+        strokes.StrokeHandle of the started stroke
         """
-        self.wait_for_buffered()
-        device_id = self.syringe[probe_num]['device_id']
+        if block:
+            self.wait_for_buffered()
+        syringe = self.syringe[probe_num]
+        device_id = syringe.device_id
         if both:
-            syringe = 'B'
+            letter = 'B'
+            probes = [syringe.left_probe, syringe.right_probe]
         else:
-            syringe = 'L'
-            if self.syringe[probe_num]['side'] is 'right':
-                syringe = 'R'
-        self.buffered('B' + syringe, device_id)
-        while block:
-            status = self.immediate('M', device_id)
-            res = re.match(r"(?P<left>[A-Z])(?P<lvol>[0-9\.]+)" +
-                           r"(?P<right>[A-Z])(?P<rvol>[\.0-9]+)", status)
-            if syringe == 'B' and res.group('left') != 'R' and \
-                                        res.group('right') != 'R':
-                break
-            elif syringe == 'L' and res.group('left') != 'R':
-                break
-            elif syringe == 'R' and res.group('right') != 'R':
-                break
-            self.sleep(self.time_delay, parent='start pump delay')
-        self.sleep(self.time_delay, parent='pump fin delay')
-        return
+            letter = syringe.letter
+            probes = [probe_num]
+        durations = {}
+        for probe in probes:
+            volume = self.syringe[probe].next_operation
+            durations[probe] = self.stroke_timer.predict(probe, volume)
+            self.ledger.record(probe)
+        queued = self.clock.time()
+        self.buffered(PUMP_402.start(letter), device_id)
+        handle = StrokeHandle(self, {device_id: (probes, letter)}, durations,
+                              queued)
+        if block:
+            # The last status poll reconciles the ledger for free
+            handle.wait()
+            self.sleep(self.time_delay, parent='pump fin delay')
+        return handle
+    
+    def start_syringe_pumps(self, volumes):
+        """
+        Set the volumes of several syringes and start them without waiting
+        
+        The volume and start commands of each pump are queued as one batch,
+        so all syringes are set up in one pass of commands and the syringes
+        of a pump start together.
+        
+        Arguments:
+        volumes -- list of volumes to pipette from probe 1 to 4
+                   Positive values dispense, negative values aspirate
+        
+        Returns:
+        strokes.StrokeHandle of the started strokes
+        """
+        probes = [probe for probe, volume in enumerate(volumes, 1) if volume]
+        for probe in probes:
+            self.ledger.check(probe, volumes[probe - 1])
+        batches = {}
+        devices = []
+        durations = {}
+        for probe in probes:
+            syringe = self.syringe[probe]
+            volume = volumes[probe - 1]
+            durations[probe] = self.stroke_timer.predict(probe, volume)
+            if volume > 0:
+                frame = PUMP_402.dispense(syringe.letter, volume)
+            else:
+                frame = PUMP_402.aspirate(syringe.letter, -volume)
+            syringe.next_operation = volume
+            if syringe.device_id not in batches:
+                batches[syringe.device_id] = ([], [])
+                devices.append(syringe.device_id)
+            batches[syringe.device_id][0].append(probe)
+            batches[syringe.device_id][1].append(frame)
+        
+        strokes = {}
+        queued = self.clock.time()
+        for device_id in devices:
+            started, frames = batches[device_id]
+            if len(started) == 2:
+                letter = 'B'
+            else:
+                letter = self.syringe[started[0]].letter
+            for probe in started:
+                self.ledger.record(probe)
+            frames.append(PUMP_402.start(letter))
+            self.buffered_batch(frames, device_id)
+            strokes[device_id] = (started, letter)
+        return StrokeHandle(self, strokes, durations, queued)
         
     def set_motor_force(self, probe_num, amplitude):
         """
@@ -820,12 +913,10 @@ class QuadZDevice():
         amplitude -- integer value to set amplitude to
         """
         self.wait_for_buffered()
-        device_id = self.syringe[probe_num]['device_id']
-        syringe = 'L'
-        if self.syringe[probe_num]['side'] is 'right':
-            syringe = 'R'
-        self.buffered('F%s%i' % (syringe, amplitude), device_id)
-        self.syringe[probe_num]['motor_force'] = amplitude
+        syringe = self.syringe[probe_num]
+        self.buffered(PUMP_402.set_motor_force(syringe.letter, amplitude),
+                      syringe.device_id)
+        syringe.motor_force = amplitude
         
     def halt_syringe_pump(self, probe_num, both = False):
         """
@@ -836,14 +927,12 @@ class QuadZDevice():
         both -- True to halt both syringes, False to halt only one
         """
         self.wait_for_buffered()
-        device_id = self.syringe[probe_num]['device_id']
+        syringe = self.syringe[probe_num]
+        letter = 'B' if both else syringe.letter
+        self.buffered(PUMP_402.halt(letter), syringe.device_id)
+        self.ledger.invalidate(probe_num)
         if both:
-            syringe = 'B'
-        else:
-            syringe = 'L'
-            if self.syringe[probe_num]['side'] is 'right':
-                syringe = 'R'
-        self.buffered('N' + syringe, device_id)
+            self.ledger.invalidate(syringe.partner_probe)
         
     def initialize_syringe(self, probe_num, both = False, block = True):
         """
@@ -854,23 +943,21 @@ class QuadZDevice():
         both -- True to initialize both syringes, False to initialize only one
         """
         self.wait_for_buffered()
-        device_id = self.syringe[probe_num]['device_id']
+        syringe = self.syringe[probe_num]
+        letter = 'B' if both else syringe.letter
+        self.buffered(PUMP_402.initialize(letter), syringe.device_id)
+        self.ledger.invalidate(probe_num)
         if both:
-            syringe = 'B'
-        else:
-            syringe = 'L'
-            if self.syringe[probe_num]['side'] is 'right':
-                syringe = 'R'
-        self.buffered('O' + syringe, device_id)
+            self.ledger.invalidate(syringe.partner_probe)
         while block:
             self.sleep(self.time_delay)
             status= self.get_syringe_pump_status(probe_num)
             if status[0] is not 'I':
-                if both:
-                    status = self.get_syringe_pump_status(
-                                  self.syringe[probe_num]['partner_probe'])
-                    if status[0] is not 'I':
-                        return
+                if not both:
+                    return
+                status = self.get_syringe_pump_status(syringe.partner_probe)
+                if status[0] is not 'I':
+                    return
         
     def set_syringe_size(self, probe_num, volume, both = False):
         """
@@ -882,28 +969,20 @@ class QuadZDevice():
         both -- True to set both syringes, False to set only one
         """
         self.wait_for_buffered()
-        device_id = self.syringe[probe_num]['device_id']
-        if self.syringe[probe_num]['side'] is 'right':
-            pl = self.syringe[probe_num]['partner_probe']
-            pr = probe_num
-        else:
-            pl = probe_num
-            pr = self.syringe[probe_num]['partner_probe']
-        
+        syringe = self.syringe[probe_num]
         if both:
-            self.syringe[pl]['syringe_size'] = volume
-            self.syringe[pr]['syringe_size'] = volume
-            syringe = 'B'
-            self.syringe[probe_num]['size'] = volume
-            self.syringe[self.syringe[probe_num]['opposite']]['size'] = volume
+            letter = 'B'
+            with self.state.lock:
+                self.syringe[syringe.left_probe].syringe_size = volume
+                self.syringe[syringe.right_probe].syringe_size = volume
         else:
-            syringe = 'L'
-            if self.syringe[probe_num]['side'] is 'right':
-                syringe = 'R'
-                self.syringe[pr]['syringe_size'] = volume
-            else:
-                self.syringe[pl]['syringe_size'] = volume
-        self.buffered('P%s%i' % (syringe, volume), device_id)
+            letter = syringe.letter
+            syringe.syringe_size = volume
+        self.buffered(PUMP_402.set_syringe_size(letter, volume),
+                      syringe.device_id)
+        self.ledger.invalidate(probe_num)
+        if both:
+            self.ledger.invalidate(syringe.partner_probe)
     
     def set_syringe_flow_rate(self, probe_num, flow_rate):
         """
@@ -914,12 +993,10 @@ class QuadZDevice():
         flow_rate -- flow rate in mL/min
         """
         self.wait_for_buffered()
-        device_id = self.syringe[probe_num]['device_id']
-        syringe = 'L'
-        if self.syringe[probe_num]['side'] is 'right':
-            syringe = 'R'
-        self.syringe[probe_num]['flow_rate'] = flow_rate
-        self.buffered('S' + syringe + str(flow_rate), device_id)
+        syringe = self.syringe[probe_num]
+        syringe.flow_rate = flow_rate
+        self.buffered(PUMP_402.set_flow_rate(syringe.letter, flow_rate),
+                      syringe.device_id)
     
     def synchronize_syringe_pump(self, probe_num):
         """
@@ -929,11 +1006,8 @@ class QuadZDevice():
         probe_num -- assigned probe number of the syringe pump
         """
         self.wait_for_buffered()
-        device_id = self.syringe[probe_num]['device_id']
-        syringe = 'L'
-        if self.syringe[probe_num]['side'] is 'right':
-            syringe = 'R'
-        self.buffered('T' + syringe, device_id)
+        syringe = self.syringe[probe_num]
+        self.buffered(PUMP_402.synchronize(syringe.letter), syringe.device_id)
     
     def set_valve_status(self, probe_num, status, block = True):
         """
@@ -946,16 +1020,14 @@ class QuadZDevice():
                   False or 'R' - reservoir
         """
         self.wait_for_buffered()
-        device_id = self.syringe[probe_num]['device_id']
-        syringe = 'L'
-        if self.syringe[probe_num]['side'] is 'right':
-            syringe = 'R'
+        syringe = self.syringe[probe_num]
         valve_status = status
         if status != 'R' and status != 'N':
             valve_status = 'R'
             if status:
                 valve_status = 'N'
-        self.buffered('V' + syringe + valve_status, device_id)
+        self.buffered(PUMP_402.set_valve(syringe.letter, valve_status),
+                      syringe.device_id)
         while block:
             self.sleep(self.time_delay)
             status = self.get_valve_status(probe_num)
@@ -967,50 +1039,25 @@ class QuadZDevice():
             if status[i] == 'R' or status[i] == 'N':
                 self.set_valve_status(i+1, status[i])
         
-    def pump(self, volumes):
+    def pump(self, volumes, block = True):
         """
         Pump probes at the given volumes
         
+        The volumes are checked against the volume ledger before any command
+        is sent, the pumps are only queried while waiting for the strokes to
+        finish.
+        
         Arguments:
         volumes -- list of volumes to pipette from probe 1 to 4
                    Positive values dispense, negative values aspirate
-        """
-        starting_vol = []
-        for i in range(len(volumes)):
-            status, vol = self.get_syringe_pump_status(i+1)
-            starting_vol.append(vol)
-            if volumes[i] > 0:
-                if vol < volumes[i]:
-                    raise gexceptions.VolumeError('Syringe for probe # ' +
-                          str(i+1) + 'does not have enough volume to' +
-                           ' dispense ' + str(volumes[i]) + ' uL')
-                self.set_dispense_volume(i+1, volumes[i])
-                starting_vol[i] -= volumes[i]
-            else:
-                if vol > -volumes[i]:
-                    raise gexceptions.VolumeError('Syringe for probe # ' +
-                          str(i+1) + 'does not have enough volume to' +
-                          ' aspirate ' + str(volumes[i]) + ' uL')
-                self.set_aspirate_volume(i+1, abs(volumes[i]))
-                starting_vol[i] -= volumes[i]
-        
-        for device in self.syringe_devices:
-            self.buffered('BB', device)
-        
-        for i in range(len(volumes)):
-            running = False
-            while True:
-                self.sleep(self.time_delay)
-                status, vol = self.get_syringe_pump_status(i+1)
-                if status != 'R' and running:
-                    if int(vol) != int(starting_vol[i]):
-                        raise gexceptions.VolumeError('Probe #' + str(i+1) +
-                              ' did not pump desired volume')
-                else:
-                    if status == 'R':
-                        running = True
-                if int(vol) == int(starting_vol[i]):
-                    break
+        block -- wait for the strokes to finish, if False return the
+                 strokes.StrokeHandle without waiting
+        """
+        handle = self.start_syringe_pumps(volumes)
+        if not block:
+            return handle
+        handle.wait()
+        handle.check()
 
     def wait_for_buffered(self):
         self.queue.event_buffered.wait()
@@ -0,0 +1,322 @@
+"""
+Dependency graph scheduler that overlaps independent instrument operations.
+
+Every high level QuadZDevice call blocks until the instrument has finished
+it, so a refill of the probe 3/4 syringes waits for a gantry move or a probe
+1/2 dispense even though they use different hardware. The Scheduler takes
+operations together with the resources they use (gantry, the Z axis of each
+probe, each 402 syringe and valve) and runs operations that share no
+resource at the same time, each in its own thread. Operations that share a
+resource run in the order they were added.
+
+Resource names:
+    'gantry' -- x/y arm
+    'z1' - 'z4' -- Z axis of a probe
+    'syringe1' - 'syringe4' -- 402 syringe assigned to a probe
+    'valve1' - 'valve4' -- valve of that syringe
+
+Example:
+    scheduler = Scheduler(quadz)
+    scheduler.move_to(1000, 2000)
+    scheduler.move_probe(300, [1, 2])
+    scheduler.dispense(1, 100)
+    scheduler.dispense(2, 100)
+    scheduler.refill(3, 250)
+    scheduler.refill(4, 250)
+    report = scheduler.run()
+
+Tasks are timed with the clock of the QuadZDevice. On a clock.VirtualClock
+the task threads are registered as actors: the virtual time only moves when
+every running task is sleeping, so the report shows the overlap a real run
+would have. A task that waits for anything but the clock or the queue (e.g.
+a function of its own blocking on a lock) holds the virtual time still
+while it waits, and QuadZDevices with separate SerialQueues must not share
+one VirtualClock, see clock.py.
+"""
+import sys
+import threading
+from clock import SYSTEM as SYSTEM_CLOCK
+
+GANTRY = 'gantry'
+PROBES = (1, 2, 3, 4)
+
+
+def z(probe):
+    return 'z%i' % (probe)
+
+
+def syringe(probe):
+    return 'syringe%i' % (probe)
+
+
+def valve(probe):
+    return 'valve%i' % (probe)
+
+
+class Task(object):
+    """
+    One operation in the schedule
+
+    after holds the tasks that must finish first: the explicit dependencies
+    plus the previous task using each of the resources. start and end are
+    set when the task has run, in seconds since the start of the run.
+    """
+    __slots__ = ('name', 'function', 'args', 'kwargs', 'resources', 'after',
+                 'start', 'end')
+
+    def __init__(self, name, function, args, kwargs, resources, after):
+        self.name = name
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.resources = resources
+        self.after = after
+        self.start = None
+        self.end = None
+
+    def duration(self):
+        if self.end is None:
+            return 0.0
+        return self.end - self.start
+
+    def __repr__(self):
+        return '<Task %s [%s]>' % (self.name, ', '.join(self.resources))
+
+
+class Scheduler(object):
+    """
+    Runs operations concurrently on the devices they use
+
+    QuadZDevice serializes the serial traffic, so the threads only overlap
+    the time the instrument spends moving and pumping.
+
+    Arguments:
+    quadz -- QuadZDevice used by the operation helpers, its clock times the
+             tasks
+    max_workers -- maximum number of operations running at once
+    """
+    def __init__(self, quadz = None, max_workers = 8):
+        self.quadz = quadz
+        self.clock = getattr(quadz, 'clock', SYSTEM_CLOCK)
+        self.max_workers = max_workers
+        self.tasks = []
+        # Last task added for each resource
+        self.last = {}
+
+    def add(self, function, args = (), kwargs = None, resources = (),
+            after = (), name = None):
+        """
+        Add an operation
+
+        Arguments:
+        function -- function to call
+        args, kwargs -- arguments to call it with
+        resources -- names of the resources the operation uses
+        after -- tasks that must finish before this one starts
+        name -- name used in the report, by default the function name
+
+        Returns:
+        Task
+        """
+        resources = tuple(resources)
+        dependencies = list(after)
+        for resource in resources:
+            previous = self.last.get(resource)
+            if previous is not None and previous not in dependencies:
+                dependencies.append(previous)
+        if name is None:
+            name = getattr(function, '__name__', 'task')
+        task = Task(name, function, tuple(args), kwargs or {}, resources,
+                    dependencies)
+        for resource in resources:
+            self.last[resource] = task
+        self.tasks.append(task)
+        return task
+
+    ################################
+    ####                        ####
+    ####       Operations       ####
+    ####                        ####
+    ################################
+
+    def move_to(self, x, y, probe = 1, after = ()):
+        """
+        Move the gantry. The probes must not move in Z or pump through the
+        needle during the move, so every Z axis is used.
+        """
+        return self.add(self.quadz.move_to, (x, y, probe),
+                        resources=(GANTRY,) + tuple(map(z, PROBES)),
+                        after=after, name='move_to(%i, %i)' % (x, y))
+
+    def move_probe(self, height, probes, liquid_sensing = False, after = ()):
+        return self.add(self.quadz.move_probe, (height, list(probes),
+                                                liquid_sensing),
+                        resources=map(z, probes), after=after,
+                        name='move_probe(%i, %s)' % (height, list(probes)))
+
+    def aspirate(self, probe, volume, after = ()):
+        """
+        Aspirate through the needle, which holds the probe in place
+        """
+        return self.add(self.pump_operation, (probe, 'N', -volume),
+                        resources=(z(probe), syringe(probe), valve(probe)),
+                        after=after, name='aspirate(%i, %s)' %
+                                          (probe, str(volume)))
+
+    def dispense(self, probe, volume, after = ()):
+        """
+        Dispense through the needle, which holds the probe in place
+        """
+        return self.add(self.pump_operation, (probe, 'N', volume),
+                        resources=(z(probe), syringe(probe), valve(probe)),
+                        after=after, name='dispense(%i, %s)' %
+                                          (probe, str(volume)))
+
+    def refill(self, probe, volume, after = ()):
+        """
+        Aspirate system fluid through the reservoir valve. The probe is not
+        used, so the refill overlaps gantry moves and the other probes.
+        """
+        return self.add(self.pump_operation, (probe, 'R', -volume),
+                        resources=(syringe(probe), valve(probe)),
+                        after=after, name='refill(%i, %s)' %
+                                          (probe, str(volume)))
+
+    def pump_operation(self, probe, valve_status, volume):
+        """
+        Set the valve, set the volume and run the syringe
+
+        Arguments:
+        probe -- probe number of the syringe
+        valve_status -- 'N' for needle, 'R' for reservoir
+        volume -- positive to dispense, negative to aspirate
+        """
+        quadz = self.quadz
+        quadz.set_valve_status(probe, valve_status)
+        if volume < 0:
+            quadz.set_aspirate_volume(probe, -volume)
+        else:
+            quadz.set_dispense_volume(probe, volume)
+        quadz.start_syringe_pump(probe)
+
+    ################################
+    ####                        ####
+    ####       Execution        ####
+    ####                        ####
+    ################################
+
+    def run(self):
+        """
+        Run all added tasks and clear the schedule. If a task raises an
+        exception no new tasks are started, the running tasks are allowed to
+        finish and the exception is raised again.
+
+        Returns:
+        report dict, see report()
+        """
+        tasks = self.tasks
+        self.tasks = []
+        self.last = {}
+        clock = self.clock
+        condition = threading.Condition()
+        waiting = list(tasks)
+        scheduled = set(tasks)
+        done = set()
+        running = []
+        errors = []
+        started = clock.time()
+
+        def start_ready():
+            # Called holding the condition. A finishing task starts the
+            # tasks that waited for it before its thread ends, so the
+            # virtual clock never sees a moment without an awake actor.
+            if errors:
+                return
+            for task in list(waiting):
+                if len(running) >= self.max_workers:
+                    break
+                if all(dependency in done or dependency not in scheduled
+                       for dependency in task.after):
+                    waiting.remove(task)
+                    running.append(task)
+                    thread = threading.Thread(target=work, args=(task,),
+                                              name=task.name)
+                    thread.daemon = True
+                    clock.add_actor(thread)
+                    thread.start()
+
+        def work(task):
+            task.start = clock.time() - started
+            try:
+                task.function(*task.args, **task.kwargs)
+            except Exception:
+                with condition:
+                    errors.append(sys.exc_info())
+            task.end = clock.time() - started
+            with condition:
+                running.remove(task)
+                done.add(task)
+                start_ready()
+                condition.notify()
+
+        with condition:
+            start_ready()
+            while running:
+                condition.wait()
+        if errors:
+            error_type, error, trace = errors[0]
+            raise error_type, error, trace
+        return self.report(tasks, clock.time() - started)
+
+    def report(self, tasks, elapsed):
+        """
+        Summarize a run
+
+        Returns:
+        dict with:
+            elapsed -- seconds from the start to the end of the run
+            serial -- sum of the task durations, the time a blocking run
+                      would have taken
+            critical_path -- duration of the longest dependency chain, the
+                             shortest possible run time
+            critical_tasks -- names of the tasks on that chain
+            utilization -- critical_path / elapsed, 1.0 when the run was
+                           as short as its dependencies allow
+            speedup -- serial / elapsed
+            resources -- fraction of the run each resource was busy
+        """
+        finish = {}
+        previous = {}
+        for task in tasks:
+            # Tasks are added after their dependencies
+            longest = 0.0
+            previous[task] = None
+            for dependency in task.after:
+                if finish.get(dependency, 0.0) > longest:
+                    longest = finish[dependency]
+                    previous[task] = dependency
+            finish[task] = longest + task.duration()
+        critical = []
+        if tasks:
+            task = max(tasks, key=lambda task: finish[task])
+            critical_path = finish[task]
+            while task is not None:
+                critical.append(task.name)
+                task = previous[task]
+            critical.reverse()
+        else:
+            critical_path = 0.0
+        busy = {}
+        for task in tasks:
+            for resource in task.resources:
+                busy[resource] = busy.get(resource, 0.0) + task.duration()
+        serial = sum(task.duration() for task in tasks)
+        ratio = lambda value: value / elapsed if elapsed > 0 else 0.0
+        return {'elapsed': elapsed,
+                'serial': serial,
+                'critical_path': critical_path,
+                'critical_tasks': critical,
+                'utilization': ratio(critical_path),
+                'speedup': ratio(serial),
+                'resources': dict((resource, ratio(seconds))
+                                  for resource, seconds in busy.items())}
@@ -1,8 +1,11 @@
 import threading, Queue
-import gexceptions
 import time
+import gexceptions
 import logging
 import traceback
+import gcommands
+from clock import SYSTEM as SYSTEM_CLOCK
+from health import HealthMonitor
 
 class SerialQueue(threading.Thread):
     """
@@ -28,18 +31,21 @@ class SerialQueue(threading.Thread):
     LF = chr(int('0A', 16))
     CR = chr(int('0D', 16))
     
-    def __init__(self, device):
+    def __init__(self, device, max_buffered = 0, clock = None,
+                 health = None):
         # Set up logging
         log_format = '%(asctime)s %(levelname)s: %(message)s'
         log_formatter = logging.Formatter(log_format)
         log_handler = logging.StreamHandler()
         log_handler.setFormatter(log_formatter)
         self.log = logging.getLogger('pygilson')
-        self.log.addHandler(log_handler)
+        # Several queues (one per serial port) share the logger
+        if not self.log.handlers:
+            self.log.addHandler(log_handler)
         self.log.setLevel(logging.DEBUG)
         
         # Log flags tell the script which categories to log.
-        # sleep: used when time.sleep() is called
+        # sleep: used when sleep() is called
         # immediate_queue: used in the immediate instruction calls
         # buffered_queue: used in the buffered instruction calsl
         # immediate: logs sent immediate commands
@@ -74,12 +80,48 @@ class SerialQueue(threading.Thread):
         # this event blocks until a response is waiting in the queue
         self.event_immediate_response = threading.Event()
         
-        # Buffered instruction queue
-        self.queue_instructions = Queue.Queue(0)
+        # Buffered instruction queue, max_buffered limits the number of
+        # queued entries (0 for no limit)
+        self.queue_instructions = Queue.Queue(max_buffered)
+        
+        # Number of buffered commands queued or being sent, per device id
+        self.outstanding = {}
+        # Clock time the last buffered entry for each device id was sent
+        self.sent_times = {}
         
-        # Next immediate command to execute and its response
+        # Attempts after a transmission error before a buffered entry
+        # fails, and the errors of failed entries not yet raised, per
+        # device id (see fail_device())
+        self.buffered_retries = 1
+        self.failures = {}
+        self.condition_outstanding = threading.Condition()
+        
+        # Next immediate command to execute and its response. There is one
+        # slot, lock_immediate lets one calling thread use it at a time.
+        self.lock_immediate = threading.Lock()
         self.immediate_instruction = False
-        self.immediate_response = False
+        self.immediate_result = (0, False)
+        self.immediate_count = 0
+        
+        # Seconds an immediate instruction may take before the caller gets
+        # a RequestTimeout (None waits forever). The deadlines are enforced
+        # by the Supervisor, see supervise().
+        self.request_timeout = 30.0
+        
+        # Worker supervision: the thread serving the queue (replaced by
+        # restart()), the buffered entry it is sending and the wall clock
+        # time of its last serial traffic. The heartbeat and the stall check
+        # deliberately use time.time(), not self.clock: a stalled worker is
+        # a real thread hanging on a real port, and a virtual clock that
+        # only moves when the queue sleeps would never see it stall. The
+        # request and buffered deadlines use self.clock like the rest of
+        # the queue's timing.
+        self.worker = self
+        self.generation = 0
+        self.restarts = 0
+        self.current_entry = None
+        self.heartbeat = time.time()
+        self.supervisor = None
         
         # Stores last exception in queue thread
         self.last_exception = False
@@ -93,85 +135,333 @@ class SerialQueue(threading.Thread):
         
         # Queue timing variables
         # sleep_subtotal allows tracking the timing of arbitrary code
+        # time_delay is the delay between commands and switch_delay the
+        # delay after a disconnect, delays holds calibrated (time_delay,
+        # switch_delay) per device id, see calibration.py
         self.time_delay = .05
+        self.switch_delay = .1
+        self.delays = {}
+        
+        # Transmission errors: echo mismatches of buffered commands, null
+        # reads of immediate commands and failed connections
+        self.errors = {'echo': 0, 'null': 0, 'connect': 0}
         self.sleep_subtotal = 0
         self.sleep_total = 0
-        
         threading.Thread.__init__(self)
         
+        # Time source, e.g. a clock.VirtualClock for simulation
+        self.clock = clock or SYSTEM_CLOCK
+        self.clock.add_worker(self, self.working)
+        
+        # Success rate, latency and circuit breaker of each device
+        self.health = health or HealthMonitor(self.clock, log=self.log)
+        
+    def working(self):
+        """
+        True while the thread has instructions to send and is not held by
+        register_device()
+        """
+        return self.event_instruction.is_set() and \
+               self.event_buffer_lock.is_set()
+    
     def run(self):
+        # A worker thread stops when the supervisor replaced it, see
+        # restart()
+        generation = self.generation
         # Wait until there is an instruction to send
         # (This is essentially an infinite loop)
         while 1:
             self.event_instruction.wait()
             self.event_buffer_lock.wait()
+            if generation != self.generation:
+                return
+            self.heartbeat = time.time()
             self.event_lock.clear()
-            
-            if self.immediate_instruction != False:
-                device_id = self.immediate_instruction[0]
-                if self.log_flags['worker']:
-                    self.log.debug(' --- Immediate Queue: %25s -> %-25s' %
-                                   (self.immediate_instruction[3], 
-                                    self.immediate_instruction[1]))
-                try:
-                    self.establish_connection(device_id)
-                except gexceptions.DeviceNotResponding, e:
-                    self.immediate_response = False
-                    self.event_immediate_response.set()
-                    self.immediate_instruction = False
-                    self.last_exception = e
-                else:
-                    try:
-                        r = self.send_immediate_instruction(
-                                        self.immediate_instruction[1],
-                                        parent=self.immediate_instruction[3])
-                    except Exception, e:
-                        # TODO: Add code to handle common exceptions for serial
-                        self.immediate_response = False
-                        self.immediate_instruction = False
-                        self.last_exception = e
-                    else:
-                        self.immediate_response = r
-                        self.immediate_instruction = False
-                    self.event_immediate_response.set()
-                # Due to limitations of the Gilson computer, there needs to be
-                # a delay before another command is sent
-                self.sleep(self.time_delay, parent='[queue_loop_delay]')
-            # Buffered commands
-            if not self.queue_instructions.empty():
-                instruction = self.queue_instructions.get()
-                device_id = instruction[0]
-                if self.log_flags['worker']:
-                    self.log.debug(' ---  Buffered Queue: %25s -> %-25s' %
-                                   (instruction[3], instruction[1]))
-                try:
-                    self.establish_connection(device_id)
-                    # This section of code uses proper command to see if 
-                    # device queue is empty
-                    if instruction[2] == 'handler':
-                        while self.send_immediate_instruction('S',
-                            parent='[check_quadz_buffer]') != '|':
-                            self.sleep(self.time_delay, 'buffer_delay')
-                    elif instruction[2] == 'pump':
-                        while self.send_immediate_instruction('S',
-                            parent='[check_syringe_buffer]')[0] != '0':
-                            self.sleep(self.time_delay, 'buffer_delay')
-                except gexceptions.DeviceNotResponding, e:
-                    # TODO: Add code to handle common exceptions for serial
-                    self.queue_instructions.task_done()
-                    self.last_exception = e
-                else:
-                    self.send_buffered_instruction(instruction[1],
-                                                   parent=instruction[3])
-                    self.queue_instructions.task_done()
-            elif self.immediate_instruction == False:
-                self.event_instruction.clear()
+            try:
+                request = self.immediate_instruction
+                if request != False:
+                    device_id = self.run_immediate(request, generation)
+                    if generation != self.generation:
+                        return
+                    # Due to limitations of the Gilson computer, there
+                    # needs to be a delay before another command is sent
+                    self.sleep(self.get_delays(device_id)[0],
+                               parent='[queue_loop_delay]')
+                # Buffered commands
+                if not self.queue_instructions.empty():
+                    self.run_buffered(generation)
+                elif self.immediate_instruction == False:
+                    self.event_instruction.clear()
+                    # An instruction added between the check and the clear
+                    # would otherwise never wake the worker
+                    if self.immediate_instruction != False or \
+                       not self.queue_instructions.empty():
+                        self.event_instruction.set()
+            except Exception, e:
+                # Keep the worker alive whatever went wrong
+                if generation != self.generation:
+                    return
+                self.last_exception = e
+                self.log.error('SerialQueue worker: %s: %s' %
+                               (e.__class__.__name__, str(e)))
+                self.resync()
+            if generation != self.generation:
+                return
             self.event_lock.set()
-            self.sleep(self.time_delay, parent='[queue_loop_delay]')
+            self.sleep(self.get_delays()[0], parent='[queue_loop_delay]')
+    
+    def run_immediate(self, request, generation):
+        """
+        Send the immediate instruction waiting in the slot
+        
+        Returns:
+        device id of the instruction
+        """
+        device_id, instruction, sequence, parent, deadline = request
+        if self.log_flags['worker']:
+            self.log.debug(' --- Immediate Queue: %25s -> %-25s' %
+                           (parent, instruction))
+        error = None
+        try:
+            self.establish_connection(device_id)
+            start = self.clock.time()
+            response = self.send_immediate_instruction(instruction,
+                                                       parent=parent)
+        except gexceptions.DeviceNotResponding, e:
+            error = e
+        except Exception, e:
+            # TODO: Add code to handle common exceptions for serial
+            error = e
+            self.health.failure(device_id)
+            self.resync()
+        else:
+            self.health.success(device_id, self.clock.time() - start)
+        if generation != self.generation:
+            return device_id
+        if error is not None:
+            self.last_exception = error
+            response = False
+        self.finish_immediate(request, response)
+        return device_id
+    
+    def finish_immediate(self, request, response):
+        """
+        Hand the response of an immediate request to the waiting caller
+        """
+        self.immediate_result = (request[2], response)
+        if self.immediate_instruction is request:
+            self.immediate_instruction = False
+        self.event_immediate_response.set()
+    
+    def run_buffered(self, generation):
+        """
+        Send the next entry of the buffered queue. After a transmission
+        error the connection is resynchronised and the entry is sent again
+        from the failed command, up to buffered_retries times. An entry that
+        still fails, or misses its deadline, fails its device: see
+        fail_device().
+        """
+        entry = self.queue_instructions.get()
+        self.current_entry = entry
+        device_id, batch, wait, parent, deadline = entry
+        if self.log_flags['worker']:
+            self.log.debug(' ---  Buffered Queue: %25s -> %-25s' %
+                           (parent, batch))
+        # A batch (tuple of instructions) is sent without reconnecting or
+        # interleaving other instructions
+        if not isinstance(batch, tuple):
+            batch = (batch,)
+        sent = 0
+        retries = 0
+        while 1:
+            try:
+                if deadline is not None and self.clock.time() > deadline:
+                    raise gexceptions.RequestTimeout(device_id,
+                        'Buffered instruction %s expired before it was '
+                        'sent' % (str(batch[sent])))
+                self.establish_connection(device_id)
+                while sent < len(batch):
+                    self.wait_for_device_buffer(wait)
+                    self.send_buffered_instruction(batch[sent],
+                                                   parent=parent)
+                    sent += 1
+                self.sent_times[device_id] = self.clock.time()
+                break
+            except Exception, e:
+                if generation != self.generation:
+                    return
+                transient = not isinstance(e, (
+                    gexceptions.DeviceNotResponding,
+                    gexceptions.RequestTimeout))
+                if transient:
+                    self.log.error('Buffered instruction %s failed: %s: %s'
+                                   % (str(batch[sent]), e.__class__.__name__,
+                                      str(e)))
+                    self.health.failure(device_id)
+                    self.resync()
+                if transient and retries < self.buffered_retries:
+                    retries += 1
+                    continue
+                self.fail_device(device_id, e)
+                self.event_buffered.set()
+                break
+        if generation != self.generation:
+            return
+        self.current_entry = None
+        self.queue_instructions.task_done()
+        self.finish_outstanding(entry)
+    
+    def fail_device(self, device_id, error):
+        """
+        Cancel the queued buffered instructions of a device whose buffered
+        instruction failed, so a motion sequence does not go on with a
+        missing step. The error is raised by the next instruction added
+        for the device.
+        """
+        self.last_exception = error
+        self.failures[device_id] = error
+        cancelled = self.cancel(device_id)
+        self.log.error('Device %i failed (%s: %s), %i queued instructions '
+                       'cancelled' % (device_id, error.__class__.__name__,
+                                      str(error), cancelled))
+    
+    def check_failure(self, device_id):
+        """
+        Raise the error of a failed buffered instruction for a device, once
+        """
+        error = self.failures.pop(device_id, None)
+        if error is not None:
+            raise error
+    
+    ################################
+    ####                        ####
+    ####      Supervision       ####
+    ####                        ####
+    ################################
+    
+    def supervise(self, interval = 1.0, stall_timeout = 30.0):
+        """
+        Start a Supervisor that restarts the worker if it dies or stalls.
+        Call after start().
+        
+        Returns:
+        Supervisor
+        """
+        self.supervisor = Supervisor(self, interval, stall_timeout)
+        self.supervisor.start()
+        return self.supervisor
+    
+    def stalled(self, stall_timeout):
+        """
+        True if the worker has had work but no serial traffic for
+        stall_timeout seconds
+        """
+        return self.working() and self.event_lock.is_set() == False and \
+               time.time() - self.heartbeat > stall_timeout
+    
+    def resync(self):
+        """
+        Forget the connected device and discard unread input, so the next
+        instruction disconnects and reconnects
+        """
+        self.connected_device = None
+        flush = getattr(self.device, 'reset_input_buffer', None) or \
+                getattr(self.device, 'flushInput', None)
+        if flush is not None:
+            try:
+                flush()
+            except Exception:
+                pass
+    
+    def restart(self):
+        """
+        Replace the worker thread. The entry and the immediate request in
+        flight fail, the connection is resynchronised and a new thread
+        serves the queue. A stalled thread stops as soon as it returns from
+        the call it is blocked in.
+        """
+        self.generation += 1
+        self.restarts += 1
+        entry = self.current_entry
+        self.current_entry = None
+        if entry is not None:
+            self.queue_instructions.task_done()
+            self.finish_outstanding(entry)
+            self.fail_device(entry[0], gexceptions.RequestTimeout(entry[0],
+                'Worker restarted while sending %s' % (str(entry[1]))))
+        request = self.immediate_instruction
+        if request != False:
+            self.last_exception = gexceptions.RequestTimeout(request[0],
+                'Worker restarted while sending %s' % (str(request[1])))
+            self.finish_immediate(request, False)
+        self.resync()
+        self.event_lock.set()
+        if self.queue_instructions.empty():
+            self.event_buffered.set()
+        self.heartbeat = time.time()
+        worker = threading.Thread(target=self.run, name='%s-%i' %
+                                  (self.name, self.generation))
+        worker.daemon = self.daemon
+        self.clock.add_worker(worker, self.working)
+        self.worker = worker
+        worker.start()
+        # Wake the new worker if instructions are waiting
+        if self.immediate_instruction != False or \
+           not self.queue_instructions.empty():
+            self.event_instruction.set()
 
+    def wait_for_device_buffer(self, wait):
+        """
+        Poll the connected device until its command buffer can accept
+        another buffered instruction
+        
+        Arguments:
+        wait -- "handler" or "pump", see add_buffered_instruction()
+        """
+        # This section of code uses proper command to see if 
+        # device queue is empty
+        if wait == 'handler':
+            while self.send_immediate_instruction('S',
+                parent='[check_quadz_buffer]') != '|':
+                self.sleep(self.get_delays()[0], 'buffer_delay')
+        elif wait == 'pump':
+            while self.send_immediate_instruction('S',
+                parent='[check_syringe_buffer]')[0] != '0':
+                self.sleep(self.get_delays()[0], 'buffer_delay')
+
+    def get_delays(self, device_id = None):
+        """
+        Get the delays for a device
+        
+        Arguments:
+        device_id -- device id, None for the connected device
+        
+        Returns:
+        (time_delay, switch_delay)
+        """
+        if device_id is None:
+            device_id = self.connected_device
+        return self.delays.get(device_id, (self.time_delay,
+                                           self.switch_delay))
+    
+    def set_delays(self, device_id, time_delay, switch_delay):
+        """
+        Set the delays for a device. A delay of None keeps its current
+        value, with both None the device uses the default delays again.
+        """
+        if time_delay is None and switch_delay is None:
+            self.delays.pop(device_id, None)
+            return
+        default_time, default_switch = self.get_delays(device_id)
+        if time_delay is None:
+            time_delay = default_time
+        if switch_delay is None:
+            switch_delay = default_switch
+        self.delays[device_id] = (time_delay, switch_delay)
+    
     def sleep(self, seconds, parent = None, top_parent = None):
         """
-        Wrapper for time.sleep which logs delays
+        Wrapper for the clock's sleep which logs delays
         
         Arguments:
         seconds -- number of seconds to wait
@@ -192,7 +482,7 @@ class SerialQueue(threading.Thread):
                 self.log.debug('%25s -> %-29s Sleep:    %ss (total: %ss)' % 
                                (top_parent, parent, str(seconds),
                                 str(self.sleep_subtotal)))
-        time.sleep(seconds)
+        self.clock.sleep(seconds)
     
     ################################
     ####                        ####
@@ -211,7 +501,7 @@ class SerialQueue(threading.Thread):
             raise gexceptions.DeviceNotRegistered(device_id)
         elif self.connected_device == device_id:
             return True
-        device_byte = chr(device_id + 128)
+        device_byte = gcommands.select_byte(device_id)
         trace = traceback.extract_stack(limit=3)
         parent = trace[-2][2]
         if parent == 'establish_connection':
@@ -227,8 +517,8 @@ class SerialQueue(threading.Thread):
         
         self.connected_device = device_id
         if self.log_flags["devices"]:
-            self.sleep(.1, parent='connect[%i]' % (device_id),
-                       top_parent=parent)
+            self.sleep(self.get_delays(device_id)[1],
+                       parent='connect[%i]' % (device_id), top_parent=parent)
         return True
             
     def disconnect(self):
@@ -241,13 +531,13 @@ class SerialQueue(threading.Thread):
             parent = trace[-3][2]
         if self.log_flags["devices"]:
             self.log.debug('%25s -> %-25s  DConnect:  > %s' % (parent,
-                                                               'disconnect',
-                                                               str(chr(255))))
-        self.send(chr(255))
+                                                    'disconnect',
+                                                    str(gcommands.DISCONNECT)))
+        self.send(gcommands.DISCONNECT)
         device_id = -1 if self.connected_device == None\
                        else self.connected_device
-        self.sleep(.1, parent='disconnect[%i]' % (device_id),
-                   top_parent=parent)
+        self.sleep(self.get_delays(self.connected_device)[1],
+                   parent='disconnect[%i]' % (device_id), top_parent=parent)
         self.connected_device = None
     
     def close(self):
@@ -260,6 +550,7 @@ class SerialQueue(threading.Thread):
         """
         Send a single character
         """
+        self.heartbeat = time.time()
         return self.device.write(char)
 
     def get_byte(self):
@@ -283,23 +574,35 @@ class SerialQueue(threading.Thread):
         self.event_buffer_lock.set()
         return True
         
-    def establish_connection(self, dev_id, max_retries = 10):
+    def establish_connection(self, dev_id, max_retries = None):
         """
-        Disconnect from current device and connect to new one
+        Disconnect from current device and connect to new one. Attempts
+        after the first wait an exponential backoff with jitter, and a
+        device whose circuit is open fails at once with CircuitOpen.
         
         Arguments:
         device_id -- device id to connect to
-        max_retries -- number of times to retry connection
+        max_retries -- number of connection attempts, by default
+                       health.max_retries
         """
+        self.health.check(dev_id)
         if self.connected_device == dev_id:
             return True
+        if max_retries is None:
+            max_retries = self.health.max_retries
+        start = self.clock.time()
         for i in range(max_retries):
+            if i:
+                self.sleep(self.health.backoff(i),
+                           parent='reconnect[%i]' % (dev_id))
             self.disconnect()
             try:
                 if self.connect(dev_id):
+                    self.health.success(dev_id, self.clock.time() - start)
                     return True
             except gexceptions.DeviceNotConnected:
-                pass
+                self.errors['connect'] += 1
+        self.health.failure(dev_id)
         raise gexceptions.DeviceNotResponding(dev_id)
     
     ################################
@@ -309,36 +612,87 @@ class SerialQueue(threading.Thread):
     ####                        ####
     ################################
     
-    def add_immediate_instruction(self, device_id, instruction):
+    def add_immediate_instruction(self, device_id, instruction,
+                                  timeout = None):
         """
         Add immediate instruction to the queue
         
         Arguments:
         device_id -- device to send to
         instruction -- instruction to send
+        timeout -- seconds to wait for the response, by default
+                   request_timeout (only enforced while supervised)
         
         Returns:
-        result of immediate command (blocks until there is a response)
+        result of immediate command (blocks until there is a response),
+        False if it failed, timed out (last_exception is a RequestTimeout)
+        or the device's circuit is open. Raises the error of a failed
+        buffered instruction for the device, see fail_device().
         """
+        self.check_failure(device_id)
+        if self.health.is_open(device_id):
+            self.last_exception = gexceptions.CircuitOpen(device_id,
+                'Circuit for device %i is open' % (device_id))
+            return False
+        if timeout is None:
+            timeout = self.request_timeout
+        with self.lock_immediate:
+            return self.queue_immediate(device_id, instruction, timeout)
+    
+    def queue_immediate(self, device_id, instruction, timeout = None):
+        if not self.working():
+            self.heartbeat = time.time()
         self.event_buffered.clear()
-        trace = traceback.extract_stack(limit=4)
-        parent_func = trace[-2][2]
+        trace = traceback.extract_stack(limit=5)
+        parent_func = trace[-3][2]
         if parent_func == 'immediate':
-            parent_func = trace[-3][2]
+            parent_func = trace[-4][2]
         
         if self.log_flags['immediate_queue']:
             self.log.debug('%25s -> %-25s     Queue: +I %s' % (parent_func,
                            'add_immediate_cmd', str(instruction)))
-        self.immediate_instruction = (device_id, instruction, 0, parent_func)
-        self.event_instruction.set()
-        self.event_immediate_response.wait()
-        response = self.immediate_response
-        self.immediate_response = False
+        # The sequence number tells this request's response from the late
+        # response of a request that timed out
+        self.immediate_count += 1
+        sequence = self.immediate_count
+        deadline = None
+        if timeout is not None:
+            deadline = self.clock.time() + timeout
+        request = (device_id, instruction, sequence, parent_func, deadline)
         self.event_immediate_response.clear()
+        self.immediate_instruction = request
+        self.event_instruction.set()
+        # A timed wait polls in Python 2 and would delay every response,
+        # expire() ends the wait instead
+        while 1:
+            self.event_immediate_response.wait()
+            self.event_immediate_response.clear()
+            result_sequence, response = self.immediate_result
+            if result_sequence == sequence:
+                break
         self.event_buffered.set()
         return response
     
-    def add_buffered_instruction(self, device_id, instruction, wait='handler'):
+    def expire(self):
+        """
+        Fail the immediate instruction if it is past its deadline. The
+        worker may still be sending it, its late response is discarded.
+        
+        Returns:
+        True if the instruction expired
+        """
+        request = self.immediate_instruction
+        if request == False or request[4] is None or \
+           self.clock.time() < request[4]:
+            return False
+        self.last_exception = gexceptions.RequestTimeout(request[0],
+            'No response to %s in time' % (str(request[1])))
+        self.finish_immediate(request, False)
+        return True
+    
+    def add_buffered_instruction(self, device_id, instruction, wait='handler',
+                                 block = True, timeout = None,
+                                 deadline = None):
         """
         Add buffered instruction to the queue
         
@@ -348,8 +702,14 @@ class SerialQueue(threading.Thread):
         wait -- string identifying what character represents an empty buffer
                 "handler" for Gilson liquid handler (default)
                 "pump" for 402 syringe pump
+        block -- if the queue is full, wait for a free slot (True) or raise
+                 QueueFull immediately (False)
+        timeout -- seconds to wait for a free slot before raising QueueFull
+                   (None waits forever)
+        deadline -- seconds the instruction may wait in the queue, if it is
+                    not sent by then it is dropped and last_exception is a
+                    RequestTimeout (None waits forever)
         """
-        self.event_buffered.clear()
         trace = traceback.extract_stack(limit=4)
         parent_func = trace[-2][2]
         if parent_func == 'buffered':
@@ -358,19 +718,178 @@ class SerialQueue(threading.Thread):
         if self.log_flags['buffered_queue']:
             self.log.debug('%25s -> %-25s     Queue: +B %s' % (parent_func,
                            'add_buffered_cmd', str(instruction)))
-        self.queue_instructions.put((device_id, instruction, wait, parent_func))
+        self.put_buffered((device_id, instruction, wait, parent_func,
+                           self.expires(deadline)), 1, block, timeout)
+    
+    def add_buffered_instructions(self, device_id, instructions,
+                                  wait='handler', block = True,
+                                  timeout = None, deadline = None):
+        """
+        Add a batch of buffered instructions to the queue. The batch is sent
+        in one pass: the worker connects to the device once and no other
+        instruction is sent between the instructions of the batch.
+        
+        Arguments:
+        device_id -- device to send to
+        instructions -- list of instructions to send
+        wait, block, timeout, deadline -- see add_buffered_instruction()
+        """
+        instructions = tuple(instructions)
+        if not instructions:
+            return
+        trace = traceback.extract_stack(limit=4)
+        parent_func = trace[-2][2]
+        if parent_func == 'buffered_batch':
+            parent_func = trace[-3][2]
+            
+        if self.log_flags['buffered_queue']:
+            self.log.debug('%25s -> %-25s     Queue: +B %s' % (parent_func,
+                           'add_buffered_cmds',
+                           ' '.join(map(str, instructions))))
+        self.put_buffered((device_id, instructions, wait, parent_func,
+                           self.expires(deadline)), len(instructions), block,
+                          timeout)
+    
+    def expires(self, deadline):
+        """
+        Get the clock time a buffered entry expires, None if it never does
+        """
+        if deadline is None:
+            return None
+        return self.clock.time() + deadline
+    
+    def put_buffered(self, entry, count, block, timeout):
+        """
+        Put an entry in the buffered queue and count its commands as
+        outstanding for the device. Raises CircuitOpen if the device's
+        circuit is open and the error of a failed buffered instruction for
+        the device, see fail_device().
+        """
+        device_id = entry[0]
+        self.check_failure(device_id)
+        if self.health.is_open(device_id):
+            raise gexceptions.CircuitOpen(device_id, 'Circuit for device %i '
+                                          'is open' % (device_id))
+        with self.condition_outstanding:
+            self.outstanding[device_id] = \
+                self.outstanding.get(device_id, 0) + count
+        if not self.working():
+            self.heartbeat = time.time()
+        was_buffered = self.event_buffered.is_set()
+        self.event_buffered.clear()
+        try:
+            self.queue_instructions.put(entry, block, timeout)
+        except Queue.Full:
+            if was_buffered:
+                self.event_buffered.set()
+            self.finish_outstanding(entry)
+            raise gexceptions.QueueFull(device_id,
+                                        'Buffered instruction queue is full')
         self.event_instruction.set()
     
+    def finish_outstanding(self, entry):
+        """
+        Remove the commands of a sent or dropped queue entry from the
+        outstanding count
+        """
+        count = 1
+        if isinstance(entry[1], tuple):
+            count = len(entry[1])
+        with self.condition_outstanding:
+            self.outstanding[entry[0]] -= count
+            self.condition_outstanding.notify_all()
+    
+    def pending(self, device_id = None):
+        """
+        Get the number of buffered commands that are queued or being sent
+        
+        Arguments:
+        device_id -- device to count commands for, None for all devices
+        """
+        with self.condition_outstanding:
+            if device_id is None:
+                return sum(self.outstanding.values())
+            return self.outstanding.get(device_id, 0)
+    
+    def cancel(self, device_id):
+        """
+        Remove all queued buffered commands for a device. A command that the
+        worker is already sending is not interrupted.
+        
+        Arguments:
+        device_id -- device to cancel commands for
+        
+        Returns:
+        number of cancelled commands
+        """
+        queue = self.queue_instructions
+        with queue.mutex:
+            cancelled = [entry for entry in queue.queue
+                         if entry[0] == device_id]
+            if not cancelled:
+                return 0
+            remaining = [entry for entry in queue.queue
+                         if entry[0] != device_id]
+            queue.queue.clear()
+            queue.queue.extend(remaining)
+            queue.unfinished_tasks -= len(cancelled)
+            if not queue.unfinished_tasks:
+                queue.all_tasks_done.notify_all()
+            queue.not_full.notify_all()
+        count = 0
+        for entry in cancelled:
+            self.finish_outstanding(entry)
+            count += len(entry[1]) if isinstance(entry[1], tuple) else 1
+        # put_buffered() cleared event_buffered, an entry in flight sets it
+        # again once it is sent
+        if queue.empty() and self.current_entry is None:
+            self.event_buffered.set()
+        if self.log_flags['buffered_queue']:
+            self.log.debug('%25s -> %-25s     Queue: -B %i commands' %
+                           ('cancel', 'device %i' % (device_id), count))
+        return count
+    
+    def drain(self, device_id = None, timeout = None):
+        """
+        Wait until all buffered commands for a device have been sent
+        
+        Arguments:
+        device_id -- device to wait for, None for all devices
+        timeout -- maximum number of seconds to wait (None waits forever)
+        
+        Returns:
+        True if the commands were sent, False if the timeout expired
+        """
+        if timeout is not None:
+            end = self.clock.time() + timeout
+        with self.condition_outstanding:
+            while self.pending(device_id):
+                if timeout is None:
+                    self.condition_outstanding.wait()
+                else:
+                    remaining = end - self.clock.time()
+                    if remaining <= 0:
+                        return False
+                    # The wait is in real time, a virtual clock advances
+                    # while the queue thread sends
+                    self.condition_outstanding.wait(min(remaining,
+                                                        self.time_delay))
+        return True
+    
     def send_buffered_instruction(self, instruction, parent = ''):
         """
         Send buffered instrument
         
         Keyword Arguments:
-        instruction -- Instruction to post to send to instrument
+        instruction -- Instruction to post to send to instrument, either a
+                       string or a precompiled gcommands.Frame
         """
         # Buffered commands sent to the instrument are returned byte by byte
         # LF and CR are added to the command when returned
-        command = self.LF + instruction + self.CR
+        if isinstance(instruction, gcommands.Frame):
+            command = instruction.wire
+        else:
+            command = self.LF + instruction + self.CR
         parent_func = traceback.extract_stack(limit=2)[-2][2]
         if self.log_flags["buffered"]:
             self.log.debug('%25s -> %-25s  Buffered:  > %s' % (parent_func,
@@ -381,6 +900,7 @@ class SerialQueue(threading.Thread):
             # If the instrument returns anything but the command sent to
             # it, it means that the call failed
             if self.get_byte() != char:
+                self.errors['echo'] += 1
                 self.event_buffered.set()
                 raise gexceptions.BufferedResponseError()
             response += char
@@ -394,8 +914,11 @@ class SerialQueue(threading.Thread):
         Send immediate instruction and return response
         
         Keyword Arguments:
-        instruction -- Instruction to send immediately
+        instruction -- Instruction to send immediately, either a string or a
+                       precompiled gcommands.Frame
         """
+        if isinstance(instruction, gcommands.Frame):
+            instruction = instruction.wire
         count = 0
         null_count = 0
         response = ''
@@ -411,6 +934,7 @@ class SerialQueue(threading.Thread):
                                                     ' was over 32 characters')
             # If the device sends a string of null characters, call failed
             if null_count > self.max_null_count:
+                self.errors['null'] += 1
                 raise gexceptions.ResponseSizeError('Reponse string' + 
                                                 'contained was over 5 nulls')
             # acknowledgement byte is required before device sends more data
@@ -431,4 +955,77 @@ class SerialQueue(threading.Thread):
                     response += response_char
             else:
                 null_count += 1
-            count += 1
\ No newline at end of file
+            count += 1
+
+
+class Supervisor(threading.Thread):
+    """
+    Watchdog for a SerialQueue worker. Immediate instructions past their
+    deadline fail with RequestTimeout, and the worker is restarted if its
+    thread died or if it has had instructions but no serial traffic for
+    stall_timeout seconds (e.g. a read without timeout on a hung port).
+    Devices whose open circuit may be tried again get a health check, see
+    HealthMonitor.probe().
+    
+    Arguments:
+    queue -- SerialQueue
+    interval -- seconds between checks
+    stall_timeout -- seconds without traffic after which the worker is
+                     considered hung
+    """
+    def __init__(self, queue, interval = 1.0, stall_timeout = 30.0):
+        threading.Thread.__init__(self, name='SerialQueueSupervisor')
+        self.daemon = True
+        self.queue = queue
+        self.interval = interval
+        self.stall_timeout = stall_timeout
+        self.event_stop = threading.Event()
+        self.prober = None
+    
+    def check(self):
+        """
+        Fail an overdue immediate instruction and restart the worker if it
+        died or stalled
+        
+        Returns:
+        True if the worker was restarted
+        """
+        queue = self.queue
+        queue.expire()
+        self.probe()
+        worker = queue.worker
+        if worker.ident is not None and not worker.is_alive():
+            reason = 'worker thread died'
+        elif queue.stalled(self.stall_timeout):
+            reason = 'no serial traffic for %.1f s' % (time.time() -
+                                                      queue.heartbeat)
+        else:
+            return False
+        queue.log.error('SerialQueue supervisor: %s, restarting worker '
+                        '(restart %i)' % (reason, queue.restarts + 1))
+        queue.restart()
+        return True
+    
+    def probe(self):
+        """
+        Send the health checks in their own thread: a device that is still
+        dead takes several connection attempts, during which the supervisor
+        keeps expiring requests
+        """
+        if self.prober is not None and self.prober.is_alive():
+            return
+        health = self.queue.health
+        if not health.due():
+            return
+        self.prober = threading.Thread(target=health.probe,
+                                       args=(self.queue,),
+                                       name='SerialQueueProbe')
+        self.prober.daemon = True
+        self.prober.start()
+    
+    def run(self):
+        while not self.event_stop.wait(self.interval):
+            self.check()
+    
+    def stop(self):
+        self.event_stop.set()
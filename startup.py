@@ -0,0 +1,202 @@
+"""
+Instrument profiles for a fast warm start.
+
+A cold start registers every device, checks the pump versions, sets the
+syringe sizes and flow rates and reads the travel ranges, which takes
+several seconds of serial traffic. InstrumentProfile stores the result of a
+cold start: the devices with their firmware versions, the probe to pump
+assignment, the ranges, the probe width, the syringe sizes and flow rates
+and the calibrated delays. On the next start the profile is verified with
+one version request per device; if every device answers with the version
+it had, the profile is applied to the QuadZDevice without any further
+commands.
+
+The syringe settings are kept by the pumps while they are powered. A pump
+that was switched off keeps its version, so remove the profile (or pass
+cold=True) after power cycling a pump.
+
+Example:
+    def configure(quadz):
+        quadz.initialize_device(22)
+        quadz.add_402_syringe_pump(0, 1, 2)
+        quadz.add_402_syringe_pump(1, 3, 4)
+        for probe in PROBES:
+            quadz.set_syringe_size(probe, 250)
+
+    quadz = QuadZDevice(com_port='/dev/ttyUSB0')
+    warm_start(quadz, 'station.json', configure)
+"""
+import json
+import os
+from calibration import read_version
+from gresponses import AxisRanges, ProbeValues
+from state import PROBES
+
+VERSION = 1
+
+
+def ranges_to_json(record):
+    if record is None:
+        return None
+    return dict((str(key), list(value)) for key, value in record.items())
+
+
+class InstrumentProfile(object):
+    """
+    Configuration of a station
+
+    Arguments:
+    data -- dict as written by save()
+    """
+    def __init__(self, data):
+        self.data = data
+
+    @classmethod
+    def capture(cls, quadz):
+        """
+        Get the profile of a configured QuadZDevice. Reads the device
+        versions and any range not cached yet.
+        """
+        queue = quadz.queue
+        state = quadz.state
+        if state.xyz_range is None:
+            quadz.get_travel_range()
+        if state.probe_x_range is None:
+            quadz.get_probe_x_range()
+        if state.probe_width is None:
+            quadz.get_probe_width()
+        pumps = []
+        syringes = {}
+        for probe in PROBES:
+            syringe = quadz.syringe[probe]
+            if syringe.device_id == -1:
+                continue
+            if syringe.side == 'left':
+                pumps.append({'device_id': syringe.device_id,
+                              'version': read_version(queue,
+                                                      syringe.device_id),
+                              'left_probe': syringe.left_probe,
+                              'right_probe': syringe.right_probe})
+            syringes[str(probe)] = {'syringe_size': syringe.syringe_size,
+                                    'flow_rate': syringe.flow_rate}
+        delays = getattr(queue, 'delays', {})
+        return cls({'version': VERSION,
+                    'handler': {'device_id': quadz.device_id,
+                                'version': read_version(queue,
+                                                        quadz.device_id)},
+                    'pumps': pumps,
+                    'syringes': syringes,
+                    'xyz_range': ranges_to_json(state.xyz_range),
+                    'probe_x_range': ranges_to_json(state.probe_x_range),
+                    'probe_width': state.probe_width,
+                    'delays': dict((str(device_id), list(value))
+                                   for device_id, value in delays.items())})
+
+    def devices(self):
+        """
+        Returns:
+        list of (device id, version), the liquid handler first
+        """
+        handler = self.data['handler']
+        return [(handler['device_id'], handler['version'])] + \
+               [(pump['device_id'], pump['version'])
+                for pump in self.data['pumps']]
+
+    def verify(self, quadz):
+        """
+        Register the devices of the profile with the queue and compare
+        their versions with the profile
+
+        Returns:
+        list of device ids that did not answer or answer with another
+        version
+        """
+        queue = quadz.queue
+        changed = []
+        for device_id, version in self.devices():
+            if device_id not in queue.registered_devices:
+                queue.register_device(device_id)
+            if read_version(queue, device_id) != version:
+                changed.append(device_id)
+        return changed
+
+    def apply(self, quadz):
+        """
+        Configure a QuadZDevice from the profile without sending commands.
+        The devices must have been registered by verify().
+        """
+        data = self.data
+        state = quadz.state
+        quadz.device_id = data['handler']['device_id']
+        with state.lock:
+            for pump in data['pumps']:
+                device_id = pump['device_id']
+                left, right = pump['left_probe'], pump['right_probe']
+                quadz.syringe[left].assign(device_id, 'left', right)
+                quadz.syringe[right].assign(device_id, 'right', left)
+                if device_id not in quadz.syringe_devices:
+                    quadz.syringe_devices.append(device_id)
+            for probe, settings in data['syringes'].items():
+                syringe = quadz.syringe[int(probe)]
+                syringe.syringe_size = settings['syringe_size']
+                syringe.flow_rate = settings['flow_rate']
+        values = {'probe_width': data['probe_width']}
+        if data['xyz_range'] is not None:
+            ranges = data['xyz_range']
+            values['xyz_range'] = AxisRanges(*[tuple(ranges[axis])
+                                               for axis in 'XYZ'])
+        if data['probe_x_range'] is not None:
+            ranges = data['probe_x_range']
+            values['probe_x_range'] = ProbeValues(*[tuple(ranges[str(probe)])
+                                                    for probe in PROBES])
+        state.update(**values)
+        if hasattr(quadz.queue, 'set_delays'):
+            for device_id, delays in data['delays'].items():
+                quadz.queue.set_delays(int(device_id), *delays)
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.data, f, indent=1, sort_keys=True)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a profile, None if the file does not exist or was written by
+        another version
+        """
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            data = json.load(f)
+        if data.get('version') != VERSION:
+            return None
+        return cls(data)
+
+
+def warm_start(quadz, path, configure, cold = False):
+    """
+    Set up a QuadZDevice from its saved profile, or configure it and save
+    the profile if there is none or a device changed
+
+    Arguments:
+    quadz -- QuadZDevice
+    path -- profile file
+    configure -- function called with quadz for a cold start
+    cold -- ignore the saved profile
+
+    Returns:
+    True for a warm start, False for a cold start
+    """
+    log = quadz.queue.log
+    profile = None if cold else InstrumentProfile.load(path)
+    if profile is not None:
+        changed = profile.verify(quadz)
+        if not changed:
+            profile.apply(quadz)
+            log.info('Warm start from %s' % (path))
+            return True
+        log.warning('Devices %s changed since %s was saved, configuring' %
+                    (', '.join(map(str, changed)), path))
+    configure(quadz)
+    InstrumentProfile.capture(quadz).save(path)
+    return False
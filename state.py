@@ -0,0 +1,135 @@
+"""
+Instrument state shared by QuadZDevice and monitoring threads.
+
+Per-probe data lives in fixed lists indexed by probe number (index 0 is
+unused), so hot methods look up state with a single list index. The probe
+to syringe pump mapping (device id, side, letter and partner) is computed
+once when the pump is registered.
+"""
+import threading
+
+PROBES = (1, 2, 3, 4)
+
+
+class Syringe(object):
+    """
+    State of the 402 syringe assigned to a probe
+
+    Item access (syringe['current_volume']) is kept for scripts written
+    against the old dict based state.
+    """
+    __slots__ = ('probe', 'device_id', 'side', 'letter', 'partner_probe',
+                 'left_probe', 'right_probe', 'syringe_size', 'status',
+                 'current_volume', 'valve_status', 'motor_force',
+                 'flow_rate', 'next_operation', 'stroke_ratio',
+                 'strokes_timed')
+
+    def __init__(self, probe):
+        self.probe = probe
+        self.device_id = -1
+        self.side = None
+        # 'L' or 'R', the syringe letter used in 402 commands
+        self.letter = None
+        self.partner_probe = 0
+        # Probes assigned to the left and right syringe of the same pump
+        self.left_probe = probe
+        self.right_probe = probe
+        self.syringe_size = 0
+        self.status = 'I'
+        self.current_volume = 0
+        self.valve_status = 'N'
+        self.motor_force = 3
+        self.flow_rate = 10
+        self.next_operation = 0
+        # Measured / predicted stroke duration, see strokes.StrokeTimer
+        self.stroke_ratio = 1.0
+        self.strokes_timed = 0
+
+    def assign(self, device_id, side, partner_probe):
+        """
+        Assign the syringe to a side of a 402 syringe pump
+
+        Arguments:
+        device_id -- device id of the syringe pump
+        side -- 'left' or 'right'
+        partner_probe -- probe assigned to the other syringe of the pump
+        """
+        self.device_id = device_id
+        self.side = side
+        self.partner_probe = partner_probe
+        if side == 'right':
+            self.letter = 'R'
+            self.left_probe = partner_probe
+            self.right_probe = self.probe
+        else:
+            self.letter = 'L'
+            self.left_probe = self.probe
+            self.right_probe = partner_probe
+
+    def copy(self):
+        syringe = Syringe.__new__(Syringe)
+        for name in self.__slots__:
+            setattr(syringe, name, getattr(self, name))
+        return syringe
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __repr__(self):
+        return '<Syringe probe %i: device %i %s %s uL %s>' % (self.probe,
+                    self.device_id, str(self.side), str(self.current_volume),
+                    self.status)
+
+
+class InstrumentState(object):
+    """
+    Cached liquid handler and syringe pump state
+
+    Writers update the state while holding lock, snapshot() takes the same
+    lock and returns a copy that monitoring threads can read freely.
+    """
+    # Cached responses of the Quad-Z getters (gresponses records, replaced
+    # as a whole and never mutated)
+    cached = ('liquid_sensitivity', 'liquid_detector_status', 'probe_speed',
+              'probe_x_range', 'xyz_range', 'home_phase', 'motor_status',
+              'probe_width')
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.syringes = [None] + [Syringe(probe) for probe in PROBES]
+        # Probe letters used in Quad-Z commands, indexed by probe
+        self.letters = [None, 'a', 'b', 'c', 'd']
+        for name in self.cached:
+            setattr(self, name, None)
+
+    def update(self, **values):
+        """
+        Atomically replace cached values, e.g. update(probe_speed=speed)
+        """
+        with self.lock:
+            for name, value in values.items():
+                if name not in self.cached:
+                    raise AttributeError(name)
+                setattr(self, name, value)
+
+    def snapshot(self):
+        """
+        Get a consistent copy of the state
+        """
+        state = InstrumentState.__new__(InstrumentState)
+        state.lock = threading.RLock()
+        state.letters = self.letters
+        with self.lock:
+            state.syringes = [None] + [self.syringes[probe].copy()
+                                       for probe in PROBES]
+            for name in self.cached:
+                setattr(state, name, getattr(self, name))
+        return state
@@ -0,0 +1,311 @@
+"""
+Handles for syringe strokes that run in the background.
+
+QuadZDevice.start_syringe_pumps() queues the volume and start commands of
+every syringe at once and returns a StrokeHandle instead of waiting for the
+strokes to finish. The handle reconciles the volume ledger when a pump has
+stopped.
+
+The duration of a stroke is predicted from the syringe flow rate, so the
+handle does not poll a pump until its strokes are close to finishing.
+StrokeTimer compares the measured durations with the predictions for each
+syringe and warns when a syringe drifts from its flow rate.
+
+Example:
+    handle = quadz.start_syringe_pumps([-100, -100, -100, -100])
+    quadz.move_to(1000, 2000)   # runs while the syringes aspirate
+    handle.wait()
+    handle.check()
+"""
+import gexceptions
+from gcommands import PUMP_402
+
+
+def stroke_duration(volume, flow_rate):
+    """
+    Get the seconds a syringe takes to move a volume
+
+    Arguments:
+    volume -- volume in uL (the sign is ignored)
+    flow_rate -- flow rate in mL/min
+
+    Returns:
+    seconds
+    """
+    if flow_rate <= 0:
+        return 0.0
+    # 1 mL/min is 1000 uL per 60 seconds
+    return abs(volume) * .06 / flow_rate
+
+
+class StrokeTimer(object):
+    """
+    Predicts stroke durations and tracks how long strokes really take
+
+    Syringe.stroke_ratio is a moving average of measured / predicted
+    duration. Once min_samples strokes were timed it scales the predictions,
+    so polling adapts to the real speed of each syringe, and a ratio outside
+    1 +- drift_tolerance is logged as drift (e.g. a worn syringe or a wrong
+    flow rate setting). The quiet time before the first poll is never longer
+    than the raw prediction: a late first poll would measure a longer
+    stroke and raise the ratio further.
+
+    Arguments:
+    state -- state.InstrumentState holding the syringes
+    quiet_fraction -- fraction of the expected duration during which the
+                      pump is not polled, the shortest stroke of a pump
+                      decides when polling starts
+    smoothing -- weight of the newest measurement in the moving average
+    drift_tolerance -- allowed deviation of the ratio from 1
+    min_duration -- strokes predicted to be shorter are not measured, their
+                    duration is dominated by command latency
+    min_samples -- strokes timed before the ratio is used or drift logged
+    log -- logger for drift warnings
+    """
+    def __init__(self, state, quiet_fraction = .9, smoothing = .2,
+                 drift_tolerance = .15, min_duration = .5, min_samples = 3,
+                 log = None):
+        self.state = state
+        self.syringes = state.syringes
+        self.quiet_fraction = quiet_fraction
+        self.smoothing = smoothing
+        self.drift_tolerance = drift_tolerance
+        self.min_duration = min_duration
+        self.min_samples = min_samples
+        self.log = log
+        # Number of times a syringe started drifting, and the probes that
+        # are drifting now
+        self.drifts = 0
+        self.drifting = set()
+
+    def predict(self, probe, volume):
+        """
+        Get the duration of a stroke from the flow rate of the syringe
+        """
+        return stroke_duration(volume, self.syringes[probe].flow_rate)
+
+    def expected(self, probe, predicted):
+        """
+        Get the duration a prediction is expected to really take
+        """
+        syringe = self.syringes[probe]
+        if syringe.strokes_timed < self.min_samples:
+            return predicted
+        return predicted * syringe.stroke_ratio
+
+    def quiet(self, probe, predicted):
+        """
+        Get the seconds after the start during which the pump is not polled
+        """
+        return min(self.expected(probe, predicted), predicted) * \
+               self.quiet_fraction
+
+    def record(self, probe, predicted, actual):
+        """
+        Record the measured duration of a stroke
+
+        Arguments:
+        probe -- probe number of the syringe
+        predicted -- duration from predict()
+        actual -- measured duration
+        """
+        if predicted < self.min_duration:
+            return
+        with self.state.lock:
+            syringe = self.syringes[probe]
+            ratio = actual / predicted
+            syringe.strokes_timed += 1
+            # Plain average of the first samples, then a moving average
+            weight = max(self.smoothing, 1.0 / syringe.strokes_timed)
+            syringe.stroke_ratio += weight * (ratio - syringe.stroke_ratio)
+            ratio = syringe.stroke_ratio
+            if syringe.strokes_timed < self.min_samples:
+                return
+        if abs(ratio - 1) <= self.drift_tolerance:
+            self.drifting.discard(probe)
+        elif probe not in self.drifting:
+            self.drifting.add(probe)
+            self.drifts += 1
+            if self.log is not None:
+                self.log.warning('Syringe for probe #%i strokes take %.2f '
+                                 'times the time predicted from its flow '
+                                 'rate' % (probe, ratio))
+
+    def drift(self, probe):
+        """
+        Get the relative deviation of a syringe from its predictions
+        """
+        return self.syringes[probe].stroke_ratio - 1
+
+
+class StrokeHandle(object):
+    """
+    Strokes started on one or more 402 syringe pumps
+
+    Arguments:
+    quadz -- QuadZDevice the strokes were started on
+    strokes -- dict of device id: (probes, letter), probes are the probes
+               whose syringes were started, letter the syringe letter sent
+               with the start command ('L', 'R' or 'B')
+    durations -- predicted durations (StrokeTimer.predict()) by probe
+    queued -- clock time before the start commands were queued
+    """
+    # Status polls of a pump that may fail in a row before done() raises
+    # DeviceNotResponding
+    max_failed_polls = 3
+
+    def __init__(self, quadz, strokes, durations = None, queued = None):
+        self.quadz = quadz
+        self.strokes = strokes
+        self.running = dict(strokes)
+        # Predicted durations (StrokeTimer.predict()) indexed by probe
+        self.durations = durations or {}
+        self.queued = quadz.clock.time() if queued is None else queued
+        # Seconds between polls, set by wait()
+        self.interval = quadz.time_delay
+        # Time each start command was sent, by device id
+        self.sent = {}
+        # Time of the last poll that found a pump running, by device id
+        self.polled = {}
+        # Status polls that failed in a row, by device id
+        self.failed_polls = {}
+        # Time each syringe was seen stopped, by probe
+        self.finished = {}
+        # Probes whose final volume differs from the volume ledger
+        self.errors = []
+
+    def start_time(self, device_id, now):
+        """
+        Get the time the start command of a pump was sent: the time the
+        queue sent the last command to the pump, or now if the queue does
+        not record it (e.g. a daemon.RemoteQueue)
+        """
+        sent = getattr(self.quadz.queue, 'sent_times', {}).get(device_id)
+        if sent is None or sent < self.queued:
+            return now
+        return sent
+
+    def quiet_until(self, device_id):
+        """
+        Get the time before which a pump is not polled, None if its start
+        command has not been sent yet
+        """
+        if device_id not in self.sent:
+            return None
+        timer = self.quadz.stroke_timer
+        probes = self.running[device_id][0]
+        quiet = [timer.quiet(probe, self.durations.get(probe, 0.0))
+                 for probe in probes if probe not in self.finished]
+        return self.sent[device_id] + min(quiet or [0.0])
+
+    def done(self):
+        """
+        Poll the pumps whose strokes may have finished, once each. A pump
+        whose status cannot be read counts as running, after
+        max_failed_polls failed polls in a row DeviceNotResponding is
+        raised.
+
+        Returns:
+        True when all strokes have finished
+        """
+        quadz = self.quadz
+        for device_id, (probes, letter) in self.running.items():
+            # Status polls overtake queued buffered commands, a poll before
+            # the start command is sent would read the previous stroke
+            if quadz.queue.pending(device_id):
+                continue
+            now = quadz.clock.time()
+            if device_id not in self.sent:
+                self.sent[device_id] = self.start_time(device_id, now)
+            if now < self.quiet_until(device_id):
+                continue
+            res = quadz.immediate(PUMP_402.get_syringe_status(), device_id)
+            if res is False:
+                failed = self.failed_polls.get(device_id, 0) + 1
+                self.failed_polls[device_id] = failed
+                if failed >= self.max_failed_polls:
+                    raise gexceptions.DeviceNotResponding(device_id,
+                        'No syringe status from device %i in %i polls' %
+                        (device_id, failed))
+                continue
+            self.failed_polls[device_id] = 0
+            now = quadz.clock.time()
+            # The strokes that stopped did so after the last poll that saw
+            # them running, on average half a poll interval ago
+            end = max(self.polled.get(device_id, self.sent[device_id]),
+                      now - self.interval / 2.0)
+            self.polled[device_id] = now
+            syringe = quadz.syringe[probes[0]]
+            for probe in probes:
+                if probe in self.finished:
+                    continue
+                if quadz.syringe[probe].letter == 'L':
+                    status = res.left_status
+                else:
+                    status = res.right_status
+                if status != 'R':
+                    self.finished[probe] = now
+                    quadz.stroke_timer.record(probe,
+                                              self.durations.get(probe, 0.0),
+                                              end - self.sent[device_id])
+            if [probe for probe in probes if probe not in self.finished]:
+                continue
+            del self.running[device_id]
+            self.errors.extend(probe for probe in
+                               quadz.update_syringe_status(syringe, res)
+                               if probe in probes)
+        return not self.running
+
+    def remaining(self):
+        """
+        Get the seconds until the next pump may need a poll
+        """
+        now = self.quadz.clock.time()
+        times = [self.quiet_until(device_id) for device_id in self.running]
+        if not times or None in times:
+            return 0.0
+        return max(0.0, min(times) - now)
+
+    def wait(self, timeout = None, interval = None):
+        """
+        Wait for the strokes to finish
+
+        Arguments:
+        timeout -- maximum number of seconds to wait (None waits forever)
+        interval -- seconds between polls, by default quadz.time_delay
+
+        Returns:
+        True if the strokes finished, False if the timeout expired
+        """
+        clock = self.quadz.clock
+        if interval is None:
+            interval = self.quadz.time_delay
+        self.interval = interval
+        if timeout is not None:
+            end = clock.time() + timeout
+        while not self.done():
+            delay = max(interval, self.remaining())
+            if timeout is not None:
+                if clock.time() >= end:
+                    return False
+                delay = min(delay, max(end - clock.time(), 0.001))
+            self.quadz.sleep(delay, '[stroke wait]')
+        return True
+
+    def check(self):
+        """
+        Raise VolumeError if a finished syringe holds a different volume
+        than expected
+        """
+        if self.errors:
+            probes = ', #'.join(map(str, sorted(self.errors)))
+            raise gexceptions.VolumeError('Probe #%s did not pump desired '
+                                          'volume' % (probes))
+
+    def probes(self):
+        return sorted(probe for probes, letter in self.strokes.values()
+                      for probe in probes)
+
+    def __repr__(self):
+        return '<StrokeHandle probes %s, %i pumps running>' % (
+                   self.probes(), len(self.running))
@@ -0,0 +1,237 @@
+"""
+Worklist execution engine.
+
+A worklist is a list of transfers (source well, destination well, volume,
+probe) stored as CSV or JSON Lines. Transfers are read one row at a time,
+compiled into operations (move, probe height, aspirate, dispense) and
+executed on a QuadZDevice, so a worklist is never fully loaded into memory.
+
+CSV worklists need a header row with the columns source, destination,
+volume and optionally probe. JSON worklists have one object per line with
+the same keys.
+
+Example:
+    runner = WorklistRunner(quadz, index)
+    runner.run(read_worklist('transfers.csv'))
+    print runner.stats
+"""
+import csv
+import json
+import planner
+
+
+class Transfer(object):
+    """
+    One worklist row, volumes in microliters
+    """
+    __slots__ = ('source', 'destination', 'volume', 'probe', 'line')
+
+    def __init__(self, source, destination, volume, probe = 1, line = 0):
+        self.source = source
+        self.destination = destination
+        self.volume = volume
+        self.probe = probe
+        self.line = line
+
+    def __repr__(self):
+        return '<Transfer %s -> %s %s uL probe %i>' % (self.source,
+                   self.destination, str(self.volume), self.probe)
+
+
+class Operation(object):
+    """
+    One instrument operation compiled from a transfer
+
+    kind is 'move' (args: x, y), 'height' (args: z), 'aspirate' or
+    'dispense' (args: volume)
+    """
+    __slots__ = ('kind', 'probe', 'args')
+
+    def __init__(self, kind, probe, *args):
+        self.kind = kind
+        self.probe = probe
+        self.args = args
+
+    def __repr__(self):
+        return '<Operation %s probe %i %r>' % (self.kind, self.probe,
+                                               self.args)
+
+
+def parse_row(row, line):
+    """
+    Convert a dict of strings from a worklist file to a Transfer
+    """
+    try:
+        volume = float(row['volume'])
+        probe = int(row.get('probe') or 1)
+        source = row['source'].strip()
+        destination = row['destination'].strip()
+    except (KeyError, TypeError, ValueError, AttributeError), e:
+        raise ValueError('Worklist line %i: invalid row (%s)' % (line, e))
+    if volume <= 0:
+        raise ValueError('Worklist line %i: volume must be positive' % (line))
+    if not 1 <= probe <= 4:
+        raise ValueError('Worklist line %i: invalid probe %i' % (line, probe))
+    return Transfer(source, destination, volume, probe, line)
+
+
+def read_worklist(path, format = None):
+    """
+    Read transfers from a CSV or JSON Lines file one row at a time
+
+    Arguments:
+    path -- file name or open file
+    format -- 'csv' or 'json', by default taken from the file extension
+
+    Returns:
+    generator of Transfer
+    """
+    if format is None:
+        name = getattr(path, 'name', path)
+        format = 'json' if str(name).lower().endswith(('.json', '.jsonl')) \
+                        else 'csv'
+    if isinstance(path, basestring):
+        with open(path, 'rb') as f:
+            for transfer in read_worklist(f, format):
+                yield transfer
+        return
+    if format == 'csv':
+        reader = csv.DictReader(path)
+        for row in reader:
+            yield parse_row(row, reader.line_num)
+    elif format == 'json':
+        for line, text in enumerate(path, 1):
+            if text.strip():
+                yield parse_row(json.loads(text), line)
+    else:
+        raise ValueError('Unknown worklist format %s' % (format))
+
+
+class WorklistRunner(object):
+    """
+    Compiles transfers into operations and executes them
+
+    Arguments:
+    quadz -- QuadZDevice with the syringe pumps set up
+    index -- labware.WellIndex the worklist wells are in
+    aspirate_offset -- height above the well bottom to aspirate at
+    dispense_offset -- height below the well top to dispense at
+    clearance -- probe clearance above labware, see planner.ClearancePlanner
+    progress -- function called with the stats dict every progress_interval
+                transfers, by default progress is logged
+    progress_interval -- number of transfers between progress reports
+    """
+    def __init__(self, quadz, index, aspirate_offset = 10,
+                 dispense_offset = 20, clearance = 50, progress = None,
+                 progress_interval = 100):
+        self.quadz = quadz
+        self.index = index
+        self.aspirate_offset = aspirate_offset
+        self.dispense_offset = dispense_offset
+        self.planner = planner.ClearancePlanner(quadz, index, clearance)
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.stats = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        """
+        Reset the counters. 'seconds' holds the time spent in each kind of
+        operation.
+        """
+        self.stats = {'transfers': 0,
+                      'operations': 0,
+                      'volume': 0.0,
+                      'elapsed': 0.0,
+                      'transfers_per_second': 0.0,
+                      'seconds': {'move': 0.0, 'height': 0.0,
+                                  'aspirate': 0.0, 'dispense': 0.0}}
+
+    def compile(self, transfer):
+        """
+        Compile a transfer into operations
+
+        Returns:
+        list of Operation
+        """
+        probe = transfer.probe
+        sx, sy, s_top, s_bottom = self.index[transfer.source]
+        dx, dy, d_top, d_bottom = self.index[transfer.destination]
+        return [Operation('move', probe, sx, sy),
+                Operation('height', probe, s_bottom + self.aspirate_offset),
+                Operation('aspirate', probe, transfer.volume),
+                Operation('move', probe, dx, dy),
+                Operation('height', probe, d_top - self.dispense_offset),
+                Operation('dispense', probe, transfer.volume)]
+
+    def execute(self, operation):
+        quadz = self.quadz
+        kind = operation.kind
+        probe = operation.probe
+        if kind == 'move':
+            self.planner.move_to(operation.args[0], operation.args[1], probe)
+        elif kind == 'height':
+            self.planner.move_probe(operation.args[0], [probe])
+        elif kind == 'aspirate':
+            quadz.set_valve_status(probe, 'N')
+            quadz.set_aspirate_volume(probe, operation.args[0])
+            quadz.start_syringe_pump(probe)
+        elif kind == 'dispense':
+            quadz.set_valve_status(probe, 'N')
+            quadz.set_dispense_volume(probe, operation.args[0])
+            quadz.start_syringe_pump(probe)
+        else:
+            raise ValueError('Unknown operation %s' % (kind))
+
+    def run(self, transfers):
+        """
+        Execute transfers in order
+
+        Arguments:
+        transfers -- iterable of Transfer, e.g. read_worklist()
+
+        Returns:
+        stats dict
+        """
+        stats = self.stats
+        seconds = stats['seconds']
+        clock = self.quadz.clock
+        started = clock.time() - stats['elapsed']
+        for transfer in transfers:
+            try:
+                operations = self.compile(transfer)
+            except KeyError, e:
+                raise ValueError('Worklist line %i: unknown well %s' %
+                                 (transfer.line, e.args[0]))
+            for operation in operations:
+                begin = clock.time()
+                self.execute(operation)
+                seconds[operation.kind] += clock.time() - begin
+            stats['transfers'] += 1
+            stats['operations'] += len(operations)
+            stats['volume'] += transfer.volume
+            if stats['transfers'] % self.progress_interval == 0:
+                self.update_elapsed(started)
+                self.report()
+        self.update_elapsed(started)
+        if stats['transfers'] % self.progress_interval:
+            self.report()
+        return stats
+
+    def update_elapsed(self, started):
+        stats = self.stats
+        stats['elapsed'] = self.quadz.clock.time() - started
+        if stats['elapsed'] > 0:
+            stats['transfers_per_second'] = stats['transfers'] / \
+                                            stats['elapsed']
+
+    def report(self):
+        if self.progress is not None:
+            self.progress(self.stats)
+            return
+        stats = self.stats
+        self.quadz.queue.log.info('Worklist: %i transfers, %.1f uL, %.1fs '
+                                  '(%.2f transfers/s)' %
+                                  (stats['transfers'], stats['volume'],
+                                   stats['elapsed'],
+                                   stats['transfers_per_second']))